@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+import asyncio
+from starlette.responses import Response
+import jsonrpc
+from logger import logger
+from ratelimit import RateLimited
+
+
+class BatchHandler:
+    """Splits JSON-RPC batches so cached and in-flight entries are answered locally,
+    and only the misses are forwarded upstream in bounded, parallel sub-batches."""
+
+    def __init__(self, config, upstream, cache, flights, heads) -> None:
+        self.max_size = config.BATCH["MAX_SIZE"]
+        self.upstream_size = config.BATCH["UPSTREAM_SIZE"]
+        self.upstream = upstream
+        self.cache = cache
+        self.flights = flights
+        self.heads = heads
+
+    async def handle(self, network, path, calls):
+        if len(calls) == 0:
+            return self.error_resp(-32600, "Invalid Request: empty batch")
+        if len(calls) > self.max_size:
+            return self.error_resp(
+                -32600, f"Invalid Request: batch exceeds {self.max_size} calls"
+            )
+        replies = [None] * len(calls)
+        cache_keys = {}
+        pending = {}
+        misses = []
+        first_miss = {}
+        hits = 0
+        keys = [
+            (
+                self.cache.get_key(network, call)
+                if isinstance(call, dict)
+                else (None, None)
+            )
+            for call in calls
+        ]
+        # Looked up together, so misses in memory go to the persistent tier concurrently
+        cached = await asyncio.gather(
+            *[self.cache.lookup(key) for key, _ in keys if key is not None]
+        )
+        cached = iter(cached)
+        for i, call in enumerate(calls):
+            key, ttl = keys[i]
+            result = next(cached) if key is not None else None
+            if not isinstance(call, dict) or not isinstance(call.get("method"), str):
+                replies[i] = jsonrpc.error_body(None, -32600, "Invalid Request")
+                continue
+            head_result = self.heads.get_result(network, call)
+            if head_result is not None:
+                replies[i] = jsonrpc.result_body(call.get("id"), head_result)
+                hits += 1
+                continue
+            if key is not None:
+                if result is not None:
+                    replies[i] = jsonrpc.result_body(call.get("id"), result)
+                    hits += 1
+                    continue
+                cache_keys[i] = (key, ttl)
+            if jsonrpc.is_shareable(call["method"]):
+                flight_key = jsonrpc.flight_key(network, path, call)
+                if flight_key in first_miss:
+                    # Repeated within this batch, answered from the first occurrence
+                    pending[i] = first_miss[flight_key]
+                    continue
+                task = self.flights.get(flight_key)
+                if task is not None:
+                    pending[i] = task
+                    continue
+                first_miss[flight_key] = i
+            misses.append(i)
+
+        for n in range(0, len(misses), self.upstream_size):
+            chunk = misses[n : n + self.upstream_size]
+            batch_task = asyncio.ensure_future(
+                self.fetch_chunk(network, path, [calls[i] for i in chunk])
+            )
+            for pos, i in enumerate(chunk):
+                coro = self.pick(batch_task, pos)
+                if jsonrpc.is_shareable(calls[i]["method"]):
+                    pending[i] = self.flights.start(
+                        jsonrpc.flight_key(network, path, calls[i]), coro
+                    )
+                else:
+                    pending[i] = asyncio.ensure_future(coro)
+        # Point in-batch repeats at the task of their first occurrence
+        for i, first in pending.items():
+            if isinstance(first, int):
+                pending[i] = pending[first]
+
+        indexes = list(pending.keys())
+        results = await asyncio.gather(*[asyncio.shield(pending[i]) for i in indexes])
+        for i, (status, content) in zip(indexes, results):
+            replies[i] = jsonrpc.with_id(content, calls[i].get("id"))
+            if status == 200 and i in cache_keys:
+                result = jsonrpc.extract_result(replies[i])
+                if result is not None:
+                    self.cache.set(cache_keys[i][0], result, cache_keys[i][1])
+
+        # Notifications (calls without an id) get no reply
+        body = b",".join(
+            r
+            for call, r in zip(calls, replies)
+            if not isinstance(call, dict) or "id" in call
+        )
+        if hits == len(calls):
+            status = "HIT"
+        elif hits == 0:
+            status = "MISS"
+        else:
+            status = "PARTIAL"
+        return Response(
+            b"[" + body + b"]",
+            media_type="application/json",
+            headers={"X-Cache": status},
+        )
+
+    async def fetch_chunk(self, network, path, calls):
+        """Forwards calls upstream as one batch, with ids rewritten to their position.
+        Returns a list of (status_code, content) in the same order as `calls`."""
+        body = jsonrpc.dumps([dict(call, id=pos) for pos, call in enumerate(calls)])
+        try:
+            r = await self.upstream.fetch(
+                network,
+                "POST",
+                path,
+                content=body,
+                headers={"content-type": "application/json"},
+                call=calls,
+            )
+            data = jsonrpc.parse_call(r.content)
+            if r.status_code != 200 or not isinstance(data, list):
+                raise ValueError(f"upstream returned {r.status_code}")
+        except RateLimited as e:
+            message = f"Rate limit exceeded: {e}"
+            return [
+                (429, jsonrpc.error_body(pos, -32005, message))
+                for pos in range(len(calls))
+            ]
+        except Exception as e:
+            logger.warning(f"Batch request to {network} failed: {e}")
+            return [
+                (502, jsonrpc.error_body(pos, -32603, f"Upstream error: {e}"))
+                for pos in range(len(calls))
+            ]
+        entries = {i.get("id"): i for i in data if isinstance(i, dict)}
+        return [
+            (
+                (200, jsonrpc.dumps(entries[pos]))
+                if pos in entries
+                else (
+                    502,
+                    jsonrpc.error_body(pos, -32603, "Upstream error: missing reply"),
+                )
+            )
+            for pos in range(len(calls))
+        ]
+
+    async def pick(self, batch_task, pos):
+        return (await asyncio.shield(batch_task))[pos]
+
+    def error_resp(self, code, message):
+        return Response(
+            jsonrpc.error_body(None, code, message), media_type="application/json"
+        )
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""Stand-in for a BlockPi EVM endpoint, used by the benchmarks instead of the live service.
+Serves JSON-RPC over HTTP and WebSocket (including newHeads subscriptions) on one port,
+with configurable latency, payload sizes and error rate."""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import Response
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocketDisconnect
+
+
+def parse_latency(spec):
+    """Returns a function sampling a delay in seconds from a spec such as "fixed:20",
+    "uniform:10:50", "exp:20" or "lognormal:20:0.5" (milliseconds; median and sigma)."""
+    kind, *args = spec.split(":")
+    args = [float(i) for i in args]
+    if kind == "fixed":
+        return lambda: args[0] / 1000
+    if kind == "uniform":
+        return lambda: random.uniform(args[0], args[1]) / 1000
+    if kind == "exp":
+        return lambda: random.expovariate(1 / args[0]) / 1000 if args[0] else 0.0
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(0, args[1]) * args[0] / 1000
+    raise ValueError(f"unknown latency distribution {kind!r}")
+
+
+class MockChain:
+    def __init__(self, args) -> None:
+        self.latency = parse_latency(args.latency)
+        self.error_rate = args.error_rate
+        self.block_time = args.block_time
+        self.logs_per_block = args.logs_per_block
+        self.txs_per_block = args.txs_per_block
+        self.height = args.height
+        self.log_data = "0x" + "ab" * args.log_size
+        self.subscriptions = {}
+        self.ids = itertools.count(1)
+        self.requests = 0
+
+    def block(self, number):
+        return {
+            "number": hex(number),
+            "hash": "0x%064x" % number,
+            "parentHash": "0x%064x" % (number - 1),
+            "timestamp": hex(int(time.time())),
+            "transactions": [
+                "0x%064x" % (number * 1000 + i) for i in range(self.txs_per_block)
+            ],
+        }
+
+    def resolve(self, tag):
+        if tag in (None, "latest", "safe", "finalized", "pending"):
+            return self.height
+        if tag == "earliest":
+            return 0
+        return int(tag, 16)
+
+    def logs(self, log_filter):
+        first = self.resolve(log_filter.get("fromBlock"))
+        last = self.resolve(log_filter.get("toBlock"))
+        return [
+            {
+                "address": "0x%040x" % i,
+                "blockNumber": hex(number),
+                "blockHash": "0x%064x" % number,
+                "logIndex": hex(i),
+                "transactionHash": "0x%064x" % (number * 1000 + i),
+                "topics": ["0x%064x" % i],
+                "data": self.log_data,
+            }
+            for number in range(first, last + 1)
+            for i in range(self.logs_per_block)
+        ]
+
+    def answer(self, call):
+        method = call.get("method")
+        params = call.get("params") or []
+        if method == "eth_blockNumber":
+            result = hex(self.height)
+        elif method == "eth_chainId":
+            result = "0x1"
+        elif method in ("eth_getBlockByNumber", "eth_getBlockByHash"):
+            number = self.resolve(params[0]) if method == "eth_getBlockByNumber" else 1
+            result = self.block(number)
+        elif method == "eth_getLogs":
+            result = self.logs(params[0])
+        else:
+            result = "0x0"
+        return {"jsonrpc": "2.0", "id": call.get("id"), "result": result}
+
+    async def rpc(self, request):
+        body = json.loads(await request.body())
+        self.requests += 1
+        await asyncio.sleep(self.latency())
+        if random.random() < self.error_rate:
+            error = {"code": -32603, "message": "mock upstream error"}
+            return Response(
+                json.dumps({"jsonrpc": "2.0", "id": None, "error": error}),
+                status_code=503,
+                media_type="application/json",
+            )
+        if isinstance(body, list):
+            reply = [self.answer(i) for i in body]
+        else:
+            reply = self.answer(body)
+        return Response(
+            json.dumps(reply, separators=(",", ":")), media_type="application/json"
+        )
+
+    async def websocket(self, ws):
+        await ws.accept()
+        subscriptions = set()
+        try:
+            while True:
+                call = json.loads(await ws.receive_text())
+                await asyncio.sleep(self.latency())
+                if call.get("method") == "eth_subscribe":
+                    id = hex(next(self.ids))
+                    self.subscriptions[id] = ws
+                    subscriptions.add(id)
+                    reply = {"jsonrpc": "2.0", "id": call.get("id"), "result": id}
+                elif call.get("method") == "eth_unsubscribe":
+                    found = self.subscriptions.pop(call["params"][0], None) is not None
+                    reply = {"jsonrpc": "2.0", "id": call.get("id"), "result": found}
+                else:
+                    reply = self.answer(call)
+                await ws.send_text(json.dumps(reply))
+        except WebSocketDisconnect:
+            pass
+        finally:
+            for id in subscriptions:
+                self.subscriptions.pop(id, None)
+
+    async def produce_blocks(self):
+        """Advances the head and notifies newHeads subscribers. Each head carries the
+        time it was sent, so clients can measure delivery latency."""
+        while True:
+            await asyncio.sleep(self.block_time)
+            self.height += 1
+            head = dict(self.block(self.height), mockSentAt=time.time())
+            for id, ws in list(self.subscriptions.items()):
+                message = {
+                    "jsonrpc": "2.0",
+                    "method": "eth_subscription",
+                    "params": {"subscription": id, "result": head},
+                }
+                try:
+                    await ws.send_text(json.dumps(message))
+                except Exception:
+                    self.subscriptions.pop(id, None)
+
+    async def stats(self, request):
+        return Response(
+            json.dumps({"height": self.height, "requests": self.requests}),
+            media_type="application/json",
+        )
+
+
+def get_app(args):
+    chain = MockChain(args)
+
+    async def startup():
+        asyncio.create_task(chain.produce_blocks())
+
+    return Starlette(
+        routes=[
+            Route("/", chain.rpc, methods=["POST"]),
+            Route("/stats", chain.stats, methods=["GET"]),
+            WebSocketRoute("/", chain.websocket),
+        ],
+        on_startup=[startup],
+    )
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=9545)
+    parser.add_argument(
+        "--latency", default="fixed:20", help="upstream latency distribution"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="share of 503 replies"
+    )
+    parser.add_argument(
+        "--block-time", type=float, default=1.0, help="seconds per block"
+    )
+    parser.add_argument(
+        "--height", type=int, default=20_000_000, help="initial block height"
+    )
+    parser.add_argument("--logs-per-block", type=int, default=4)
+    parser.add_argument(
+        "--log-size", type=int, default=128, help="bytes of data per log"
+    )
+    parser.add_argument("--txs-per-block", type=int, default=100)
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    uvicorn.run(get_app(args), host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""Replays traffic recorded with CAPTURE_ENABLED against a proxy, at the original pace,
+scaled by --speed, or as fast as --concurrency allows with --speed 0. With --analyze it
+only summarizes the capture: calls per method, how often identical calls repeat (the
+best hit ratio a cache could reach) and response sizes."""
+import argparse
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timezone
+import httpx
+from run import RESULTS_PATH, summarize
+
+
+def load(paths):
+    """Returns the captured entries from all files, oldest first."""
+    entries = []
+    for path in paths:
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # The last line of a file still being written may be incomplete
+                    continue
+    entries.sort(key=lambda i: i["ts"])
+    return entries
+
+
+def build_request(entry, id):
+    """Returns (method, url path, kwargs) to re-issue an entry, or None if it can't be."""
+    if entry.get("truncated"):
+        return None
+    network = entry["network"]
+    if entry["http_method"] == "GET":
+        params = entry.get("query") or None
+        return "GET", f"/rpc/{network}/{entry.get('path') or ''}", {"params": params}
+    if "batch" in entry:
+        body = [
+            {
+                "jsonrpc": "2.0",
+                "id": id + n,
+                "method": i["method"],
+                "params": i["params"],
+            }
+            for n, i in enumerate(entry["batch"])
+        ]
+        return "POST", f"/rpc/{network}", {"json": body}
+    if "body" in entry:
+        return "POST", f"/rpc/{network}", {"content": entry["body"].encode()}
+    body = {"jsonrpc": "2.0", "id": id, "method": entry["method"]}
+    if entry.get("params") is not None:
+        body["params"] = entry["params"]
+    return "POST", f"/rpc/{network}", {"json": body}
+
+
+def call_keys(entry):
+    if "batch" in entry:
+        return [
+            (i["method"], json.dumps(i["params"], sort_keys=True))
+            for i in entry["batch"]
+        ]
+    if entry.get("truncated") or "body" in entry:
+        return []
+    return [(entry["method"], json.dumps(entry.get("params"), sort_keys=True))]
+
+
+def analyze(entries):
+    methods = {}
+    for entry in entries:
+        keys = call_keys(entry) or [(entry["method"], None)]
+        for method, params in keys:
+            stats = methods.setdefault(
+                method, {"calls": 0, "unique": set(), "bytes": 0}
+            )
+            stats["calls"] += 1
+            stats["unique"].add(params)
+        # Sizes are per request, batches count towards their first method
+        methods[keys[0][0]]["bytes"] += entry.get("size") or 0
+    span = entries[-1]["ts"] - entries[0]["ts"] if entries else 0
+    print(f"{len(entries)} requests over {span:.0f}s")
+    print(f"{'method':40} {'calls':>9} {'unique':>9} {'repeat':>7} {'avg bytes':>10}")
+    for method, stats in sorted(methods.items(), key=lambda i: -i[1]["calls"]):
+        unique = len(stats["unique"])
+        print(
+            f"{str(method)[:40]:40} {stats['calls']:>9} {unique:>9} "
+            f"{1 - unique / stats['calls']:>7.1%} {stats['bytes'] // stats['calls']:>10}"
+        )
+
+
+async def replay(entries, args):
+    latencies = []
+    methods = {}
+    counters = {"requests": 0, "errors": 0, "skipped": 0, "late": 0, "bytes": 0}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency)
+
+    async def send(client, entry, request):
+        method, url, kwargs = request
+        start = time.monotonic()
+        try:
+            r = await client.request(method, url, **kwargs)
+            content = r.content
+            failed = r.status_code != 200
+        except httpx.HTTPError:
+            content = b""
+            failed = True
+        finally:
+            semaphore.release()
+        elapsed = time.monotonic() - start
+        latencies.append(elapsed)
+        methods.setdefault(entry["method"], []).append(elapsed)
+        counters["requests"] += 1
+        counters["errors"] += failed
+        counters["bytes"] += len(content)
+
+    async with httpx.AsyncClient(
+        base_url=args.target, limits=limits, timeout=60
+    ) as client:
+        tasks = []
+        first = entries[0]["ts"] if entries else 0
+        start = time.monotonic()
+        for n, entry in enumerate(entries):
+            request = build_request(entry, n * 1000)
+            if request is None:
+                counters["skipped"] += 1
+                continue
+            if args.speed > 0:
+                delay = start + (entry["ts"] - first) / args.speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                elif delay < -0.1:
+                    # Behind schedule, the target or the concurrency limit can't keep up
+                    counters["late"] += 1
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(send(client, entry, request)))
+        await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - start
+    top = sorted(methods.items(), key=lambda i: -len(i[1]))[:20]
+    return {
+        **counters,
+        "elapsed": round(elapsed, 3),
+        "throughput": round(counters["requests"] / elapsed, 1) if elapsed else 0,
+        "latency_ms": summarize(latencies),
+        "recorded_latency_ms": summarize([i["latency_ms"] / 1000 for i in entries]),
+        "methods": {method: summarize(values) for method, values in top},
+    }
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("captures", nargs="+", help="capture-*.jsonl files")
+    parser.add_argument(
+        "--target", default="http://127.0.0.1:8528", help="proxy to replay to"
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="pace multiplier, 0 for as fast as possible",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=256, help="most requests in flight"
+    )
+    parser.add_argument(
+        "--limit", type=int, default=None, help="replay the first N requests"
+    )
+    parser.add_argument(
+        "--analyze", action="store_true", help="summarize without replaying"
+    )
+    parser.add_argument(
+        "--output", default=None, help="results file, timestamped by default"
+    )
+    return parser
+
+
+async def main():
+    args = get_parser().parse_args()
+    entries = load(args.captures)[: args.limit]
+    if args.analyze:
+        analyze(entries)
+        return
+    started = datetime.now(timezone.utc)
+    print(
+        f"Replaying {len(entries)} requests to {args.target} at speed {args.speed}..."
+    )
+    result = await replay(entries, args)
+    latency = result["latency_ms"]
+    print(
+        f"{result['requests']} requests in {result['elapsed']}s ({result['throughput']} req/s), "
+        f"{result['errors']} errors, {result['skipped']} skipped, {result['late']} late, "
+        f"p50 {latency.get('p50')} ms, p95 {latency.get('p95')} ms, p99 {latency.get('p99')} ms"
+    )
+    output = (
+        args.output or f"{RESULTS_PATH}/replay-{started.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    report = {
+        "started": started.isoformat(timespec="seconds"),
+        "captures": args.captures,
+        "settings": vars(args),
+        "result": result,
+    }
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved results to {output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
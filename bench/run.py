@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+"""Load benchmark for the proxy. Starts the mock upstream and the proxy pointed at it,
+runs each scenario for a fixed time and reports throughput, latency percentiles and the
+proxy's CPU and memory use. Results are saved as JSON, and --compare prints the change
+against an earlier run."""
+import argparse
+import asyncio
+import json
+import os
+import re
+import random
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+import httpx
+import websockets
+from dotenv import dotenv_values
+
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+ROOT_PATH = os.path.dirname(BENCH_PATH)
+RESULTS_PATH = f"{BENCH_PATH}/results"
+
+# Upstream settings read by config.py, e.g. ETH_RPC_URL or ETH_WSS_URL_2
+UPSTREAM_KEY = re.compile(r"^[A-Z0-9]+_(RPC|WSS)_URL(_\d+)?$")
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+    return {
+        "p50": round(percentile(latencies, 50) * 1000, 3),
+        "p95": round(percentile(latencies, 95) * 1000, 3),
+        "p99": round(percentile(latencies, 99) * 1000, 3),
+        "mean": round(sum(latencies) / len(latencies) * 1000, 3),
+        "max": round(latencies[-1] * 1000, 3),
+    }
+
+
+def call(method, params, id=1):
+    return {"jsonrpc": "2.0", "id": id, "method": method, "params": params}
+
+
+def random_address():
+    return "0x%040x" % random.getrandbits(160)
+
+
+class Scenarios:
+    """Request bodies per scenario, built around the mock's current height."""
+
+    def __init__(self, args, height) -> None:
+        self.height = height
+        self.logs_range = args.logs_range
+        self.batch_size = args.batch_size
+
+    def small(self, i):
+        # Distinct addresses at "latest": never cached or coalesced
+        return call("eth_getBalance", [random_address(), "latest"], i)
+
+    def cached(self, i):
+        # A working set of finalized blocks, served from the cache once warm
+        return call(
+            "eth_getBlockByNumber", [hex(self.height - 1000 - i % 200), False], i
+        )
+
+    def logs(self, i):
+        first = self.height - 100_000 + random.randrange(50_000)
+        log_filter = {
+            "fromBlock": hex(first),
+            "toBlock": hex(first + self.logs_range - 1),
+        }
+        return call("eth_getLogs", [log_filter], i)
+
+    def batch(self, i):
+        calls = []
+        for n in range(self.batch_size):
+            kind = n % 3
+            if kind == 0:
+                calls.append(self.small(n))
+            elif kind == 1:
+                calls.append(self.cached(i + n))
+            else:
+                to = {"to": random_address(), "data": "0x"}
+                calls.append(call("eth_call", [to, "latest"], n))
+        return calls
+
+
+class ProcessSampler:
+    """Samples CPU time and RSS of a process and its children from /proc."""
+
+    def __init__(self, pid) -> None:
+        self.pid = pid
+        self.first = {}
+        self.last = {}
+        self.rss = []
+        self.started = None
+        self.task = None
+
+    def tree(self):
+        pids = [self.pid]
+        for pid in pids:
+            try:
+                with open(f"/proc/{pid}/task/{pid}/children") as f:
+                    pids.extend(int(i) for i in f.read().split())
+            except OSError:
+                pass
+        return pids
+
+    def sample(self):
+        rss = 0
+        for pid in self.tree():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                with open(f"/proc/{pid}/status") as f:
+                    rss += next(int(i.split()[1]) for i in f if i.startswith("VmRSS:"))
+            except (OSError, StopIteration):
+                continue
+            # utime and stime, in clock ticks
+            ticks = int(fields[11]) + int(fields[12])
+            self.first.setdefault(pid, ticks)
+            self.last[pid] = ticks
+        self.rss.append(rss)
+
+    async def run(self, interval):
+        while True:
+            self.sample()
+            await asyncio.sleep(interval)
+
+    def start(self, interval=0.5):
+        if not os.path.exists(f"/proc/{self.pid}"):
+            return
+        self.started = time.monotonic()
+        self.task = asyncio.create_task(self.run(interval))
+
+    async def stop(self):
+        if self.task is None:
+            return None
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.sample()
+        elapsed = time.monotonic() - self.started
+        ticks = sum(self.last[pid] - self.first[pid] for pid in self.last)
+        return {
+            "cpu_percent": round(ticks / CLOCK_TICKS / elapsed * 100, 1),
+            "rss_mb_max": round(max(self.rss) / 1024, 1),
+            "rss_mb_end": round(self.rss[-1] / 1024, 1),
+        }
+
+
+async def run_http(url, make_body, concurrency, warmup, duration):
+    """Closed-loop load: `concurrency` clients each send the next request as soon as
+    the previous one is answered. Returns latencies and counters for the measured part.
+    """
+    latencies = []
+    counters = {"requests": 0, "errors": 0, "bytes": 0}
+    limits = httpx.Limits(
+        max_connections=concurrency, max_keepalive_connections=concurrency
+    )
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        start = time.monotonic()
+        measure_from = start + warmup
+        deadline = measure_from + duration
+
+        async def worker(n):
+            i = n
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    return
+                i += concurrency
+                try:
+                    r = await client.post(url, json=make_body(i))
+                    content = r.content
+                    failed = r.status_code != 200 or b'"error"' in content[:200]
+                except httpx.HTTPError:
+                    content = b""
+                    failed = True
+                if now < measure_from:
+                    continue
+                latencies.append(time.monotonic() - now)
+                counters["requests"] += 1
+                counters["bytes"] += len(content)
+                counters["errors"] += failed
+
+        await asyncio.gather(*[worker(n) for n in range(concurrency)])
+    return latencies, counters
+
+
+async def run_websockets(url, clients, connect_parallel, warmup, duration):
+    """Opens `clients` WebSocket connections subscribed to newHeads and measures how long
+    heads take to reach them from the mock upstream."""
+    latencies = []
+    counters = {"requests": 0, "errors": 0, "bytes": 0, "connected": 0}
+    semaphore = asyncio.Semaphore(connect_parallel)
+    start = time.monotonic()
+    measure_from = start + warmup
+    deadline = measure_from + duration
+
+    async def client(n):
+        try:
+            async with semaphore:
+                ws = await websockets.connect(url, max_size=None, open_timeout=30)
+                await ws.send(json.dumps(call("eth_subscribe", ["newHeads"], n)))
+                await asyncio.wait_for(ws.recv(), 30)
+                counters["connected"] += 1
+        except Exception:
+            counters["errors"] += 1
+            return
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    message = await asyncio.wait_for(ws.recv(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                received = time.time()
+                if time.monotonic() < measure_from:
+                    continue
+                head = json.loads(message).get("params", {}).get("result", {})
+                if "mockSentAt" in head:
+                    latencies.append(received - head["mockSentAt"])
+                counters["requests"] += 1
+                counters["bytes"] += len(message)
+        except websockets.ConnectionClosed:
+            counters["errors"] += 1
+        finally:
+            await ws.close()
+
+    await asyncio.gather(*[client(n) for n in range(clients)])
+    return latencies, counters
+
+
+class Bench:
+    def __init__(self, args) -> None:
+        self.args = args
+        self.mock_port = free_port()
+        self.proxy_port = args.proxy_port or free_port()
+        self.processes = []
+        os.makedirs(RESULTS_PATH, exist_ok=True)
+        self.log = open(f"{RESULTS_PATH}/processes.log", "w")
+
+    def start_mock(self):
+        args = self.args
+        command = [
+            sys.executable,
+            f"{BENCH_PATH}/mock_upstream.py",
+            f"--port={self.mock_port}",
+            f"--latency={args.latency}",
+            f"--error-rate={args.error_rate}",
+            f"--block-time={args.block_time}",
+            f"--logs-per-block={args.logs_per_block}",
+            f"--log-size={args.log_size}",
+        ]
+        self.processes.append(
+            subprocess.Popen(command, stdout=self.log, stderr=self.log)
+        )
+
+    def get_proxy_env(self):
+        env = dict(os.environ)
+        urls = {
+            "RPC": f"http://127.0.0.1:{self.mock_port}/",
+            "WSS": f"ws://127.0.0.1:{self.mock_port}/",
+        }
+        # Every upstream the proxy would load from .env points at the mock instead,
+        # so a benchmark can never reach the live service
+        for key in set(dotenv_values(f"{ROOT_PATH}/.env")) | set(env):
+            match = UPSTREAM_KEY.match(key)
+            if match is not None:
+                env[key] = urls[match.group(1)]
+        env.update(
+            {
+                "ETH_RPC_URL": urls["RPC"],
+                "ETH_WSS_URL": urls["WSS"],
+                "FASTAPI_PORT": str(self.proxy_port),
+                "WORKERS": str(self.args.workers),
+                "SHARED_SOCKET": f"/tmp/blockpi-proxy-bench-{self.proxy_port}.sock",
+                "STORE_ENABLED": "False",
+            }
+        )
+        env.update(dict(i.split("=", 1) for i in self.args.env))
+        return env
+
+    def start_proxy(self):
+        self.proxy = subprocess.Popen(
+            [sys.executable, "main.py"],
+            cwd=ROOT_PATH,
+            env=self.get_proxy_env(),
+            stdout=self.log,
+            stderr=self.log,
+        )
+        self.processes.append(self.proxy)
+
+    async def wait_ready(self, url, timeout=30):
+        deadline = time.monotonic() + timeout
+        async with httpx.AsyncClient() as client:
+            while time.monotonic() < deadline:
+                try:
+                    r = await client.get(url)
+                    if r.status_code < 500:
+                        return r
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(0.2)
+        raise RuntimeError(f"{url} did not come up, see {RESULTS_PATH}/processes.log")
+
+    def stop(self):
+        for process in reversed(self.processes):
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.log.close()
+
+    async def run_scenario(self, name, scenarios):
+        args = self.args
+        sampler = ProcessSampler(self.proxy.pid)
+        cpu_before = os.times()
+        started = time.monotonic()
+        # Resources are sampled from the start, the warmup is short compared to the run
+        sampler.start()
+        if name == "ws":
+            latencies, counters = await run_websockets(
+                f"ws://127.0.0.1:{self.proxy_port}/ws/eth/websocket",
+                args.ws_clients,
+                args.ws_connect_parallel,
+                args.warmup,
+                args.duration,
+            )
+        else:
+            latencies, counters = await run_http(
+                f"http://127.0.0.1:{self.proxy_port}/rpc/eth",
+                getattr(scenarios, name),
+                args.concurrency,
+                args.warmup,
+                args.duration,
+            )
+        resources = await sampler.stop()
+        cpu_after = os.times()
+        elapsed = time.monotonic() - started
+        loadgen_cpu = (cpu_after.user - cpu_before.user) + (
+            cpu_after.system - cpu_before.system
+        )
+        return {
+            **counters,
+            "throughput": round(counters["requests"] / args.duration, 1),
+            "latency_ms": summarize(latencies),
+            "proxy": resources,
+            # Close to 100 means the load generator, not the proxy, is the bottleneck
+            "loadgen_cpu_percent": round(loadgen_cpu / elapsed * 100, 1),
+        }
+
+    async def run(self):
+        self.start_mock()
+        mock_url = f"http://127.0.0.1:{self.mock_port}"
+        await self.wait_ready(f"{mock_url}/stats")
+        self.start_proxy()
+        await self.wait_ready(f"http://127.0.0.1:{self.proxy_port}/api/v1/healthcheck")
+        async with httpx.AsyncClient() as client:
+            height = (await client.get(f"{mock_url}/stats")).json()["height"]
+        scenarios = Scenarios(self.args, height)
+        results = {}
+        for name in self.args.scenarios.split(","):
+            print(f"Running {name} for {self.args.warmup + self.args.duration}s...")
+            results[name] = await self.run_scenario(name, scenarios)
+            print_result(name, results[name])
+        return results
+
+
+def print_result(name, result):
+    latency = result["latency_ms"]
+    proxy = result["proxy"] or {}
+    print(
+        f"  {name}: {result['throughput']} req/s, {result['errors']} errors, "
+        f"p50 {latency.get('p50')} ms, p95 {latency.get('p95')} ms, p99 {latency.get('p99')} ms, "
+        f"proxy cpu {proxy.get('cpu_percent')}%, rss {proxy.get('rss_mb_max')} MB"
+    )
+
+
+def change(old, new):
+    if not old or new is None:
+        return "n/a"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def compare(baseline, results):
+    print(f"Compared to {baseline['started']} ({baseline.get('commit')}):")
+    for name, new in results.items():
+        old = baseline["scenarios"].get(name)
+        if old is None:
+            continue
+        old_cpu = (old["proxy"] or {}).get("cpu_percent")
+        new_cpu = (new["proxy"] or {}).get("cpu_percent")
+        print(
+            f"  {name}: throughput {change(old['throughput'], new['throughput'])}, "
+            f"p50 {change(old['latency_ms'].get('p50'), new['latency_ms'].get('p50'))}, "
+            f"p99 {change(old['latency_ms'].get('p99'), new['latency_ms'].get('p99'))}, "
+            f"cpu {change(old_cpu, new_cpu)}"
+        )
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_PATH, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scenarios", default="small,cached,logs,batch,ws")
+    parser.add_argument("--duration", type=float, default=20, help="measured seconds")
+    parser.add_argument(
+        "--warmup", type=float, default=3, help="unmeasured seconds first"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=64, help="concurrent HTTP clients"
+    )
+    parser.add_argument("--workers", type=int, default=1, help="proxy worker processes")
+    parser.add_argument("--proxy-port", type=int, default=None)
+    parser.add_argument(
+        "--latency", default="lognormal:20:0.5", help="see mock_upstream.py"
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--block-time", type=float, default=1.0)
+    parser.add_argument(
+        "--logs-range", type=int, default=100, help="blocks per eth_getLogs"
+    )
+    parser.add_argument("--logs-per-block", type=int, default=4)
+    parser.add_argument("--log-size", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--ws-clients", type=int, default=2000)
+    parser.add_argument("--ws-connect-parallel", type=int, default=100)
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        help="extra proxy setting, e.g. CACHE_ENABLED=False",
+    )
+    parser.add_argument(
+        "--output", default=None, help="results file, timestamped by default"
+    )
+    parser.add_argument(
+        "--compare", default=None, help="earlier results file to compare with"
+    )
+    return parser
+
+
+async def main():
+    args = get_parser().parse_args()
+    started = datetime.now(timezone.utc)
+    bench = Bench(args)
+    try:
+        results = await bench.run()
+    finally:
+        bench.stop()
+    output = args.output or f"{RESULTS_PATH}/{started.strftime('%Y%m%d-%H%M%S')}.json"
+    report = {
+        "started": started.isoformat(timespec="seconds"),
+        "commit": get_commit(),
+        "python": sys.version.split()[0],
+        "settings": vars(args),
+        "scenarios": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved results to {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
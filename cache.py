@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+import time
+from collections import OrderedDict
+import jsonrpc
+import timing
+
+
+# Block tags whose meaning moves with the chain head
+VOLATILE_TAGS = {"latest", "pending", "safe", "finalized"}
+
+# Per-method cache policy.
+#   ttl: seconds a result stays fresh, None for immutable results.
+#   volatile_ttl: seconds to keep results pinned to a volatile block tag, 0 to never cache.
+#   tag_index: position of the block parameter, if omitted the call defaults to "latest".
+#   head: results change with every new block, even without a block tag.
+#   mined_ttl: the result is a transaction or receipt. It is not cached while pending,
+#     and kept for `mined_ttl` seconds until its block is FINALITY blocks behind the head.
+# Methods not listed here are never cached.
+CACHE_POLICIES = {
+    "eth_chainId": {"ttl": None},
+    "net_version": {"ttl": None},
+    "web3_clientVersion": {"ttl": 300},
+    "eth_blockNumber": {"ttl": 1, "head": True},
+    "eth_gasPrice": {"ttl": 2, "head": True},
+    "eth_maxPriorityFeePerGas": {"ttl": 2, "head": True},
+    "eth_getBlockByHash": {"ttl": None},
+    "eth_getBlockByNumber": {"ttl": None, "volatile_ttl": 1, "tag_index": 0},
+    "eth_getBlockTransactionCountByNumber": {
+        "ttl": None,
+        "volatile_ttl": 1,
+        "tag_index": 0,
+    },
+    "eth_getTransactionByHash": {"ttl": None, "mined_ttl": 2},
+    "eth_getTransactionReceipt": {"ttl": None, "mined_ttl": 2},
+    "eth_getTransactionByBlockNumberAndIndex": {
+        "ttl": None,
+        "volatile_ttl": 1,
+        "tag_index": 0,
+    },
+    "eth_getCode": {"ttl": None, "volatile_ttl": 2, "tag_index": 1},
+    "eth_getBalance": {"ttl": None, "volatile_ttl": 0, "tag_index": 1},
+    "eth_getTransactionCount": {"ttl": None, "volatile_ttl": 0, "tag_index": 1},
+    "eth_getStorageAt": {"ttl": None, "volatile_ttl": 0, "tag_index": 2},
+    "eth_call": {"ttl": None, "volatile_ttl": 0, "tag_index": 1},
+    "eth_feeHistory": {"ttl": None, "volatile_ttl": 2, "tag_index": 1},
+}
+# Seconds to keep results pinned to a block number less than FINALITY blocks behind the
+# head (or any number while the head is unknown), as a reorg could still replace it
+RECENT_TTL = 2
+
+
+def is_volatile(policy, params):
+    """Returns True if the call depends on a moving block tag."""
+    if not isinstance(params, list):
+        params = [params] if params is not None else []
+    if "tag_index" in policy:
+        if len(params) <= policy["tag_index"]:
+            return True
+        tag = params[policy["tag_index"]]
+        return isinstance(tag, str) and tag in VOLATILE_TAGS
+    return any(isinstance(i, str) and i in VOLATILE_TAGS for i in params)
+
+
+class ResponseCache:
+    """LRU cache of encoded JSON-RPC results, bounded by total bytes."""
+
+    def __init__(self, config, store=None, shared=None) -> None:
+        self.settings = config.CACHE
+        self.enabled = self.settings["ENABLED"]
+        self.max_bytes = self.settings["MAX_BYTES"]
+        self.max_entry_bytes = self.settings["MAX_ENTRY_BYTES"]
+        self.finality = config.STORE["FINALITY"]
+        # Optional persistent tier for immutable results
+        self.store = store if store is not None and store.enabled else None
+        # Optional cache shared with the other worker processes
+        self.shared = shared
+        self.entries = OrderedDict()
+        self.head_keys = {}
+        self.heights = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, network, call):
+        """Returns the (key, ttl) for a call, or (None, None) if it should not be cached."""
+        if not self.enabled or not isinstance(call, dict):
+            return None, None
+        method = call.get("method")
+        if not isinstance(method, str):
+            return None, None
+        policy = CACHE_POLICIES.get(method)
+        if policy is None:
+            return None, None
+        params = call.get("params", [])
+        ttl = policy["ttl"]
+        if is_volatile(policy, params):
+            ttl = policy.get("volatile_ttl", 0)
+        elif ttl is None and "tag_index" in policy:
+            ttl = self.get_block_ttl(network, policy, params)
+        if ttl == 0:
+            return None, None
+        return f"{network}:{jsonrpc.call_key(call)}", ttl
+
+    def get(self, key):
+        return self.get_entry(key)[0]
+
+    def get_entry(self, key):
+        """Returns (value, remaining ttl) for a key, or (None, None) on a miss."""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None, None
+        value, expires = entry
+        ttl = None
+        if expires is not None:
+            ttl = expires - time.monotonic()
+            if ttl < 0:
+                self.delete(key)
+                self.misses += 1
+                return None, None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value, ttl
+
+    async def lookup(self, key):
+        """Like `get`, falling back to the cache shared by other workers and then
+        the persistent tier for immutable results."""
+        with timing.phase("cache"):
+            value = self.get(key)
+            if value is None and self.shared is not None:
+                value, ttl = await self.shared.get(key)
+                if value is not None:
+                    self.set(key, value, ttl, persist=False, share=False)
+                    return value
+            if value is None and self.store is not None:
+                value = await self.store.get(key)
+                if value is not None:
+                    self.set(key, value, persist=False)
+            return value
+
+    def set(self, key, value, ttl=None, persist=None, share=True):
+        """Stores a result. Immutable ones (no ttl) are also written to the persistent
+        tier once final, `persist` overrides that check for keys without a policy.
+        Results that don't depend on the head are offered to the other workers."""
+        size = len(key) + len(value)
+        if size > self.max_entry_bytes:
+            return
+        network, method, _ = key.split(":", 2)
+        # Entries stored directly by other components may have no policy
+        policy = CACHE_POLICIES.get(method, {})
+        if "mined_ttl" in policy:
+            ttl = self.get_mined_ttl(network, policy, value)
+            if ttl == 0:
+                return
+        if key in self.entries:
+            self.delete(key)
+        expires = None if ttl is None else time.monotonic() + ttl
+        self.entries[key] = (value, expires)
+        self.size += size
+        if policy.get("head") or (ttl is not None and policy.get("ttl", ttl) is None):
+            # Pinned to a volatile block tag or a recent block, or mined too recently
+            # to be final.
+            # Without a head tracker for the network they only expire by ttl.
+            if network in self.heights:
+                self.head_keys.setdefault(network, set()).add(key)
+        elif share and self.shared is not None:
+            # Head-dependent entries stay local, as each worker sees new heads at its own time
+            self.shared.set(key, value, ttl)
+        while self.size > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self.delete(oldest)
+        if self.store is not None and ttl is None:
+            if persist is None:
+                persist = self.is_final(network, key, policy)
+            if persist:
+                self.store.put(key, value)
+
+    def get_block_ttl(self, network, policy, params):
+        """Returns the ttl of a result pinned to a block: None if it is addressed by hash
+        or its block is final, RECENT_TTL while a reorg could still replace the block.
+        """
+        try:
+            number = int(params[policy["tag_index"]], 16)
+        except (ValueError, TypeError, IndexError, KeyError):
+            # EIP-1898 block references and "earliest"
+            return None
+        height = self.heights.get(network)
+        if height is not None and number <= height - self.finality:
+            return None
+        return RECENT_TTL
+
+    def get_mined_ttl(self, network, policy, value):
+        """Returns the ttl of a transaction or receipt: None once its block is final,
+        `mined_ttl` while a reorg could still drop it, 0 while it is pending or unknown.
+        """
+        try:
+            block = jsonrpc.loads(value).get("blockNumber")
+            number = int(block, 16)
+        except (ValueError, TypeError, AttributeError):
+            return 0
+        height = self.heights.get(network)
+        if height is not None and number <= height - self.finality:
+            return None
+        return policy["mined_ttl"]
+
+    def is_final(self, network, key, policy):
+        """Returns True if a result can no longer change with a reorg: it is addressed
+        by hash, or by a block number at least FINALITY blocks behind the head."""
+        if not policy:
+            return False
+        if "mined_ttl" in policy:
+            # Only stored without a ttl by `set` once final
+            return True
+        if "tag_index" not in policy:
+            return True
+        try:
+            params = jsonrpc.loads(key.split(":", 2)[2])
+            block = params[policy["tag_index"]]
+        except (ValueError, IndexError, TypeError):
+            return False
+        if isinstance(block, dict):
+            # EIP-1898 block reference by hash
+            return "blockHash" in block
+        height = self.heights.get(network)
+        try:
+            return height is not None and int(block, 16) <= height - self.finality
+        except (TypeError, ValueError):
+            return False
+
+    def set_head(self, network, height):
+        """Records a new head, dropping every entry that depended on the previous one."""
+        self.heights[network] = height
+        self.invalidate_head(network)
+
+    def delete(self, key):
+        value, _ = self.entries.pop(key)
+        self.size -= len(key) + len(value)
+        keys = self.head_keys.get(key.split(":", 1)[0])
+        if keys is not None:
+            keys.discard(key)
+
+    def invalidate_head(self, network):
+        """Drops every entry that depends on the current head of a network."""
+        for key in self.head_keys.pop(network, ()):
+            if key in self.entries:
+                self.delete(key)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0,
+            "head_keys": sum(len(i) for i in self.head_keys.values()),
+        }
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+import os
+import glob
+import time
+import queue
+import random
+import threading
+import jsonrpc
+from logger import logger
+
+
+# Seconds the writer waits for more records before flushing the file
+FLUSH_INTERVAL = 1.0
+
+
+class TrafficCapture:
+    """Records a sample of /rpc requests to rotating JSON lines files, for replay with
+    bench/replay.py. Request handlers only queue the raw request; decoding, truncation
+    and file I/O happen on a writer thread, and records are dropped under backlog."""
+
+    def __init__(self, config) -> None:
+        self.settings = config.CAPTURE
+        self.enabled = self.settings["ENABLED"]
+        self.path = self.settings["PATH"]
+        self.rate = self.settings["SAMPLE_RATE"]
+        self.max_body_bytes = self.settings["MAX_BODY_BYTES"]
+        self.rotate_bytes = self.settings["ROTATE_BYTES"]
+        self.max_files = self.settings["MAX_FILES"]
+        self.records = queue.Queue(maxsize=self.settings["MAX_PENDING"])
+        self.writer = None
+        self.file = None
+        self.written = 0
+        self.dropped = 0
+        self.truncated = 0
+        self.files = 0
+
+    def start(self):
+        if not self.enabled:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        self.writer = threading.Thread(
+            target=self.write_loop, name="capture", daemon=True
+        )
+        self.writer.start()
+        logger.info(f"Capturing {self.rate:.0%} of requests to {self.path}")
+
+    def close(self):
+        """Flushes queued records and stops the writer thread."""
+        if self.writer is None:
+            return
+        self.records.put(None)
+        self.writer.join()
+        self.writer = None
+
+    def record(
+        self, network, path, method, rpc_method, body, query, elapsed, size, status
+    ):
+        """Queues a request if it is sampled. Never blocks."""
+        if self.writer is None or random.random() >= self.rate:
+            return
+        item = (
+            time.time(),
+            network,
+            path,
+            method,
+            rpc_method,
+            body,
+            query,
+            elapsed,
+            size,
+            status,
+        )
+        try:
+            self.records.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def encode(self, item):
+        ts, network, path, method, rpc_method, body, query, elapsed, size, status = item
+        entry = {
+            "ts": round(ts - elapsed, 6),
+            "network": network,
+            "path": path,
+            "http_method": method,
+            "method": rpc_method,
+            "latency_ms": round(elapsed * 1000, 3),
+            "size": size,
+            "status": status,
+        }
+        if query:
+            entry["query"] = query
+        if body is not None:
+            if len(body) > self.max_body_bytes:
+                # Too large to keep whole, the entry is recorded but can't be replayed
+                self.truncated += 1
+                entry["truncated"] = True
+                entry["body"] = body[: self.max_body_bytes].decode(errors="replace")
+            else:
+                call = jsonrpc.parse_call(body)
+                if isinstance(call, dict):
+                    entry["params"] = call.get("params")
+                elif isinstance(call, list):
+                    entry["batch"] = [
+                        {"method": i.get("method"), "params": i.get("params")}
+                        for i in call
+                        if isinstance(i, dict)
+                    ]
+                else:
+                    entry["body"] = body.decode(errors="replace")
+        return jsonrpc.dumps(entry) + b"\n"
+
+    def open(self):
+        if self.file is not None:
+            self.file.close()
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        # Worker processes each write their own files, and may rotate several times a second
+        name = f"capture-{stamp}-{os.getpid()}-{self.files:04d}.jsonl"
+        self.file = open(f"{self.path}/{name}", "ab")
+        self.files += 1
+        names = sorted(glob.glob(f"{self.path}/capture-*.jsonl"), key=os.path.getmtime)
+        for name in names[: max(len(names) - self.max_files, 0)]:
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+    def write_loop(self):
+        while True:
+            try:
+                item = self.records.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                if self.file is not None:
+                    self.file.flush()
+                continue
+            if item is None:
+                break
+            try:
+                if self.file is None or self.file.tell() >= self.rotate_bytes:
+                    self.open()
+                self.file.write(self.encode(item))
+                self.written += 1
+            except (OSError, ValueError, TypeError) as e:
+                logger.warning(f"Traffic capture write failed: {e}")
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "written": self.written,
+            "dropped": self.dropped,
+            "truncated": self.truncated,
+            "files": self.files,
+            "pending": self.records.qsize(),
+        }
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import asyncio
+import struct
+from shared import FOUND, LEADER
+
+
+# HTTP status in front of a result handed to other workers
+STATUS = struct.Struct("!H")
+
+
+class SingleFlight:
+    """Shares one upstream request between identical concurrent callers. Given the
+    shared cache client, flights are also claimed across worker processes."""
+
+    def __init__(self, config, remote=None) -> None:
+        self.enabled = config.COALESCE["ENABLED"]
+        self.remote = remote
+        self.flights = {}
+        self.leaders = 0
+        self.shared = 0
+        self.remote_shared = 0
+
+    async def do(self, key, func):
+        """Awaits `func()`, or the already running flight for `key`.
+        Returns a tuple of (result, shared)."""
+        if not self.enabled:
+            return await func(), False
+        task = self.get(key)
+        if task is not None:
+            return await asyncio.shield(task), True
+        if self.remote is None:
+            return await asyncio.shield(self.start(key, func())), False
+        remote = False
+
+        async def flight():
+            nonlocal remote
+            status, value = await self.remote.claim(key)
+            if status == FOUND:
+                remote = True
+                self.remote_shared += 1
+                return STATUS.unpack_from(value)[0], value[STATUS.size :]
+            if status != LEADER:
+                # The hub is unreachable or the other worker's request failed
+                return await func()
+            try:
+                result = await func()
+            except BaseException:
+                self.remote.fail(key)
+                raise
+            if result[0] == 200:
+                self.remote.resolve(key, STATUS.pack(result[0]) + result[1])
+            else:
+                self.remote.fail(key)
+            return result
+
+        result = await asyncio.shield(self.start(key, flight()))
+        return result, remote
+
+    def get(self, key):
+        """Returns the running flight for `key` (counted as shared), or None."""
+        task = self.flights.get(key)
+        if task is not None:
+            self.shared += 1
+        return task
+
+    def start(self, key, coro):
+        """Runs `coro` as the flight for `key` and returns its task."""
+        # Run as a task so a disconnecting leader does not cancel the followers
+        task = asyncio.ensure_future(coro)
+        if self.enabled:
+            self.leaders += 1
+            self.flights[key] = task
+            task.add_done_callback(lambda t: self.done(key, t))
+        return task
+
+    def done(self, key, task):
+        if self.flights.get(key) is task:
+            del self.flights[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved when no caller is left to await it
+            task.exception()
+
+    def stats(self):
+        total = self.leaders + self.shared
+        return {
+            "in_flight": len(self.flights),
+            "leaders": self.leaders,
+            "shared": self.shared,
+            "shared_remote": self.remote_shared,
+            "shared_ratio": round(self.shared / total, 4) if total else 0,
+        }
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+import zlib
+import asyncio
+from collections import OrderedDict
+from starlette.responses import Response
+import jsonrpc
+
+try:
+    import brotli
+except ImportError:  # optional, br is not offered without it
+    brotli = None
+try:
+    import zstandard
+except ImportError:  # optional, zstd is not offered without it
+    zstandard = None
+
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+# Bodies and chunks at least this large are compressed off the event loop
+THREAD_BYTES = 256 * 1024
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+# Upstream encodings httpx can undo when a client doesn't accept them
+DECODABLE = {"gzip", "deflate", "br"} if brotli is not None else {"gzip", "deflate"}
+
+
+class ResultResponse(Response):
+    """A JSON-RPC reply around a cached result. The compressor keeps the compressed
+    result per cache key, so hot entries aren't compressed again on every hit."""
+
+    media_type = "application/json"
+
+    def __init__(self, key, id, result, headers=None) -> None:
+        self.key = key
+        self.id = id
+        self.result = result
+        super().__init__(jsonrpc.result_body(id, result), headers=headers)
+
+
+def parse_accept_encoding(header):
+    """Returns {encoding: q} for an Accept-Encoding header."""
+    accepted = {}
+    for part in header.lower().split(","):
+        name, _, params = part.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name.strip():
+            accepted[name.strip()] = q
+    return accepted
+
+
+class Compressor:
+    """Negotiates gzip, br or zstd with clients and compresses /rpc responses above
+    MIN_BYTES, streaming ones chunk by chunk. Replies already compressed by the upstream
+    are relayed as they are, unless the client can't decode them."""
+
+    def __init__(self, config) -> None:
+        settings = config.COMPRESSION
+        self.enabled = settings["ENABLED"]
+        self.min_bytes = settings["MIN_BYTES"]
+        self.gzip_level = settings["GZIP_LEVEL"]
+        self.brotli_quality = settings["BROTLI_QUALITY"]
+        self.zstd_level = settings["ZSTD_LEVEL"]
+        self.max_prefix_bytes = settings["PREFIX_CACHE_BYTES"]
+        # Strongest first, for bodies compressed once
+        self.encodings = [
+            i
+            for i, available in (("zstd", zstandard), ("br", brotli), ("gzip", True))
+            if available is not None
+        ]
+        # Cache key -> (result, compressed prefix, compressor state after it)
+        self.prefixes = OrderedDict()
+        self.prefix_bytes = 0
+        self.compressed = {i: 0 for i in self.encodings}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.prefix_hits = 0
+        self.decoded = 0
+
+    def negotiate(self, header, encodings=None):
+        """Returns the preferred encoding the client accepts, or None."""
+        accepted = parse_accept_encoding(header)
+        for encoding in encodings or self.encodings:
+            if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+                return encoding
+        return None
+
+    def accepts(self, header, encoding):
+        accepted = parse_accept_encoding(header)
+        if encoding == "identity":
+            return accepted.get("identity", 1.0) > 0
+        return accepted.get(encoding, accepted.get("*", 0.0)) > 0
+
+    def get_encoder(self, encoding):
+        """Returns (compress, flush) functions of a new streaming compressor."""
+        if encoding == "zstd":
+            c = zstandard.ZstdCompressor(level=self.zstd_level).compressobj()
+            return c.compress, c.flush
+        if encoding == "br":
+            c = brotli.Compressor(quality=self.brotli_quality)
+            return c.process, c.finish
+        c = zlib.compressobj(self.gzip_level, zlib.DEFLATED, GZIP_WBITS)
+        return c.compress, c.flush
+
+    def compress_body(self, body, encoding):
+        compress, flush = self.get_encoder(encoding)
+        return compress(body) + flush()
+
+    def build_prefix(self, result):
+        c = zlib.compressobj(self.gzip_level, zlib.DEFLATED, GZIP_WBITS)
+        prefix = (
+            c.compress(jsonrpc.RESULT_PREFIX)
+            + c.compress(result)
+            + c.flush(zlib.Z_SYNC_FLUSH)
+        )
+        return result, prefix, c
+
+    async def compress_result(self, key, id, result):
+        """Gzips a ResultResponse body. The result comes before the id in the body, so
+        the compressed prefix is kept and only the id is compressed per request."""
+        entry = self.prefixes.get(key)
+        if entry is not None and entry[0] is result:
+            self.prefixes.move_to_end(key)
+            self.prefix_hits += 1
+        else:
+            if len(result) >= THREAD_BYTES:
+                entry = await asyncio.to_thread(self.build_prefix, result)
+            else:
+                entry = self.build_prefix(result)
+            self.add_prefix(key, entry)
+        _, prefix, c = entry
+        # The kept state is copied, so it can continue any number of bodies
+        c = c.copy()
+        return prefix + c.compress(jsonrpc.result_suffix(id)) + c.flush()
+
+    def add_prefix(self, key, entry):
+        old = self.prefixes.pop(key, None)
+        if old is not None:
+            self.prefix_bytes -= len(old[1])
+        if len(entry[1]) > self.max_prefix_bytes:
+            return
+        self.prefixes[key] = entry
+        self.prefix_bytes += len(entry[1])
+        while self.prefix_bytes > self.max_prefix_bytes:
+            _, (_, prefix, _) = self.prefixes.popitem(last=False)
+            self.prefix_bytes -= len(prefix)
+
+    async def compress_stream(self, iterator, encoding):
+        compress, flush = self.get_encoder(encoding)
+        async for chunk in iterator:
+            self.bytes_in += len(chunk)
+            if len(chunk) >= THREAD_BYTES:
+                chunk = await asyncio.to_thread(compress, chunk)
+            else:
+                chunk = compress(chunk)
+            if chunk:
+                self.bytes_out += len(chunk)
+                yield chunk
+        chunk = flush()
+        self.bytes_out += len(chunk)
+        yield chunk
+
+    def is_compressible(self, resp):
+        if "content-encoding" in resp.headers:
+            return False
+        content_type = resp.headers.get("content-type", "")
+        return content_type.startswith(COMPRESSIBLE_TYPES)
+
+    async def compress(self, request, resp):
+        """Returns the response compressed for the client, when that is worth it."""
+        if not self.enabled or not self.is_compressible(resp):
+            return resp
+        resp.headers["vary"] = "Accept-Encoding"
+        header = request.headers.get("accept-encoding", "")
+        length = resp.headers.get("content-length")
+        if length is not None and int(length) < self.min_bytes:
+            return resp
+        if not hasattr(resp, "body"):
+            # Streamed, its length is usually unknown
+            encoding = self.negotiate(header)
+            if encoding is None:
+                return resp
+            self.compressed[encoding] += 1
+            resp.body_iterator = self.compress_stream(resp.body_iterator, encoding)
+            del resp.headers["content-length"]
+            resp.headers["content-encoding"] = encoding
+            return resp
+        if isinstance(resp, ResultResponse) and self.negotiate(header, ["gzip"]):
+            encoding = "gzip"
+            body = await self.compress_result(resp.key, resp.id, resp.result)
+        else:
+            encoding = self.negotiate(header)
+            if encoding is None:
+                return resp
+            if len(resp.body) >= THREAD_BYTES:
+                body = await asyncio.to_thread(self.compress_body, resp.body, encoding)
+            else:
+                body = self.compress_body(resp.body, encoding)
+        self.compressed[encoding] += 1
+        self.bytes_in += len(resp.body)
+        self.bytes_out += len(body)
+        resp.body = body
+        resp.headers["content-length"] = str(len(body))
+        resp.headers["content-encoding"] = encoding
+        return resp
+
+    def decode_passthrough(self, request, r):
+        """Returns True if an upstream reply is in an encoding the client didn't accept
+        and must be relayed decoded."""
+        encoding = r.headers.get("content-encoding")
+        if encoding is None or encoding not in DECODABLE:
+            return False
+        if self.accepts(request.headers.get("accept-encoding", "identity"), encoding):
+            return False
+        self.decoded += 1
+        return True
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "encodings": self.encodings,
+            "compressed": self.compressed,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "ratio": round(self.bytes_out / self.bytes_in, 4) if self.bytes_in else 0,
+            "prefix_hits": self.prefix_hits,
+            "prefix_bytes": self.prefix_bytes,
+            "decoded_upstream": self.decoded,
+        }
@@ -1,4 +1,5 @@
 import os
+import re
 from dotenv import load_dotenv
 import json_utils
 
@@ -30,12 +31,115 @@ class ConfigFastAPI:
         if os.getenv("CORS_ORIGINS"):
             self.FASTAPI.update({"CORS_ORIGINS": os.getenv("CORS_ORIGINS").split(" ")})
 
+        # Upstream HTTP client pool settings
+        self.UPSTREAM = {
+            "HTTP2": os.getenv("UPSTREAM_HTTP2") == "True",
+            "MAX_CONNECTIONS": self.int_or_none(os.getenv("UPSTREAM_MAX_CONNECTIONS"))
+            or 100,
+            "MAX_KEEPALIVE": self.int_or_none(os.getenv("UPSTREAM_MAX_KEEPALIVE"))
+            or 20,
+            "KEEPALIVE_EXPIRY": self.float_or_none(
+                os.getenv("UPSTREAM_KEEPALIVE_EXPIRY")
+            )
+            or 30.0,
+            "CONNECT_TIMEOUT": self.float_or_none(os.getenv("UPSTREAM_CONNECT_TIMEOUT"))
+            or 5.0,
+            "READ_TIMEOUT": self.float_or_none(os.getenv("UPSTREAM_READ_TIMEOUT"))
+            or 30.0,
+        }
+
+        # In-memory JSON-RPC response cache
+        self.CACHE = {
+            "ENABLED": os.getenv("CACHE_ENABLED", "True") == "True",
+            "MAX_BYTES": (self.int_or_none(os.getenv("CACHE_MAX_MB")) or 64) * 1024**2,
+            "MAX_ENTRY_BYTES": (
+                self.int_or_none(os.getenv("CACHE_MAX_ENTRY_KB")) or 4096
+            )
+            * 1024,
+        }
+
+        # HTTP caching of the GET /rpc/{network}/{path} route, kept in the response cache
+        self.REST_CACHE = {
+            "ENABLED": os.getenv("REST_CACHE_ENABLED", "True") == "True",
+            # Seconds an expired reply is still served while it is refreshed in the background
+            "STALE_SECONDS": self.int_or_none(os.getenv("REST_CACHE_STALE_SECONDS"))
+            or 30,
+        }
+
+        # Persistent SQLite tier for immutable results, kept across restarts
+        self.STORE = {
+            "ENABLED": os.getenv("STORE_ENABLED") == "True",
+            "PATH": os.getenv("STORE_PATH") or f"{script_path}/cache/rpc.sqlite",
+            "MAX_BYTES": (self.int_or_none(os.getenv("STORE_MAX_MB")) or 2048)
+            * 1024**2,
+            "COMPRESSION_LEVEL": self.int_or_none(
+                os.getenv("STORE_COMPRESSION_LEVEL"), 6
+            ),
+            # Threads serving reads, writes always go through a single thread
+            "READERS": self.int_or_none(os.getenv("STORE_READERS")) or 4,
+            # Queued writes beyond this are dropped rather than blocking requests
+            "MAX_PENDING": self.int_or_none(os.getenv("STORE_MAX_PENDING")) or 10000,
+            # Blocks behind the head before results for a block number are stored
+            "FINALITY": self.int_or_none(os.getenv("STORE_FINALITY")) or 64,
+        }
+
+        # Cache and in-flight requests shared by uvicorn workers through a helper process
+        workers = self.int_or_none(os.getenv("WORKERS")) or 1
+        self.SHARED = {
+            "WORKERS": workers,
+            "ENABLED": workers > 1,
+            "SOCKET": os.getenv("SHARED_SOCKET") or "/tmp/blockpi-proxy-cache.sock",
+            # Longest a worker waits on a request another worker is running
+            "TIMEOUT": self.UPSTREAM["CONNECT_TIMEOUT"] + self.UPSTREAM["READ_TIMEOUT"],
+        }
+
+        # Accept-Encoding negotiation for /rpc responses, br and zstd need `brotli` / `zstandard`
+        self.COMPRESSION = {
+            "ENABLED": os.getenv("COMPRESSION_ENABLED", "True") == "True",
+            # Smaller responses are sent as they are
+            "MIN_BYTES": self.int_or_none(os.getenv("COMPRESSION_MIN_BYTES")) or 1024,
+            "GZIP_LEVEL": self.int_or_none(os.getenv("COMPRESSION_GZIP_LEVEL")) or 5,
+            "BROTLI_QUALITY": self.int_or_none(os.getenv("COMPRESSION_BROTLI_QUALITY"))
+            or 4,
+            "ZSTD_LEVEL": self.int_or_none(os.getenv("COMPRESSION_ZSTD_LEVEL")) or 3,
+            # Compressed cache hits kept so they aren't compressed again
+            "PREFIX_CACHE_BYTES": (
+                self.int_or_none(os.getenv("COMPRESSION_CACHE_MB")) or 32
+            )
+            * 1024**2,
+        }
+
+        # Sharing of identical in-flight upstream requests
+        self.COALESCE = {
+            "ENABLED": os.getenv("COALESCE_ENABLED", "True") == "True",
+        }
+
+        # JSON-RPC batch limits
+        self.BATCH = {
+            "MAX_SIZE": self.int_or_none(os.getenv("BATCH_MAX_SIZE")) or 100,
+            "UPSTREAM_SIZE": self.int_or_none(os.getenv("BATCH_UPSTREAM_SIZE")) or 20,
+        }
+
+        # Opt-in micro-batching of single calls, per network (space separated)
+        self.MICROBATCH = {
+            "NETWORKS": set(os.getenv("MICROBATCH_NETWORKS", "").lower().split()),
+            "WINDOW_MS": self.float_or_none(os.getenv("MICROBATCH_WINDOW_MS"), 3.0),
+            "MAX_SIZE": self.int_or_none(os.getenv("MICROBATCH_MAX_SIZE")) or 20,
+        }
+
         self.API_KEYS = {}
         self.API_SECRETS = {}
         self.API_URLS = {}
-        for k, v in os.environ.items():
+        # All upstreams per network, e.g. ETH_RPC_URL, ETH_RPC_URL_2, ... with
+        # optional relative weights from ETH_RPC_WEIGHT, ETH_RPC_WEIGHT_2, ...
+        self.UPSTREAM_URLS = {}
+        for k, v in sorted(os.environ.items()):
             self.API_KEYS.update({k.replace("_APIKEY", ""): v})
             self.API_SECRETS.update({k.replace("_SECRET", ""): v})
+            index = 1
+            if re.search(r"_URL_\d+$", k):
+                k, index = k.rsplit("_", 1)
+                index = int(index)
             if k.endswith("_URL"):
                 if v.endswith("/"):
                     v = v[:-1]
@@ -43,17 +147,208 @@ class ConfigFastAPI:
                 proto = k.split("_")[1].lower()
                 if network not in self.API_URLS:
                     self.API_URLS.update({network.lower(): {"rpc": None, "wss": None}})
-                if proto == "rpc":
-                    self.API_URLS[network]["rpc"] = v
-                if proto == "wss":
-                    self.API_URLS[network]["wss"] = v
+                    self.UPSTREAM_URLS.update({network: {"rpc": [], "wss": []}})
+                if proto not in ["rpc", "wss"]:
+                    continue
+                suffix = "" if index == 1 else f"_{index}"
+                weight = os.getenv(f"{network.upper()}_{proto.upper()}_WEIGHT{suffix}")
+                self.UPSTREAM_URLS[network][proto].append(
+                    {
+                        "url": v,
+                        "weight": self.float_or_none(weight) or 1.0,
+                        "index": index,
+                    }
+                )
+                self.UPSTREAM_URLS[network][proto].sort(key=lambda i: i["index"])
+                # The lowest numbered upstream stays the primary one
+                self.API_URLS[network][proto] = self.UPSTREAM_URLS[network][proto][0][
+                    "url"
+                ]
+
+        # Upstream load balancing
+        self.BALANCER = {
+            # Smoothing factor for the response time moving average
+            "EWMA_ALPHA": self.float_or_none(os.getenv("BALANCER_EWMA_ALPHA"))
+            or 0.3,
+        }
+
+        # Log output
+        self.LOGGING = {
+            # "text" for coloured console lines, "json" for compact JSON lines
+            "FORMAT": os.getenv("LOG_FORMAT") or "text",
+            # Write log records from a background thread instead of the event loop
+            "QUEUE": os.getenv("LOG_QUEUE", "True") == "True",
+            # Share of requests whose payload is logged, and the bytes kept of each
+            "PAYLOAD_SAMPLE_RATE": self.float_or_none(
+                os.getenv("LOG_PAYLOAD_SAMPLE_RATE")
+            )
+            or 0.0,
+            "PAYLOAD_MAX_BYTES": self.int_or_none(os.getenv("LOG_PAYLOAD_MAX_BYTES"))
+            or 512,
+        }
+
+        # Sampled capture of /rpc traffic to JSON lines files, for bench/replay.py
+        self.CAPTURE = {
+            "ENABLED": os.getenv("CAPTURE_ENABLED") == "True",
+            "PATH": os.getenv("CAPTURE_PATH") or f"{script_path}/captures",
+            "SAMPLE_RATE": self.float_or_none(os.getenv("CAPTURE_SAMPLE_RATE"), 0.1),
+            # Larger request bodies are truncated, and skipped on replay
+            "MAX_BODY_BYTES": (self.int_or_none(os.getenv("CAPTURE_MAX_BODY_KB")) or 64)
+            * 1024,
+            "ROTATE_BYTES": (self.int_or_none(os.getenv("CAPTURE_ROTATE_MB")) or 64)
+            * 1024**2,
+            "MAX_FILES": self.int_or_none(os.getenv("CAPTURE_MAX_FILES")) or 20,
+            # Queued records beyond this are dropped rather than blocking requests
+            "MAX_PENDING": self.int_or_none(os.getenv("CAPTURE_MAX_PENDING")) or 10000,
+        }
+
+        # Prometheus metrics served on /metrics
+        self.METRICS = {
+            "ENABLED": os.getenv("METRICS_ENABLED", "True") == "True",
+            # Seconds between event loop lag measurements
+            "LAG_INTERVAL": self.float_or_none(os.getenv("METRICS_LAG_INTERVAL"))
+            or 0.5,
+        }
+
+        # Per-request phase timings of the /rpc routes
+        self.TIMING = {
+            "SERVER_TIMING": os.getenv("SERVER_TIMING", "True") == "True",
+            # Requests slower than this are logged with their phase timings
+            "SLOW_REQUEST_MS": self.float_or_none(os.getenv("SLOW_REQUEST_MS"))
+            or 1000.0,
+        }
+
+        # Sampling profiler behind /api/v1/profile, disabled unless a token is set
+        self.PROFILER = {
+            "TOKEN": os.getenv("PROFILER_TOKEN") or None,
+            "INTERVAL_MS": self.float_or_none(os.getenv("PROFILER_INTERVAL_MS")) or 5.0,
+            "MAX_SECONDS": self.float_or_none(os.getenv("PROFILER_MAX_SECONDS"))
+            or 60.0,
+        }
+
+        # Per-client rate limits on the /rpc routes, charged in request units
+        self.RATELIMIT = {
+            "ENABLED": os.getenv("RATELIMIT_ENABLED") == "True",
+            # "ip", "header:<name>" or "query:<name>"
+            "KEY": os.getenv("RATELIMIT_KEY") or "ip",
+            "RATE": self.float_or_none(os.getenv("RATELIMIT_RATE")) or 50.0,
+            "BURST": self.float_or_none(os.getenv("RATELIMIT_BURST")) or 100.0,
+            "MAX_CLIENTS": self.int_or_none(os.getenv("RATELIMIT_MAX_CLIENTS"))
+            or 10000,
+        }
+
+        # Upstream request unit budget of each network. RU_PER_SEC and BURST are the quota
+        # of one upstream endpoint, a network's budget is that times its endpoint count.
+        self.BUDGET = {
+            # 0 disables the budget scheduler
+            "RU_PER_SEC": self.float_or_none(os.getenv("BUDGET_RU_PER_SEC")) or 0.0,
+            "BURST": self.float_or_none(os.getenv("BUDGET_BURST")) or 100.0,
+            # Share of the burst that normal calls leave for high priority ones, doubled for bulk
+            "RESERVE": self.float_or_none(os.getenv("BUDGET_RESERVE"), 0.2),
+            # Seconds a call may queue for budget before it is rejected
+            "MAX_WAIT": self.float_or_none(os.getenv("BUDGET_MAX_WAIT")) or 5.0,
+            # Request unit overrides, e.g. "eth_getLogs=10 debug_=20"
+            "UNITS": self.get_request_units(os.getenv("RU_WEIGHTS")),
+        }
+
+        # Splitting of wide eth_getLogs ranges into parallel chunk requests
+        self.LOGS = {
+            "ENABLED": os.getenv("LOGS_SPLIT_ENABLED", "True") == "True",
+            # Blocks per chunk, chunks are aligned to multiples of this
+            "CHUNK_SIZE": self.int_or_none(os.getenv("LOGS_CHUNK_SIZE")) or 2000,
+            # Smallest chunk a rejected range is halved down to
+            "MIN_CHUNK": self.int_or_none(os.getenv("LOGS_MIN_CHUNK")) or 100,
+            "MAX_PARALLEL": self.int_or_none(os.getenv("LOGS_MAX_PARALLEL")) or 4,
+            # Wider ranges are passed through for the upstream to reject
+            "MAX_BLOCKS": self.int_or_none(os.getenv("LOGS_MAX_BLOCKS")) or 1000000,
+            # Blocks behind the head after which a chunk is cached as final
+            "FINALITY": self.int_or_none(os.getenv("LOGS_FINALITY")) or 64,
+        }
+
+        # Per-upstream circuit breaker
+        self.BREAKER = {
+            "ENABLED": os.getenv("BREAKER_ENABLED", "True") == "True",
+            # Share of failed requests among the last WINDOW that opens the circuit
+            "ERROR_RATE": self.float_or_none(os.getenv("BREAKER_ERROR_RATE")) or 0.5,
+            "WINDOW": self.int_or_none(os.getenv("BREAKER_WINDOW")) or 50,
+            "MIN_REQUESTS": self.int_or_none(os.getenv("BREAKER_MIN_REQUESTS")) or 20,
+            # Consecutive failures or timeouts that open the circuit regardless of rate
+            "MAX_FAILURES": self.int_or_none(os.getenv("BREAKER_MAX_FAILURES")) or 5,
+            # Seconds an open circuit waits before letting trial requests through
+            "COOLDOWN": self.float_or_none(os.getenv("BREAKER_COOLDOWN")) or 10.0,
+            "HALF_OPEN_PROBES": self.int_or_none(os.getenv("BREAKER_HALF_OPEN_PROBES"))
+            or 3,
+        }
 
-    def int_or_none(self, value):
-        """Returns an integer or None."""
+        # Background health probes comparing upstream block heights
+        self.HEALTH = {
+            "ENABLED": os.getenv("HEALTH_ENABLED", "True") == "True",
+            "INTERVAL": self.float_or_none(os.getenv("HEALTH_INTERVAL")) or 10.0,
+            "TIMEOUT": self.float_or_none(os.getenv("HEALTH_TIMEOUT")) or 5.0,
+            # Blocks behind the best known head before an upstream leaves rotation
+            "MAX_LAG": self.int_or_none(os.getenv("HEALTH_MAX_LAG")) or 5,
+        }
+
+        # Hedging of slow read-only calls to a second upstream
+        self.HEDGE = {
+            "ENABLED": os.getenv("HEDGE_ENABLED") == "True",
+            "PERCENTILE": self.float_or_none(os.getenv("HEDGE_PERCENTILE")) or 95.0,
+            "MIN_MS": self.float_or_none(os.getenv("HEDGE_MIN_MS"), 50.0),
+            "DEFAULT_MS": self.float_or_none(os.getenv("HEDGE_DEFAULT_MS")) or 500.0,
+            "MIN_SAMPLES": self.int_or_none(os.getenv("HEDGE_MIN_SAMPLES")) or 20,
+        }
+
+        # Chain head tracking over upstream WebSocket subscriptions
+        self.HEADS = {
+            "ENABLED": os.getenv("HEADS_ENABLED", "True") == "True",
+            "TENDERMINT_NETWORKS": set(
+                os.getenv("TENDERMINT_NETWORKS", "atom").lower().split()
+            ),
+            # Seconds without a new head before queries go upstream again
+            "MAX_AGE": self.float_or_none(os.getenv("HEADS_MAX_AGE")) or 30.0,
+        }
+
+        # WebSocket relay settings
+        self.WEBSOCKET = {
+            # Outbound frames buffered per client before the slow-consumer policy applies
+            "QUEUE_SIZE": self.int_or_none(os.getenv("WS_QUEUE_SIZE")) or 256,
+            # One of "drop_oldest", "coalesce" or "disconnect"
+            "SLOW_POLICY": os.getenv("WS_SLOW_POLICY") or "coalesce",
+            # Calls per client answered concurrently through the HTTP path
+            "MAX_INFLIGHT": self.int_or_none(os.getenv("WS_MAX_INFLIGHT")) or 32,
+            # permessage-deflate, negotiated with both clients and upstreams
+            "COMPRESSION": os.getenv("WS_COMPRESSION", "True") == "True",
+            "PING_INTERVAL": self.float_or_none(os.getenv("WS_PING_INTERVAL")) or 20.0,
+            "PING_TIMEOUT": self.float_or_none(os.getenv("WS_PING_TIMEOUT")) or 20.0,
+            "MAX_MESSAGE_BYTES": (
+                self.int_or_none(os.getenv("WS_MAX_MESSAGE_MB")) or 16
+            )
+            * 1024**2,
+        }
+
+    def get_request_units(self, value):
+        """Parses "method_prefix=units" pairs into a dict."""
+        units = {}
+        for pair in (value or "").split():
+            prefix, _, cost = pair.partition("=")
+            cost = self.float_or_none(cost)
+            if prefix and cost is not None:
+                units[prefix] = cost
+        return units
+
+    def int_or_none(self, value, default=None):
+        """Returns an integer, or `default` (None) if the value isn't one."""
         try:
             return int(value)
         except:
-            return None
+            return default
+
+    def float_or_none(self, value, default=None):
+        """Returns a float, or `default` (None) if the value isn't one."""
+        try:
+            return float(value)
+        except:
+            return default
 
     def get_FASTAPI_METADATA(self):
         """Returns the API metadata tags"""
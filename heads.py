@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import asyncio
+import time
+import jsonrpc
+from logger import logger
+
+
+EVM_SUBSCRIBE = {
+    "jsonrpc": "2.0",
+    "id": 1,
+    "method": "eth_subscribe",
+    "params": ["newHeads"],
+}
+TENDERMINT_SUBSCRIBE = {
+    "jsonrpc": "2.0",
+    "id": 1,
+    "method": "subscribe",
+    "params": {"query": "tm.event='NewBlockHeader'"},
+}
+
+
+class HeadTracker:
+    """Follows the chain head of each network over a single upstream WebSocket
+    subscription, so head queries can be answered from memory."""
+
+    def __init__(self, config, upstream, cache) -> None:
+        self.enabled = config.HEADS["ENABLED"]
+        self.tendermint = config.HEADS["TENDERMINT_NETWORKS"]
+        self.max_age = config.HEADS["MAX_AGE"]
+        self.upstream = upstream
+        self.cache = cache
+        self.heads = {}
+        self.tasks = {}
+        self.answered = 0
+
+    def start(self):
+        if not self.enabled:
+            return
+        for network, protos in self.upstream.endpoints.items():
+            if protos["rpc"] and protos["wss"]:
+                self.tasks[network] = asyncio.create_task(self.follow(network))
+        logger.info(f"Following chain heads for {list(self.tasks.keys())}")
+
+    async def stop(self):
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.tasks = {}
+
+    async def follow(self, network):
+        """Keeps a head subscription open, reconnecting with backoff."""
+        delay = 1
+        subscribe = (
+            TENDERMINT_SUBSCRIBE if network in self.tendermint else EVM_SUBSCRIBE
+        )
+        while True:
+            try:
+                async with self.upstream.websocket(network) as ws:
+                    await ws.send(jsonrpc.dumps(subscribe).decode())
+                    delay = 1
+                    async for message in ws:
+                        head = self.parse_head(network, message)
+                        if head is not None:
+                            self.on_head(network, *head)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Head subscription for {network} failed: {e}")
+            # Stop answering locally until the subscription is back
+            self.heads.pop(network, None)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    def parse_head(self, network, message):
+        """Returns (height, block hash) from a head notification, or None. Tendermint
+        headers don't carry their own hash, but its blocks are final once committed."""
+        try:
+            data = jsonrpc.loads(message)
+            if network in self.tendermint:
+                header = data["result"]["data"]["value"]["header"]
+                return int(header["height"]), None
+            block = data["params"]["result"]
+            return int(block["number"], 16), block.get("hash")
+        except (ValueError, TypeError, KeyError, AttributeError):
+            # Subscription confirmations and anything unexpected
+            return None
+
+    def on_head(self, network, height, block_hash=None):
+        head = self.heads.get(network)
+        if head is not None:
+            if height < head["height"]:
+                return
+            # A different block at the same height is a reorg
+            if height == head["height"] and block_hash == head["hash"]:
+                return
+        self.cache.set_head(network, height)
+        self.heads[network] = {
+            "height": height,
+            "hash": block_hash,
+            "updated": time.monotonic(),
+        }
+        asyncio.create_task(self.refresh(network, height, block_hash))
+
+    async def refresh(self, network, height, block_hash=None):
+        """Fetches the head block (or Tendermint status) once per new head."""
+        try:
+            if network in self.tendermint:
+                r = await self.upstream.fetch(network, "GET", "status")
+                key, value = "status", r.content if r.status_code == 200 else None
+            else:
+                call = {
+                    "jsonrpc": "2.0",
+                    "id": 1,
+                    "method": "eth_getBlockByNumber",
+                    "params": [hex(height), False],
+                }
+                r = await self.upstream.fetch(
+                    network,
+                    "POST",
+                    content=jsonrpc.dumps(call),
+                    headers={"content-type": "application/json"},
+                )
+                key, value = "block", jsonrpc.extract_result(r.content)
+                cache_key, ttl = self.cache.get_key(network, call)
+                if value is not None and cache_key is not None:
+                    self.cache.set(cache_key, value, ttl)
+        except Exception as e:
+            logger.warning(f"Head refresh for {network} failed: {e}")
+            return
+        head = self.heads.get(network)
+        if value is None or head is None:
+            return
+        if head["height"] == height and head["hash"] == block_hash:
+            head[key] = value
+
+    def get_head(self, network):
+        head = self.heads.get(network)
+        if head is None or time.monotonic() - head["updated"] > self.max_age:
+            return None
+        return head
+
+    def get_result(self, network, call):
+        """Returns the encoded result for a head query, or None if it can't be answered locally."""
+        head = self.get_head(network)
+        if head is None:
+            return None
+        method = call.get("method")
+        params = call.get("params")
+        if not isinstance(params, list):
+            params = []
+        result = None
+        if method == "eth_blockNumber":
+            result = jsonrpc.dumps(hex(head["height"]))
+        elif method == "eth_getBlockByNumber" and params[:1] == ["latest"]:
+            if len(params) < 2 or params[1] is False:
+                result = head.get("block")
+        if result is not None:
+            self.answered += 1
+        return result
+
+    def get_status(self, network):
+        """Returns the cached Tendermint /status body, or None."""
+        head = self.get_head(network)
+        if head is None or "status" not in head:
+            return None
+        self.answered += 1
+        return head["status"]
+
+    def stats(self):
+        return {
+            "answered": self.answered,
+            "heads": {
+                network: {
+                    "height": head["height"],
+                    "age": round(time.monotonic() - head["updated"], 2),
+                }
+                for network, head in self.heads.items()
+            },
+        }
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+import asyncio
+import time
+from collections import deque
+import jsonrpc
+from logger import logger
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+BLOCK_NUMBER = {"jsonrpc": "2.0", "id": 1, "method": "eth_blockNumber", "params": []}
+
+
+class UpstreamUnavailable(Exception):
+    """Raised when every upstream of a network is out of rotation."""
+
+
+class CircuitBreaker:
+    """Takes an endpoint out of rotation when its recent error rate is too high or
+    it fails several times in a row. After a cooldown a few trial requests are let
+    through one at a time, and the breaker closes again once enough of them succeed."""
+
+    def __init__(self, settings) -> None:
+        self.enabled = settings["ENABLED"]
+        self.error_rate = settings["ERROR_RATE"]
+        self.min_requests = settings["MIN_REQUESTS"]
+        self.max_failures = settings["MAX_FAILURES"]
+        self.cooldown = settings["COOLDOWN"]
+        self.probes = settings["HALF_OPEN_PROBES"]
+        self.outcomes = deque(maxlen=settings["WINDOW"])
+        self.failures = 0
+        self.opened_at = None
+        self.successes = 0
+        self.trial = False
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return CLOSED
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return OPEN
+        return HALF_OPEN
+
+    def available(self):
+        state = self.state
+        return (
+            not self.enabled
+            or state == CLOSED
+            or (state == HALF_OPEN and not self.trial)
+        )
+
+    def begin(self):
+        """Returns True if the request starting now is the half-open trial."""
+        if self.state == HALF_OPEN and not self.trial:
+            self.trial = True
+            return True
+        return False
+
+    def end(self, trial):
+        """Ends a request, `trial` being what its `begin` returned."""
+        if trial:
+            self.trial = False
+
+    def success(self):
+        self.failures = 0
+        state = self.state
+        if state == CLOSED:
+            self.outcomes.append(True)
+        elif state == HALF_OPEN:
+            self.successes += 1
+            if self.successes >= self.probes:
+                self.close()
+
+    def failure(self):
+        self.failures += 1
+        state = self.state
+        if state == HALF_OPEN:
+            self.trip()
+        elif state == CLOSED:
+            self.outcomes.append(False)
+            errors = self.outcomes.count(False)
+            if self.failures >= self.max_failures or (
+                len(self.outcomes) >= self.min_requests
+                and errors / len(self.outcomes) >= self.error_rate
+            ):
+                self.trip()
+
+    def trip(self):
+        self.opened_at = time.monotonic()
+        self.successes = 0
+        self.trips += 1
+
+    def close(self):
+        self.opened_at = None
+        self.outcomes.clear()
+        self.failures = 0
+
+    def stats(self):
+        return {"state": self.state if self.enabled else CLOSED, "trips": self.trips}
+
+
+class HealthChecker:
+    """Polls the block height of every upstream in the background. Endpoints more than
+    MAX_LAG blocks behind the best known head are taken out of rotation, and probe
+    results feed the circuit breakers so a recovered upstream is let back in."""
+
+    def __init__(self, config, upstream, heads) -> None:
+        self.enabled = config.HEALTH["ENABLED"]
+        self.interval = config.HEALTH["INTERVAL"]
+        self.timeout = config.HEALTH["TIMEOUT"]
+        self.max_lag = config.HEALTH["MAX_LAG"]
+        self.tendermint = config.HEADS["TENDERMINT_NETWORKS"]
+        self.upstream = upstream
+        self.heads = heads
+        self.task = None
+        self.probes = 0
+
+    def start(self):
+        if self.enabled:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run(self):
+        while True:
+            await asyncio.gather(
+                *[
+                    self.check(network)
+                    for network, protos in self.upstream.endpoints.items()
+                    if protos["rpc"]
+                ]
+            )
+            await asyncio.sleep(self.interval)
+
+    async def check(self, network):
+        endpoints = self.upstream.endpoints[network]["rpc"]
+        heights = await asyncio.gather(*[self.probe(network, i) for i in endpoints])
+        best = max([i for i in heights if i is not None], default=None)
+        head = self.heads.get_head(network)
+        if head is not None:
+            best = max(best or 0, head["height"])
+        for endpoint, height in zip(endpoints, heights):
+            endpoint.height = height
+            lagging = height is not None and best - height > self.max_lag
+            if lagging and not endpoint.lagging:
+                logger.warning(
+                    f"{endpoint.name} is {best - height} blocks behind, removed"
+                )
+            elif endpoint.lagging and not lagging:
+                logger.info(f"{endpoint.name} caught up, back in rotation")
+            endpoint.lagging = lagging
+
+    async def probe(self, network, endpoint):
+        """Returns the block height reported by an endpoint, or None if it failed."""
+        self.probes += 1
+        try:
+            if network in self.tendermint:
+                r = await asyncio.wait_for(
+                    self.upstream.request(network, "GET", "status", endpoint=endpoint),
+                    self.timeout,
+                )
+                return int(
+                    jsonrpc.loads(r.content)["result"]["sync_info"][
+                        "latest_block_height"
+                    ]
+                )
+            r = await asyncio.wait_for(
+                self.upstream.request(
+                    network,
+                    "POST",
+                    None,
+                    content=jsonrpc.dumps(BLOCK_NUMBER),
+                    headers={"content-type": "application/json"},
+                    endpoint=endpoint,
+                ),
+                self.timeout,
+            )
+            return int(jsonrpc.loads(r.content)["result"], 16)
+        except asyncio.TimeoutError:
+            endpoint.failed()
+        except Exception as e:
+            logger.warning(f"Health probe of {endpoint.name} failed: {e}")
+        return None
+
+    def stats(self):
+        return {"enabled": self.enabled, "probes": self.probes}
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import asyncio
+import time
+from collections import deque
+import jsonrpc
+
+
+# Bound on tracked (network, method) latency series, as methods come from clients
+MAX_SERIES = 512
+
+
+class Hedger:
+    """Sends a duplicate of slow read calls to a second upstream once the first has
+    taken longer than the observed tail latency, and keeps whichever answers first."""
+
+    def __init__(self, config) -> None:
+        self.enabled = config.HEDGE["ENABLED"]
+        self.percentile = config.HEDGE["PERCENTILE"]
+        self.min_delay = config.HEDGE["MIN_MS"] / 1000
+        self.default_delay = config.HEDGE["DEFAULT_MS"] / 1000
+        self.min_samples = config.HEDGE["MIN_SAMPLES"]
+        self.samples = {}
+        self.thresholds = {}
+        self.requests = 0
+        self.hedged = 0
+        self.wins = 0
+
+    def eligible(self, method):
+        return self.enabled and method is not None and jsonrpc.is_read(method)
+
+    def get_series(self, network, method):
+        key = (network, method)
+        if key not in self.samples and len(self.samples) >= MAX_SERIES:
+            key = (network, None)
+        return key
+
+    def threshold(self, key):
+        return self.thresholds.get(key, self.default_delay)
+
+    def observe(self, key, elapsed):
+        samples = self.samples.setdefault(key, deque(maxlen=200))
+        samples.append(elapsed)
+        # Recalculate the percentile periodically rather than on every call
+        if len(samples) >= self.min_samples and len(samples) % 10 == 0:
+            ordered = sorted(samples)
+            value = ordered[int(len(ordered) * self.percentile / 100) - 1]
+            self.thresholds[key] = max(value, self.min_delay)
+
+    async def run(self, network, method, primary, secondary):
+        """Awaits `primary()`, hedging with `secondary()` if it is slower than the threshold."""
+        key = self.get_series(network, method)
+        self.requests += 1
+        start = time.perf_counter()
+        first = asyncio.ensure_future(primary())
+        second = None
+        try:
+            done, _ = await asyncio.wait({first}, timeout=self.threshold(key))
+            if done:
+                self.observe(key, time.perf_counter() - start)
+                return first.result()
+            self.hedged += 1
+            hedge_start = time.perf_counter()
+            second = asyncio.ensure_future(secondary())
+            pending = {first, second}
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.wins += 1
+                            self.observe(key, time.perf_counter() - hedge_start)
+                        else:
+                            self.observe(key, time.perf_counter() - start)
+                        return task.result()
+            # Both attempts failed, surface the original error
+            return first.result()
+        finally:
+            for task in (first, second):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.wins,
+            "hedge_rate": round(self.hedged / self.requests, 4) if self.requests else 0,
+        }
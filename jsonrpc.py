@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+import re
+import json
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib encoder is used without it
+    orjson = None
+
+
+# Members of a single call that can be read from the raw body without decoding it
+METHOD_PATTERN = re.compile(rb'"method"\s*:\s*"([\w.\-/]+)"')
+ID_PATTERN = re.compile(rb'"id"\s*:\s*(-?\d+|"[^"\\]*"|null)\s*[,}]')
+OBJECT_START = re.compile(rb"\s*\{")
+RESULT_PREFIX = b'{"jsonrpc":"2.0","result":'
+# Runs of digits long enough to be an integer beyond 64 bits
+LONG_DIGITS = re.compile(rb"[0-9]{19}")
+LONG_DIGITS_TEXT = re.compile(r"[0-9]{19}")
+
+# Methods with side effects, which must never be shared, retried or hedged. Besides
+# these, anything sending, broadcasting or signing is matched by name in `is_write`.
+WRITE_METHODS = {
+    "eth_subscribe",
+    "eth_unsubscribe",
+    "eth_newFilter",
+    "eth_newBlockFilter",
+    "eth_newPendingTransactionFilter",
+    "eth_uninstallFilter",
+    "eth_getFilterChanges",
+}
+WRITE_PREFIXES = ("eth_send", "broadcast_", "personal_")
+
+# Read-only methods and Tendermint paths that may be hedged to a second upstream,
+# along with every eth_get* method not tied to a filter
+READ_METHODS = {
+    "eth_blockNumber",
+    "eth_call",
+    "eth_chainId",
+    "eth_estimateGas",
+    "eth_feeHistory",
+    "eth_gasPrice",
+    "eth_maxPriorityFeePerGas",
+    "eth_syncing",
+    "net_version",
+    "web3_clientVersion",
+    "abci_info",
+    "abci_query",
+    "block",
+    "block_by_hash",
+    "block_results",
+    "block_search",
+    "blockchain",
+    "commit",
+    "consensus_params",
+    "header",
+    "header_by_hash",
+    "health",
+    "net_info",
+    "num_unconfirmed_txs",
+    "status",
+    "tx",
+    "tx_search",
+    "validators",
+}
+
+# Methods tied to state held by one upstream node, which need a sticky connection
+STATEFUL_PREFIXES = (
+    "eth_newFilter",
+    "eth_newBlockFilter",
+    "eth_newPendingTransactionFilter",
+    "eth_getFilter",
+    "eth_uninstallFilter",
+)
+
+# Methods whose replies can be very large, these keep the zero-copy streaming path
+HEAVY_PREFIXES = ("eth_getLogs", "debug_", "trace_", "block_results")
+
+
+def loads(data):
+    # orjson turns integers wider than 64 bits into floats, anything that may hold one
+    # is left to the exact stdlib decoder
+    long_digits = LONG_DIGITS_TEXT if isinstance(data, str) else LONG_DIGITS
+    if orjson is not None and long_digits.search(data) is None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # The stdlib is more lenient, it accepts NaN and Infinity
+            pass
+    return json.loads(data)
+
+
+def dumps(data, sort_keys=False):
+    """Returns compact JSON as bytes."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+        except TypeError:
+            # Integers wider than 64 bits or keys that are not strings
+            pass
+    return json.dumps(data, sort_keys=sort_keys, separators=(",", ":")).encode()
+
+
+def parse_call(body):
+    """Returns the decoded JSON-RPC payload (a call dict or a batch list), or None."""
+    try:
+        return loads(body)
+    except (ValueError, TypeError):
+        return None
+
+
+def sniff_call(body):
+    """Reads the method and id of a single call from the raw body without decoding it,
+    so large params such as raw transactions are never materialized. Returns a call
+    dict without params, or None if that can't be done reliably."""
+    if not OBJECT_START.match(body):
+        return None
+    # Keys nested in the params could be mistaken for the call's own
+    if body.count(b'"method"') != 1 or body.count(b'"id"') != 1:
+        return None
+    method = METHOD_PATTERN.search(body)
+    id = ID_PATTERN.search(body)
+    if method is None or id is None:
+        return None
+    return {
+        "jsonrpc": "2.0",
+        "id": loads(id.group(1)),
+        "method": method.group(1).decode(),
+    }
+
+
+def canonical_params(params):
+    """Returns a stable string form of the params, for use in cache / flight keys."""
+    return dumps(params, sort_keys=True).decode()
+
+
+def call_key(call):
+    """Returns a key identifying a call by method and params, ignoring its id."""
+    return f"{call.get('method')}:{canonical_params(call.get('params', []))}"
+
+
+def flight_key(network, path, call):
+    """Returns the key under which identical in-flight calls are shared."""
+    return f"{network}/{path or ''}:{call_key(call)}"
+
+
+def is_write(method):
+    method = str(method)
+    return (
+        method in WRITE_METHODS
+        or method.startswith(WRITE_PREFIXES)
+        or "sign" in method.lower()
+    )
+
+
+def is_read(method):
+    """Returns True for calls known to be free of side effects, safe to send twice."""
+    method = str(method).strip("/")
+    if method.startswith("eth_get"):
+        return not (is_write(method) or is_stateful(method))
+    return method in READ_METHODS
+
+
+def is_heavy(method):
+    return str(method).startswith(HEAVY_PREFIXES)
+
+
+def method_name(call):
+    """Returns the method of a call for labelling, "batch" for batches."""
+    if isinstance(call, list):
+        return "batch"
+    if isinstance(call, dict) and isinstance(call.get("method"), str):
+        return call["method"]
+    return "invalid"
+
+
+def is_stateful(method):
+    return str(method).startswith(STATEFUL_PREFIXES)
+
+
+def is_shareable(method):
+    """Returns True if identical concurrent calls of this method may share a reply."""
+    return not (is_write(method) or is_heavy(method))
+
+
+def extract_result(body):
+    """Returns the encoded `result` of a successful response, or None if it errored,
+    was empty or could not be decoded."""
+    try:
+        data = loads(body)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(data, dict) or "error" in data:
+        return None
+    if data.get("result") is None:
+        return None
+    return dumps(data["result"])
+
+
+def with_id(body, id):
+    """Returns the response body with its `id` replaced, or unchanged if not a single call."""
+    # Large replies get the id swapped in place when it can be found unambiguously
+    if OBJECT_START.match(body) and body.count(b'"id"') == 1:
+        match = ID_PATTERN.search(body)
+        if match is not None:
+            return body[: match.start(1)] + dumps(id) + body[match.end(1) :]
+    try:
+        data = loads(body)
+    except (ValueError, TypeError):
+        return body
+    if not isinstance(data, dict) or data.get("id") == id:
+        return body
+    data["id"] = id
+    return dumps(data)
+
+
+def result_suffix(id):
+    return b',"id":' + dumps(id) + b"}"
+
+
+def result_body(id, result):
+    """Builds a response body around an already encoded result. The id goes last, so
+    bodies for the same result share everything up to it."""
+    return RESULT_PREFIX + result + result_suffix(id)
+
+
+def error_body(id, code, message):
+    return dumps(
+        {"jsonrpc": "2.0", "id": id, "error": {"code": code, "message": message}}
+    )
@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
-from datetime import datetime
 from os.path import basename, dirname, abspath
+import time
+import atexit
+import inspect
+import json
+import queue
+import random
 import logging
+import logging.handlers
 import functools
 
 
@@ -53,120 +59,52 @@ class CustomFormatter(logging.Formatter):
     debug = "\x1b[30;1m"
     reset = "\x1b[0m"
 
-    format = (
+    log_format = (
         "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s (%(filename)s:%(lineno)d)"
     )
     datefmt = "%d-%b-%y %H:%M:%S"
 
-    FORMATS = {
-        logging.DEBUG: debug + format + reset,
-        logging.INFO: lightgreen + format + reset,
-        logging.WARNING: red + format + reset,
-        logging.ERROR: lightred + format + reset,
-        logging.CRITICAL: bold_red + format + reset,
-    }
+    # Formatters are built once per level, custom levels register theirs in addLoggingLevel
+    FORMATTERS = {}
+
+    @classmethod
+    def add_level(cls, levelNum, colour):
+        cls.FORMATTERS[levelNum] = logging.Formatter(
+            colour + cls.log_format + cls.reset, datefmt=cls.datefmt
+        )
 
     def format(self, record):
-        if record.levelname == "STOPWATCH":
-            log_fmt = (
-                self.pink
-                + "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s (%(filename)s:%(lineno)d)"
-                + self.reset
-            )
-        elif record.levelname == "PAIR":
-            # Blue for lib class
-            log_fmt = (
-                self.skyblue
-                + "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s (%(filename)s:%(lineno)d)"
-            )
-        elif record.levelname == "DEXRPC":
-            # Blue for lib class
-            log_fmt = (
-                self.iceblue
-                + "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s (%(filename)s:%(lineno)d)"
-                + self.reset
-            )
-        elif record.levelname == "SOURCED":
-            # Blue for lib class
-            log_fmt = (
-                self.blue
-                + "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s (%(filename)s:%(lineno)d)"
-                + self.reset
-            )
-        elif record.levelname == "QUERY":
-            # Yellow for incoming data
-            log_fmt = (
-                self.lightyellow
-                + "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s (%(filename)s:%(lineno)d)"
-                + self.reset
-            )
-        elif record.levelname == "REQUEST":
-            # Yellow for incoming data
-            log_fmt = (
-                self.gold
-                + "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s (%(filename)s:%(lineno)d)"
-                + self.reset
-            )
-        elif record.levelname == "LOOP":
-            # Purple for cache loops
-            log_fmt = (
-                self.purple
-                + "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s (%(filename)s:%(lineno)d)"
-                + self.reset
-            )
-        elif record.levelname == "CALC":
-            # Cyan for data processing
-            log_fmt = (
-                self.lightcyan
-                + "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s (%(filename)s:%(lineno)d)"
-                + self.reset
-            )
-        elif record.levelname == "MERGE":
-            # Cyan for data processing
-            log_fmt = (
-                self.cyan
-                + "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s (%(filename)s:%(lineno)d)"
-                + self.reset
-            )
-        elif record.levelname == "CACHED":
-            # Green for data storage
-            log_fmt = (
-                self.drabgreen
-                + "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s (%(filename)s:%(lineno)d)"
-                + self.reset
-            )
-        elif record.levelname == "SAVED":
-            # Green for data storage
-            log_fmt = (
-                self.mintgreen
-                + "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s (%(filename)s:%(lineno)d)"
-                + self.reset
-            )
-        elif record.levelname == "UPDATED":
-            # Green for data storage
-            log_fmt = (
-                self.lightgreen
-                + "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s (%(filename)s:%(lineno)d)"
-            )
-        elif record.levelname == "MUTED":
-            log_fmt = (
-                self.muted
-                + "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s (%(filename)s:%(lineno)d)"
-                + self.reset
-            )
-        elif record.levelname == "DEBUG":
-            log_fmt = (
-                self.debug
-                + "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s (%(filename)s:%(lineno)d)"
-                + self.reset
-            )
-        else:
-            log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt, datefmt="%d-%b-%y %H:%M:%S")
+        formatter = self.FORMATTERS.get(record.levelno)
+        if formatter is None:
+            formatter = self.FORMATTERS[logging.INFO]
         return formatter.format(record)
 
 
-def addLoggingLevel(levelName, levelNum, methodName=None):
+CustomFormatter.add_level(logging.DEBUG, CustomFormatter.debug)
+CustomFormatter.add_level(logging.INFO, CustomFormatter.lightgreen)
+CustomFormatter.add_level(logging.WARNING, CustomFormatter.red)
+CustomFormatter.add_level(logging.ERROR, CustomFormatter.lightred)
+CustomFormatter.add_level(logging.CRITICAL, CustomFormatter.bold_red)
+
+
+class JsonFormatter(logging.Formatter):
+    """Compact JSON lines, for log shippers rather than terminals."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "file": record.filename,
+            "line": record.lineno,
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"), default=str)
+
+
+def addLoggingLevel(levelName, levelNum, methodName=None, colour=CustomFormatter.white):
     # From https://stackoverflow.com/questions/2183233/
     # how-to-add-a-custom-loglevel-to-pythons-logging-facility/
 
@@ -182,12 +120,15 @@ def addLoggingLevel(levelName, levelNum, methodName=None):
 
     def logForLevel(self, message, *args, **kwargs):
         if self.isEnabledFor(levelNum):
+            # Report the caller's file and line, not this wrapper's
+            kwargs.setdefault("stacklevel", 2)
             self._log(levelNum, message, args, **kwargs)
 
     def logToRoot(message, *args, **kwargs):
         logging.log(levelNum, message, *args, **kwargs)
 
     logging.addLevelName(levelNum, levelName)
+    CustomFormatter.add_level(levelNum, colour)
     setattr(logging, levelName, levelNum)
     setattr(logging.getLoggerClass(), methodName, logForLevel)
     setattr(logging, methodName, logToRoot)
@@ -200,51 +141,97 @@ handler.setFormatter(CustomFormatter())
 logger.addHandler(handler)
 
 
-addLoggingLevel("SOURCED", logging.DEBUG + 14)
+def configure(config):
+    """Applies the LOGGING settings: JSON or coloured output, written from a
+    background thread so a slow stdout never blocks the event loop."""
+    settings = config.LOGGING
+    handler.setFormatter(
+        JsonFormatter() if settings["FORMAT"] == "json" else CustomFormatter()
+    )
+    if not settings["QUEUE"] or isinstance(
+        logger.handlers[0], logging.handlers.QueueHandler
+    ):
+        return
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        records, handler, respect_handler_level=True
+    )
+    logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    listener.start()
+    atexit.register(listener.stop)
+
+
+class PayloadSampler:
+    """Logs a sample of request payloads, truncated, instead of every body."""
+
+    def __init__(self, config) -> None:
+        self.rate = config.LOGGING["PAYLOAD_SAMPLE_RATE"]
+        self.max_bytes = config.LOGGING["PAYLOAD_MAX_BYTES"]
+
+    def log(self, network, path, body=None, params=None):
+        if not self.rate or random.random() >= self.rate:
+            return
+        if not logger.isEnabledFor(logging.CALC):
+            return
+        url = f"{network}/{path or ''}"
+        if params:
+            url += f"?{params}"
+        if body is None:
+            logger.calc(url)
+            return
+        payload = body[: self.max_bytes].decode(errors="replace")
+        more = len(body) - self.max_bytes
+        if more > 0:
+            payload += f"... ({more} more bytes)"
+        logger.calc(f"{url} {payload}")
+
+
+addLoggingLevel("SOURCED", logging.DEBUG + 14, colour=CustomFormatter.blue)
 logger.setLevel("SOURCED")
 
 
-addLoggingLevel("SAVED", logging.DEBUG + 13)
+addLoggingLevel("SAVED", logging.DEBUG + 13, colour=CustomFormatter.mintgreen)
 logger.setLevel("SAVED")
 
 
-addLoggingLevel("CACHED", logging.DEBUG + 12)
+addLoggingLevel("CACHED", logging.DEBUG + 12, colour=CustomFormatter.drabgreen)
 logger.setLevel("CACHED")
 
 
-addLoggingLevel("PAIR", logging.DEBUG + 11)
+addLoggingLevel("PAIR", logging.DEBUG + 11, colour=CustomFormatter.skyblue)
 logger.setLevel("PAIR")
 
 
-addLoggingLevel("MERGE", logging.DEBUG + 9)
+addLoggingLevel("MERGE", logging.DEBUG + 9, colour=CustomFormatter.cyan)
 logger.setLevel("MERGE")
 
 # Shows cache updates
-addLoggingLevel("UPDATED", logging.DEBUG + 8)
+addLoggingLevel("UPDATED", logging.DEBUG + 8, colour=CustomFormatter.lightgreen)
 logger.setLevel("UPDATED")
 
 # Shows database req/resp
-addLoggingLevel("QUERY", logging.DEBUG + 7)
+addLoggingLevel("QUERY", logging.DEBUG + 7, colour=CustomFormatter.lightyellow)
 logger.setLevel("QUERY")
 
 # Shows dex api req/resp
-addLoggingLevel("DEXRPC", logging.DEBUG + 6)
+addLoggingLevel("DEXRPC", logging.DEBUG + 6, colour=CustomFormatter.iceblue)
 logger.setLevel("DEXRPC")
 
 # Shows cache loop updates
-addLoggingLevel("LOOP", logging.DEBUG + 5)
+addLoggingLevel("LOOP", logging.DEBUG + 5, colour=CustomFormatter.purple)
 logger.setLevel("LOOP")
 
 # Shows cache loop updates
-addLoggingLevel("CALC", logging.DEBUG + 4)
+addLoggingLevel("CALC", logging.DEBUG + 4, colour=CustomFormatter.lightcyan)
 logger.setLevel("CALC")
 
 # Shows generally ignorable errors, e.g. CoinConfigNotFound
-addLoggingLevel("MUTED", logging.DEBUG - 1)
+addLoggingLevel("MUTED", logging.DEBUG - 1, colour=CustomFormatter.muted)
 logger.setLevel("MUTED")
 
 # Shows cache loop updates
-addLoggingLevel("REQUEST", logging.DEBUG + 2)
+addLoggingLevel("REQUEST", logging.DEBUG + 2, colour=CustomFormatter.gold)
 logger.setLevel("REQUEST")
 
 
@@ -290,6 +277,7 @@ def send_log(loglevel, msg):
 
 class StopWatch:
     def __init__(self, start_time, trace, loglevel="debug", msg="") -> None:
+        # `start_time` is a time.perf_counter_ns() reading
         self.start_time = start_time
         self.msg = msg
         self.trace = trace
@@ -297,7 +285,7 @@ class StopWatch:
         self.get_stopwatch()
 
     def get_stopwatch(self):
-        duration = int(datetime.utcnow().timestamp()) - int(self.start_time)
+        duration = (time.perf_counter_ns() - self.start_time) / 1e6
         if not isinstance(self.msg, str):
             self.msg = str(self.msg)
         lineno = self.trace["lineno"]
@@ -305,7 +293,7 @@ class StopWatch:
         func = self.trace["function"]
         if PROJECT_ROOT_PATH in self.msg:
             self.msg = self.msg.replace(f"{PROJECT_ROOT_PATH}/", "")
-        self.msg = f"{duration:>2} sec | {func:<20} | {str(self.msg):<80} "
+        self.msg = f"{duration:>9.3f} ms | {func:<20} | {str(self.msg):<80} "
         self.msg += f"| {basename(filename)}:{lineno}"
         send_log(loglevel=self.loglevel, msg=self.msg)
 
@@ -341,49 +329,49 @@ def show_pallete():
     logger.cached("cached")
 
 
-# A decorator for returning runtime of functions
+def log_timed(func, start_time, result=None, error=None):
+    """Logs a `timed` call as its result asks, returning the result to hand back."""
+    trace = get_trace(func)
+    if error is not None:
+        msg = f"{type(error)}: {error}"
+        StopWatch(start_time, trace=trace, loglevel="error", msg=msg)
+        return None
+    if not isinstance(result, dict) or "loglevel" not in result:
+        # if not using `default.result`
+        return result
+    duration = (time.perf_counter_ns() - start_time) / 1e9
+    if duration >= result.get("ignore_until", 0):
+        msg = result.get("message", "")
+        StopWatch(start_time, trace=trace, loglevel=result["loglevel"], msg=msg)
+    # Using `default.result`, with actual data to return
+    if result.get("data") is not None:
+        return result["data"]
+    return result
+
+
+# A decorator for returning runtime of functions, sync or async
 def timed(func):
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start_time = time.perf_counter_ns()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                return log_timed(func, start_time, error=e)
+            return log_timed(func, start_time, result)
+
+        return async_wrapper
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        start_time = int(datetime.utcnow().timestamp())
-        duration = int(datetime.utcnow().timestamp()) - start_time
-        trace = get_trace(func)
-        msg = "<<< no msg provided >>>"
+        start_time = time.perf_counter_ns()
         try:
             result = func(*args, **kwargs)
         except Exception as e:
-            ignore_until = 0
-            loglevel = "error"
-            if isinstance(e, ValueError):
-                # Custom logic here
-                pass
-            msg = f"{type(e)}: {e}"
-            StopWatch(start_time, trace=trace, loglevel=loglevel, msg=msg)
-        else:
-            send = False
-            msg = ""
-            ignore_until = 0
-            loglevel = "info"
-            if isinstance(result, dict):
-                if "loglevel" in result:
-                    loglevel = result["loglevel"]
-                    send = True
-                else:
-                    # if not using `default.result`
-                    return result
-                if "message" in result:
-                    msg = result["message"]
-                    send = True
-                if "ignore_until" in result:
-                    ignore_until = result["ignore_until"]
-                    send = True
-                if duration >= ignore_until and send:
-                    StopWatch(start_time, trace=trace, loglevel=loglevel, msg=msg)
-                # Using `default.result`, with actual data to return
-                if "data" in result:
-                    if result["data"] is not None:
-                        result = result["data"]
-            return result
+            return log_timed(func, start_time, error=e)
+        return log_timed(func, start_time, result)
 
     return wrapper
 
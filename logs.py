@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+import asyncio
+from starlette.responses import Response, StreamingResponse
+import jsonrpc
+from logger import logger
+
+
+# Error message fragments providers use when a range is too wide or returns too much,
+# e.g. "block range is too wide" or "query returned more than 10000 results"
+RANGE_ERROR_HINTS = (
+    "block range",
+    "blocks range",
+    "range is too",
+    "range too",
+    "too wide",
+    "ranges over",
+    "limited to a",
+    "too many blocks",
+    "returned more than",
+    "too many results",
+    "max results",
+    "response size",
+    "response is too big",
+    "response too large",
+)
+# Throttling, which narrower ranges would only make worse by sending more requests
+RATE_LIMIT_HINTS = (
+    "rate limit",
+    "too many requests",
+    "request limit",
+    "quota",
+    "throttl",
+    "capacity",
+)
+
+
+def is_rate_limited(message):
+    message = message.lower()
+    return any(i in message for i in RATE_LIMIT_HINTS)
+
+
+def is_range_error(message):
+    """Returns True if an upstream error suggests retrying with a narrower range."""
+    if is_rate_limited(message):
+        return False
+    message = message.lower()
+    return any(i in message for i in RANGE_ERROR_HINTS)
+
+
+class UpstreamError(Exception):
+    """An error reply from the upstream that splitting the range won't fix."""
+
+    def __init__(self, content) -> None:
+        super().__init__(content[:200])
+        self.content = content
+
+
+class LogSplitter:
+    """Answers wide eth_getLogs ranges by fetching fixed-size block chunks in parallel.
+    Chunks are aligned to CHUNK_SIZE so overlapping queries share them, finalized ones
+    are cached, and results are streamed back in block order as they arrive."""
+
+    def __init__(self, config, upstream, cache, heads) -> None:
+        self.enabled = config.LOGS["ENABLED"]
+        self.chunk_size = config.LOGS["CHUNK_SIZE"]
+        self.min_chunk = config.LOGS["MIN_CHUNK"]
+        self.max_parallel = config.LOGS["MAX_PARALLEL"]
+        self.max_blocks = config.LOGS["MAX_BLOCKS"]
+        self.finality = config.LOGS["FINALITY"]
+        self.upstream = upstream
+        self.cache = cache
+        self.heads = heads
+        self.requests = 0
+        self.chunks = 0
+        self.cached = 0
+        self.splits = 0
+
+    def resolve(self, network, tag):
+        """Returns a block number for a hex number or block tag, or None."""
+        if tag is None or tag == "latest":
+            head = self.heads.get_head(network)
+            return head["height"] if head is not None else None
+        if tag == "earliest":
+            return 0
+        try:
+            return int(tag, 16)
+        except (TypeError, ValueError):
+            return None
+
+    def get_range(self, network, call):
+        """Returns (filter, first, last) if the call is worth splitting, else None."""
+        if not self.enabled or call.get("method") != "eth_getLogs":
+            return None
+        params = call.get("params")
+        if (
+            not isinstance(params, list)
+            or len(params) != 1
+            or not isinstance(params[0], dict)
+        ):
+            return None
+        log_filter = params[0]
+        if "blockHash" in log_filter:
+            return None
+        first = self.resolve(network, log_filter.get("fromBlock"))
+        last = self.resolve(network, log_filter.get("toBlock"))
+        if first is None or last is None:
+            return None
+        if last - first < self.chunk_size or last - first > self.max_blocks:
+            return None
+        return log_filter, first, last
+
+    def get_chunks(self, first, last):
+        """Splits [first, last] on CHUNK_SIZE boundaries."""
+        chunks = []
+        start = first
+        while start <= last:
+            end = min((start // self.chunk_size + 1) * self.chunk_size - 1, last)
+            chunks.append((start, end))
+            start = end + 1
+        return chunks
+
+    async def handle(self, network, path, call):
+        """Returns a streaming response for a splittable eth_getLogs call, or None."""
+        block_range = self.get_range(network, call)
+        if block_range is None:
+            return None
+        log_filter, first, last = block_range
+        self.requests += 1
+        head = self.heads.get_head(network)
+        final = head["height"] - self.finality if head is not None else -1
+        base = {
+            k: v for k, v in log_filter.items() if k not in ("fromBlock", "toBlock")
+        }
+        if isinstance(base.get("address"), str):
+            base["address"] = base["address"].lower()
+        elif isinstance(base.get("address"), list):
+            base["address"] = sorted(
+                i.lower() for i in base["address"] if isinstance(i, str)
+            )
+
+        semaphore = asyncio.Semaphore(self.max_parallel)
+        tasks = []
+        hits = 0
+        chunks = []
+        for start, end in self.get_chunks(first, last):
+            chunk = dict(base, fromBlock=hex(start), toBlock=hex(end))
+            key = f"{network}:{jsonrpc.call_key({'method': 'eth_getLogs', 'params': [chunk]})}"
+            chunks.append((start, end, chunk, key))
+        if self.cache.enabled:
+            cached = await asyncio.gather(*[self.cache.lookup(i[3]) for i in chunks])
+        else:
+            cached = [None] * len(chunks)
+        for (start, end, chunk, key), result in zip(chunks, cached):
+            if result is not None:
+                hits += 1
+                done = asyncio.get_running_loop().create_future()
+                done.set_result(result)
+                tasks.append(done)
+                continue
+            cache_key = key if self.cache.enabled and end <= final else None
+            tasks.append(
+                asyncio.ensure_future(
+                    self.fetch_chunk(
+                        network, path, semaphore, chunk, start, end, cache_key
+                    )
+                )
+            )
+        self.cached += hits
+        # Hold the response until the first chunk succeeds, so errors get a proper status
+        try:
+            first_result = await asyncio.shield(tasks[0])
+        except Exception as e:
+            for task in tasks:
+                task.cancel()
+            if isinstance(e, UpstreamError):
+                return Response(
+                    jsonrpc.with_id(e.content, call.get("id")),
+                    media_type="application/json",
+                )
+            raise
+        if hits == len(tasks):
+            status = "HIT"
+        elif hits == 0:
+            status = "MISS"
+        else:
+            status = "PARTIAL"
+        return StreamingResponse(
+            self.stream(call.get("id"), first_result, tasks),
+            media_type="application/json",
+            headers={"X-Cache": status, "X-Log-Chunks": str(len(tasks))},
+        )
+
+    async def stream(self, id, first_result, tasks):
+        """Yields the merged reply, stripping the brackets of each chunk's array."""
+        try:
+            yield b'{"jsonrpc":"2.0","id":' + jsonrpc.dumps(id) + b',"result":['
+            empty = True
+            for i, task in enumerate(tasks):
+                result = first_result if i == 0 else await task
+                items = result.strip()[1:-1].strip()
+                if items:
+                    if not empty:
+                        yield b","
+                    yield items
+                    empty = False
+            yield b"]}"
+        except Exception as e:
+            # Headers are already sent, all that is left is to cut the response short
+            logger.warning(f"eth_getLogs stream aborted: {e}")
+            raise
+        finally:
+            # The client went away or a chunk failed, stop the remaining fetches
+            for task in tasks:
+                task.cancel()
+
+    async def fetch_chunk(self, network, path, semaphore, chunk, start, end, cache_key):
+        """Fetches one chunk, halving it when the upstream rejects the range.
+        Returns the encoded array of logs."""
+        async with semaphore:
+            self.chunks += 1
+            call = {
+                "jsonrpc": "2.0",
+                "id": 1,
+                "method": "eth_getLogs",
+                "params": [chunk],
+            }
+            r = await self.upstream.fetch(
+                network,
+                "POST",
+                path,
+                content=jsonrpc.dumps(call),
+                headers={"content-type": "application/json"},
+                rpc_method="eth_getLogs",
+            )
+        data = jsonrpc.parse_call(r.content)
+        if isinstance(data, dict) and isinstance(data.get("result"), list):
+            result = jsonrpc.dumps(data["result"])
+            if cache_key is not None:
+                self.cache.set(cache_key, result, persist=True)
+            return result
+        message = str(data.get("error") if isinstance(data, dict) else r.status_code)
+        if r.status_code == 429 or end - start + 1 <= self.min_chunk:
+            raise UpstreamError(r.content)
+        if not is_range_error(message):
+            raise UpstreamError(r.content)
+        # Most providers reject ranges with too many results, retry as two halves
+        self.splits += 1
+        middle = (start + end) // 2
+        left = dict(chunk, toBlock=hex(middle))
+        right = dict(chunk, fromBlock=hex(middle + 1))
+        halves = await asyncio.gather(
+            self.fetch_chunk(network, path, semaphore, left, start, middle, None),
+            self.fetch_chunk(network, path, semaphore, right, middle + 1, end, None),
+        )
+        logger.calc(f"Split eth_getLogs {start}-{end} on {network}")
+        left, right = (i.strip()[1:-1].strip() for i in halves)
+        result = b"[" + b",".join(i for i in (left, right) if i) + b"]"
+        if cache_key is not None:
+            self.cache.set(cache_key, result, persist=True)
+        return result
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "requests": self.requests,
+            "chunks_fetched": self.chunks,
+            "chunks_cached": self.cached,
+            "splits": self.splits,
+        }
@@ -1,28 +1,97 @@
 #!/usr/bin/env python3
 import json
+import math
+import time
+import functools
+import multiprocessing
 from dotenv import load_dotenv
 import asyncio
 import uvicorn
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, APIRouter
+from fastapi import FastAPI, Request, WebSocket, APIRouter
 from starlette.requests import Request
-from starlette.responses import StreamingResponse
+from starlette.responses import Response, StreamingResponse
 from starlette.background import BackgroundTask
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse
 import httpx  # httpx streaming allows for larger files & less memory usage
-import websockets
-from websockets import connect
-from logger import logger
-import requests
+from contextlib import asynccontextmanager
+from logger import logger, PayloadSampler, configure as configure_logging
 
 
 from config import ConfigFastAPI
+from upstream import UpstreamPool
+from cache import ResponseCache
+from store import PersistentStore
+from coalesce import SingleFlight
+from batch import BatchHandler
+from microbatch import MicroBatcher
+from heads import HeadTracker
+from health import HealthChecker, UpstreamUnavailable
+from wsproxy import WebSocketProxy
+from metrics import Metrics
+from ratelimit import ClientLimiter, RateLimited
+from logs import LogSplitter
+from restcache import RestCache
+from capture import TrafficCapture
+from compression import Compressor, ResultResponse
+from shared import SharedCacheClient, run_server as run_shared_cache
+from timing import RequestTiming
+from profiler import SamplingProfiler, ProfilerBusy
+import jsonrpc
+import timing
 
 load_dotenv()
 config = ConfigFastAPI()
-
-
-app = FastAPI(openFASTAPI_TAGS=config.FASTAPI["TAGS"])
+configure_logging(config)
+payloads = PayloadSampler(config)
+metrics = Metrics(config)
+upstream = UpstreamPool(config)
+store = PersistentStore(config)
+shared_cache = SharedCacheClient(config) if config.SHARED["ENABLED"] else None
+cache = ResponseCache(config, store, shared_cache)
+flights = SingleFlight(config, shared_cache)
+heads = HeadTracker(config, upstream, cache)
+health = HealthChecker(config, upstream, heads)
+batches = BatchHandler(config, upstream, cache, flights, heads)
+log_splitter = LogSplitter(config, upstream, cache, heads)
+rest_cache = RestCache(config, upstream, cache, flights)
+limiter = ClientLimiter(config)
+ws_clients = WebSocketProxy(config, upstream, limiter)
+microbatcher = MicroBatcher(config, batches)
+capture = TrafficCapture(config)
+compressor = Compressor(config)
+timings = RequestTiming(config)
+profiler = SamplingProfiler(config)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    upstream.start()
+    store.start()
+    capture.start()
+    heads.start()
+    health.start()
+    metrics.start()
+    if shared_cache is not None:
+        await shared_cache.connect()
+    yield
+    await metrics.stop()
+    await health.stop()
+    await heads.stop()
+    await upstream.close()
+    if shared_cache is not None:
+        await shared_cache.close()
+    await asyncio.to_thread(store.close)
+    await asyncio.to_thread(capture.close)
+
+
+app = FastAPI(
+    openFASTAPI_TAGS=config.FASTAPI["TAGS"],
+    lifespan=lifespan,
+    default_response_class=(
+        ORJSONResponse if jsonrpc.orjson is not None else JSONResponse
+    ),
+)
 router = APIRouter()
 if config.FASTAPI["USE_MIDDLEWARE"]:
     app.add_middleware(
@@ -34,25 +103,240 @@ if config.FASTAPI["USE_MIDDLEWARE"]:
     )
 
 
+async def fetch_upstream(network, path, body=None, params=None, rpc_method=None):
+    """Fetches a full upstream response, returned as (status_code, content)."""
+    if body is None:
+        r = await upstream.fetch(
+            network, "GET", path, params=params, rpc_method=rpc_method or path
+        )
+    else:
+        r = await upstream.fetch(
+            network,
+            "POST",
+            path,
+            content=body,
+            headers={"content-type": "application/json"},
+            rpc_method=rpc_method,
+        )
+    return r.status_code, r.content
+
+
+async def fetch_shared(network, path, body, call):
+    """Fetches a single call upstream, sharing the request with identical concurrent calls.
+    Returns a tuple of (status_code, content, shared)."""
+    batched = microbatcher.enabled_for(network)
+    if batched:
+        fetch = functools.partial(microbatcher.fetch, network, path, call)
+    else:
+        fetch = functools.partial(
+            fetch_upstream, network, path, body, rpc_method=call.get("method")
+        )
+    (status, content), shared = await flights.do(
+        jsonrpc.flight_key(network, path, call), fetch
+    )
+    if shared or batched:
+        content = jsonrpc.with_id(content, call.get("id"))
+    return status, content, shared
+
+
+async def get_cached_resp(network, path, body, call, key, ttl):
+    """Serves a cacheable call from the response cache, fetching it upstream on a miss."""
+    result = await cache.lookup(key)
+    if result is not None:
+        return ResultResponse(key, call.get("id"), result, headers={"X-Cache": "HIT"})
+    status, content, shared = await fetch_shared(network, path, body, call)
+    if status == 200 and not shared:
+        result = jsonrpc.extract_result(content)
+        if result is not None:
+            cache.set(key, result, ttl)
+    return Response(
+        content,
+        status_code=status,
+        media_type="application/json",
+        headers={"X-Cache": "MISS"},
+    )
+
+
+async def get_call_resp(network, path, body, call):
+    """Answers a JSON-RPC call or batch from the head tracker, cache or shared flights.
+    Returns None when the call should be streamed straight through to the upstream."""
+    if isinstance(call, list):
+        return await batches.handle(network, path, call)
+    if not isinstance(call, dict):
+        return None
+    if not isinstance(call.get("method"), str):
+        return error_resp(call, 400, -32600, "Invalid Request")
+    result = heads.get_result(network, call)
+    if result is not None:
+        return Response(
+            jsonrpc.result_body(call.get("id"), result),
+            media_type="application/json",
+            headers={"X-Cache": "HEAD"},
+        )
+    resp = await log_splitter.handle(network, path, call)
+    if resp is not None:
+        return resp
+    key, ttl = cache.get_key(network, call)
+    if key is not None:
+        return await get_cached_resp(network, path, body, call, key, ttl)
+    # Other reads are shared or micro-batched when either is on, else streamed through
+    shared = flights.enabled or microbatcher.enabled_for(network)
+    if shared and jsonrpc.is_shareable(call.get("method")):
+        status, content, _ = await fetch_shared(network, path, body, call)
+        return Response(content, status_code=status, media_type="application/json")
+    return None
+
+
+async def get_ws_call_resp(network, body, call):
+    """Answers a JSON-RPC call sent over a client WebSocket through the HTTP path,
+    returning the reply body."""
+    start = time.perf_counter()
+    resp = await get_call_resp(network, None, body, call)
+    if isinstance(resp, StreamingResponse):
+        content = b"".join([i async for i in resp.body_iterator])
+    elif resp is not None:
+        content = resp.body
+    else:
+        _, content = await fetch_upstream(
+            network, None, body, rpc_method=call.get("method")
+        )
+    metrics.observe_request(
+        network, jsonrpc.method_name(call), time.perf_counter() - start, len(content)
+    )
+    return content
+
+
+ws_clients.call_handler = get_ws_call_resp
+
+
+def error_resp(call, status, code, message, headers=None):
+    """Returns a JSON-RPC error response, echoing the id of a single call."""
+    id = call.get("id") if isinstance(call, dict) else None
+    return Response(
+        jsonrpc.error_body(id, code, message),
+        status_code=status,
+        media_type="application/json",
+        headers=headers,
+    )
+
+
+def rate_limited_resp(call, message, retry_after):
+    return error_resp(
+        call, 429, -32005, message, headers={"Retry-After": str(math.ceil(retry_after))}
+    )
+
+
 async def get_rpc_resp(request, network, path=None):
+    timer = timings.start()
+    resp = await forward_rpc(request, network, path)
+    if isinstance(resp, StreamingResponse):
+        size = resp.headers.get("content-length")
+        size = int(size) if size is not None else None
+    else:
+        size = len(resp.body)
+    with timer.phase("serialize"):
+        resp = await compressor.compress(request, resp)
+    elapsed = timer.elapsed() / 1e9
+    metrics.observe_request(network, request.state.rpc_method, elapsed, size)
+    if capture.enabled:
+        capture.record(
+            network.lower(),
+            path,
+            request.method,
+            request.state.rpc_method,
+            await request.body() if request.method == "POST" else None,
+            request.url.query,
+            elapsed,
+            size,
+            resp.status_code,
+        )
+    return timings.finish(timer, resp, f"{network}/{request.state.rpc_method}")
+
+
+async def forward_rpc(request, network, path=None):
+    call = None
+    # REST paths are labelled by their first segment to keep metric series bounded
+    request.state.rpc_method = (path or "").split("/")[0]
     try:
         network = network.lower()
-        logger.calc(config.API_URLS[network])
-        url = config.API_URLS[network]["rpc"]
-        if path is None and url.endswith("/"):
-            url = url[:-1]
-        if path is not None:
-            url = f"{url}/{path}"
-        logger.calc(url)
+        # Let the client decide on compression, raw upstream bytes are relayed as-is
+        headers = {
+            "accept-encoding": request.headers.get("accept-encoding", "identity")
+        }
         if request.method == "POST":
-            data = await request.json()
-            logger.calc(data)
-            r = requests.post(url, json=data)
+            with timing.phase("read"):
+                body = await request.body()
+            payloads.log(network, path, body)
+            call = jsonrpc.sniff_call(body)
+            if call is None or not jsonrpc.is_write(call["method"]):
+                # Reads need their params decoded for cache keys and local answers
+                call = jsonrpc.parse_call(body)
+            request.state.rpc_method = jsonrpc.method_name(call)
+            retry_after = limiter.check(request, call)
+            if retry_after is not None:
+                return rate_limited_resp(call, "Rate limit exceeded", retry_after)
+            resp = await get_call_resp(network, path, body, call)
+            if resp is not None:
+                return resp
+            headers["content-type"] = "application/json"
+            r = await upstream.send(
+                network, "POST", path, content=body, headers=headers, call=call
+            )
         else:
-            r = requests.get(url)
-        return JSONResponse(r.json())
-    except:
-        logger.warning(r.text)
+            payloads.log(network, path, params=request.query_params)
+            retry_after = limiter.check(request, path)
+            if retry_after is not None:
+                return rate_limited_resp(call, "Rate limit exceeded", retry_after)
+            if path.strip("/") == "status":
+                status = heads.get_status(network)
+                if status is not None:
+                    return Response(
+                        status,
+                        media_type="application/json",
+                        headers={"X-Cache": "HEAD"},
+                    )
+            resp = await rest_cache.respond(request, network, path)
+            if resp is not None:
+                return resp
+            if flights.enabled and not jsonrpc.is_heavy(path):
+                key = f"GET:{network}/{path}?{request.url.query}"
+                (status, content), _ = await flights.do(
+                    key,
+                    lambda: fetch_upstream(network, path, params=request.query_params),
+                )
+                return Response(
+                    content, status_code=status, media_type="application/json"
+                )
+            r = await upstream.send(
+                network,
+                "GET",
+                path,
+                params=request.query_params,
+                headers=headers,
+                call=path,
+            )
+        if compressor.decode_passthrough(request, r):
+            # Compressed in an encoding the client didn't ask for
+            content = r.aiter_bytes()
+            headers = {
+                "content-type": r.headers.get("content-type", "application/json")
+            }
+        else:
+            content = r.aiter_raw()
+            headers = upstream.passthrough_headers(r)
+        return StreamingResponse(
+            content,
+            status_code=r.status_code,
+            headers=headers,
+            background=BackgroundTask(r.aclose),
+        )
+    except UpstreamUnavailable as e:
+        return error_resp(call, 503, -32000, f"Upstream unavailable: {e}")
+    except RateLimited as e:
+        return rate_limited_resp(call, f"Rate limit exceeded: {e}", e.retry_after)
+    except Exception as e:
+        logger.warning(f"Upstream request to {network} failed: {e}")
+        return error_resp(call, 502, -32603, "Upstream request failed")
 
 
 @app.get("/")
@@ -69,6 +353,56 @@ def healthcheck(request: Request):
     return {"status": "online"}
 
 
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    # Async so it runs on the event loop, which updates the counters being rendered
+    return Response(
+        metrics.render(upstream, cache, flights, ws_clients),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+@app.get("/api/v1/stats")
+async def stats(request: Request):
+    # Async for the same reason as /metrics, the stats are read from live state
+    return {
+        "cache": cache.stats(),
+        "rest_cache": rest_cache.stats(),
+        "store": store.stats(),
+        "shared": (
+            shared_cache.stats() if shared_cache is not None else {"enabled": False}
+        ),
+        "coalesce": flights.stats(),
+        "microbatch": microbatcher.stats(),
+        "upstreams": upstream.stats(),
+        "hedge": upstream.hedger.stats(),
+        "heads": heads.stats(),
+        "logs": log_splitter.stats(),
+        "capture": capture.stats(),
+        "compression": compressor.stats(),
+        "health": health.stats(),
+        "ratelimit": limiter.stats(),
+        "budget": upstream.budget.stats(),
+        "websockets": ws_clients.stats(),
+        "timing": timings.stats(),
+        "profiler": profiler.stats(),
+    }
+
+
+@app.post("/api/v1/profile")
+async def profile(request: Request, seconds: float = 10):
+    """Samples all threads for `seconds` and returns collapsed stacks for a flame graph."""
+    if not profiler.authorized(request.headers.get("authorization", "")):
+        if not profiler.enabled:
+            return JSONResponse({"error": "profiler disabled"}, status_code=404)
+        return JSONResponse({"error": "unauthorized"}, status_code=401)
+    try:
+        stacks = await profiler.profile(seconds)
+    except ProfilerBusy:
+        return JSONResponse({"error": "a profile is already running"}, status_code=409)
+    return Response(stacks, media_type="text/plain")
+
+
 @app.get("/rpc/{network}/{path:path}")
 async def get_rpc(request: Request, network: str, path: str):
     network = network.lower()
@@ -93,62 +427,15 @@ async def get_rpc(request: Request, network: str):
     return await get_rpc_resp(request, network)
 
 
-async def forward_messages_from_client_to_upstream(client_ws: WebSocket, upstream_ws):
-    try:
-        while True:
-            message = await client_ws.receive_text()
-            if not upstream_ws.open:
-                break
-            await upstream_ws.send(message)
-    except (WebSocketDisconnect, websockets.exceptions.ConnectionClosedError):
-        pass
-    except Exception as e:
-        print(f"Error forwarding message from client to upstream: {e}")
-
-
-async def forward_messages_from_upstream_to_client(upstream_ws, client_ws: WebSocket):
-    try:
-        async for message in upstream_ws:
-            await client_ws.send_text(message)
-    except (WebSocketDisconnect, websockets.exceptions.ConnectionClosedError):
-        pass
-    except Exception as e:
-        print(f"Error forwarding message from upstream to client: {e}")
-
-
 async def connect_to_upstream(client_ws: WebSocket, network: str):
     try:
         network = network.lower()
-        if network not in config.API_URLS:
-            upstream_ws_url = "wss://echo.websocket.org"
-        else:
-            upstream_ws_url = config.API_URLS[network]["wss"]
-        if upstream_ws_url.endswith("/"):
-            upstream_ws_url = upstream_ws_url[:-1]
-
-        async with websockets.connect(upstream_ws_url) as upstream_ws:
-            # Send a ping message to keep the connection alive
-            asyncio.create_task(ping_pong(upstream_ws))
-
-            # Forward messages between the client and upstream WebSocket
-            await asyncio.gather(
-                forward_messages_from_client_to_upstream(client_ws, upstream_ws),
-                forward_messages_from_upstream_to_client(upstream_ws, client_ws),
-            )
+        await ws_clients.serve(client_ws, network)
     except Exception as e:
         print(f"Upstream connection error: {e}")
         await client_ws.close()
 
 
-async def ping_pong(websocket):
-    try:
-        while websocket.open:
-            await websocket.ping()
-            await asyncio.sleep(10)
-    except Exception as e:
-        print(f"Ping/pong error: {e}")
-
-
 @app.websocket("/rpc/{network}/websocket")
 async def ws_proxy(websocket: WebSocket, network: str):
     await websocket.accept()
@@ -173,6 +460,20 @@ async def websocket_proxy(websocket: WebSocket, network: str):
 
 if __name__ == "__main__":
     print("Starting FastAPI...")
+    # Client-side WebSocket keepalive and permessage-deflate negotiation
+    ws_options = {
+        "ws_per_message_deflate": config.WEBSOCKET["COMPRESSION"],
+        "ws_ping_interval": config.WEBSOCKET["PING_INTERVAL"],
+        "ws_ping_timeout": config.WEBSOCKET["PING_TIMEOUT"],
+        "ws_max_size": config.WEBSOCKET["MAX_MESSAGE_BYTES"],
+        "workers": config.SHARED["WORKERS"],
+    }
+    if config.SHARED["ENABLED"]:
+        # Holds the cache and in-flight requests the workers share
+        hub = multiprocessing.get_context("spawn").Process(
+            target=run_shared_cache, name="shared-cache", daemon=True
+        )
+        hub.start()
     if None not in [config.FASTAPI["SSL_KEY"], config.FASTAPI["SSL_CERT"]]:
         uvicorn.run(
             "main:app",
@@ -180,9 +481,12 @@ if __name__ == "__main__":
             port=config.FASTAPI["PORT"],
             ssl_keyfile=config.FASTAPI["SSL_KEY"],
             ssl_certfile=config.FASTAPI["SSL_CERT"],
+            **ws_options,
         )
     else:
-        uvicorn.run("main:app", host="0.0.0.0", port=config.FASTAPI["PORT"])
+        uvicorn.run(
+            "main:app", host="0.0.0.0", port=config.FASTAPI["PORT"], **ws_options
+        )
 
 
 # See for an example of upstream proxy with FastAPI https://github.com/tiangolo/fastapi/issues/1788
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+import asyncio
+import time
+from bisect import bisect_left
+
+
+# Upper bounds in seconds, for request, upstream and event loop latency
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+SIZE_BUCKETS = (128, 512, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# Bound on (network, method) series, as method names come from clients
+MAX_SERIES = 512
+
+
+class Histogram:
+    """Bucket counts for one label set. Observing is a bisect and two additions,
+    cumulative counts are only worked out when scraped."""
+
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets=LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip((*self.buckets, "+Inf"), self.counts):
+            total += count
+            yield bound, total
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+class Exposition:
+    """Builds the Prometheus text format at scrape time."""
+
+    def __init__(self) -> None:
+        self.lines = []
+
+    def header(self, name, kind, help):
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} {kind}")
+
+    def sample(self, name, value, **labels):
+        self.lines.append(f"{name}{format_labels(labels)} {value}")
+
+    def metric(self, name, kind, help, samples):
+        """Adds a counter or gauge from an iterable of (labels, value)."""
+        self.header(name, kind, help)
+        for labels, value in samples:
+            self.sample(name, value, **labels)
+
+    def histogram(self, name, help, series):
+        """Adds a histogram from an iterable of (labels, Histogram)."""
+        self.header(name, "histogram", help)
+        for labels, hist in series:
+            for bound, total in hist.cumulative():
+                self.sample(f"{name}_bucket", total, **labels, le=bound)
+            self.sample(f"{name}_sum", round(hist.sum, 6), **labels)
+            self.sample(f"{name}_count", hist.count, **labels)
+
+    def render(self):
+        return "\n".join(self.lines) + "\n"
+
+
+class Metrics:
+    """Request metrics recorded on the hot path, plus an event loop lag monitor.
+    Everything else is read from each component's counters when scraped."""
+
+    def __init__(self, config) -> None:
+        self.enabled = config.METRICS["ENABLED"]
+        self.lag_interval = config.METRICS["LAG_INTERVAL"]
+        self.requests = {}
+        self.sizes = {}
+        self.loop_lag = Histogram()
+        self.last_lag = 0.0
+        self.task = None
+
+    def start(self):
+        if self.enabled:
+            self.task = asyncio.create_task(self.monitor_loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def monitor_loop(self):
+        """Measures how late the event loop wakes up from a fixed sleep."""
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.lag_interval)
+            self.last_lag = max(time.perf_counter() - start - self.lag_interval, 0.0)
+            self.loop_lag.observe(self.last_lag)
+
+    def observe_request(self, network, method, elapsed, size=None):
+        if not self.enabled:
+            return
+        key = (network, method)
+        hist = self.requests.get(key)
+        if hist is None:
+            if len(self.requests) >= MAX_SERIES:
+                key = (network, "other")
+            hist = self.requests.setdefault(key, Histogram())
+        hist.observe(elapsed)
+        if size is not None:
+            sizes = self.sizes.get(network)
+            if sizes is None:
+                sizes = self.sizes[network] = Histogram(SIZE_BUCKETS)
+            sizes.observe(size)
+
+    def render(self, upstream, cache, flights, ws_clients):
+        out = Exposition()
+        out.metric(
+            "proxy_requests_total",
+            "counter",
+            "Client requests by network and JSON-RPC method or REST path.",
+            (
+                ({"network": n, "method": m}, h.count)
+                for (n, m), h in self.requests.items()
+            ),
+        )
+        out.histogram(
+            "proxy_request_duration_seconds",
+            "Total time to answer a client request.",
+            (({"network": n, "method": m}, h) for (n, m), h in self.requests.items()),
+        )
+        out.histogram(
+            "proxy_response_size_bytes",
+            "Size of response bodies sent to clients, before compression.",
+            (({"network": n}, h) for n, h in self.sizes.items()),
+        )
+
+        endpoints = [
+            i
+            for protos in upstream.endpoints.values()
+            for p in protos.values()
+            for i in p
+        ]
+        out.histogram(
+            "proxy_upstream_duration_seconds",
+            "Time spent waiting on upstream HTTP requests.",
+            (
+                ({"network": i.network, "endpoint": i.name}, i.latency)
+                for i in endpoints
+                if i.proto == "rpc"
+            ),
+        )
+        out.metric(
+            "proxy_upstream_responses_total",
+            "counter",
+            "Upstream responses by HTTP status.",
+            (
+                ({"endpoint": i.name, "status": status}, count)
+                for i in endpoints
+                for status, count in i.statuses.items()
+            ),
+        )
+        out.metric(
+            "proxy_upstream_errors_total",
+            "counter",
+            "Upstream connection errors, timeouts, 5xx and 429 responses.",
+            (({"endpoint": i.name}, i.errors) for i in endpoints),
+        )
+        out.metric(
+            "proxy_upstream_in_flight",
+            "gauge",
+            "Open requests per upstream, or open sockets for WebSocket upstreams.",
+            (({"endpoint": i.name}, i.outstanding) for i in endpoints),
+        )
+        out.metric(
+            "proxy_upstream_available",
+            "gauge",
+            "1 if the endpoint's circuit allows traffic and it is not lagging.",
+            (
+                ({"endpoint": i.name}, int(i.available() and not i.lagging))
+                for i in endpoints
+            ),
+        )
+
+        cache_stats = cache.stats()
+        flight_stats = flights.stats()
+        out.metric(
+            "proxy_cache_requests_total",
+            "counter",
+            "Response cache lookups by result.",
+            [
+                ({"result": "hit"}, cache_stats["hits"]),
+                ({"result": "miss"}, cache_stats["misses"]),
+            ],
+        )
+        out.metric(
+            "proxy_cache_hit_ratio",
+            "gauge",
+            "Response cache hit ratio.",
+            [({}, cache_stats["hit_ratio"])],
+        )
+        out.metric(
+            "proxy_cache_bytes",
+            "gauge",
+            "Bytes held by the response cache.",
+            [({}, cache_stats["bytes"])],
+        )
+        out.metric(
+            "proxy_coalesce_requests_total",
+            "counter",
+            "Coalescable calls that led an upstream request or shared one.",
+            [
+                ({"result": "leader"}, flight_stats["leaders"]),
+                ({"result": "shared"}, flight_stats["shared"]),
+            ],
+        )
+        out.metric(
+            "proxy_coalesce_shared_ratio",
+            "gauge",
+            "Share of coalescable calls that were shared.",
+            [({}, flight_stats["shared_ratio"])],
+        )
+
+        out.metric(
+            "proxy_websocket_clients",
+            "gauge",
+            "Connected downstream WebSocket clients.",
+            [({}, ws_clients.clients)],
+        )
+        out.histogram(
+            "proxy_event_loop_lag_seconds",
+            "Delay of event loop wake-ups past their scheduled time.",
+            [({}, self.loop_lag)],
+        )
+        out.metric(
+            "proxy_event_loop_lag_last_seconds",
+            "gauge",
+            "Most recent event loop lag.",
+            [({}, round(self.last_lag, 6))],
+        )
+        return out.render()
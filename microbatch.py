@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+import asyncio
+
+
+class MicroBatcher:
+    """Collects single calls for a short window and sends them upstream as one batch.
+    Trades up to WINDOW_MS of latency for far fewer upstream requests."""
+
+    def __init__(self, config, batches) -> None:
+        self.networks = config.MICROBATCH["NETWORKS"]
+        self.window = config.MICROBATCH["WINDOW_MS"] / 1000
+        self.max_size = config.MICROBATCH["MAX_SIZE"]
+        self.batches = batches
+        self.queues = {}
+        self.timers = {}
+        self.calls = 0
+        self.flushes = 0
+        self.errors = 0
+
+    def enabled_for(self, network):
+        return network in self.networks
+
+    async def fetch(self, network, path, call):
+        """Queues a call for the next upstream batch and returns its (status_code, content).
+        The reply carries a rewritten id, callers restore their own."""
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.setdefault((network, path), [])
+        queue.append((call, future))
+        self.calls += 1
+        if len(queue) >= self.max_size:
+            self.flush(network, path)
+        elif len(queue) == 1:
+            self.timers[(network, path)] = asyncio.get_running_loop().call_later(
+                self.window, self.flush, network, path
+            )
+        return await future
+
+    def flush(self, network, path):
+        timer = self.timers.pop((network, path), None)
+        if timer is not None:
+            timer.cancel()
+        queue = self.queues.pop((network, path), [])
+        if queue:
+            self.flushes += 1
+            asyncio.ensure_future(self.send(network, path, queue))
+
+    async def send(self, network, path, queue):
+        try:
+            results = await self.batches.fetch_chunk(
+                network, path, [i[0] for i in queue]
+            )
+        except asyncio.CancelledError:
+            for _, future in queue:
+                future.cancel()
+            raise
+        except Exception as e:
+            # Every caller waiting on this batch fails with it, rather than hanging
+            self.errors += 1
+            for _, future in queue:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(queue, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            "networks": sorted(self.networks),
+            "calls": self.calls,
+            "upstream_batches": self.flushes,
+            "errors": self.errors,
+            "avg_batch_size": (
+                round(self.calls / self.flushes, 2) if self.flushes else 0
+            ),
+        }
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+import sys
+import time
+import hmac
+import asyncio
+import threading
+from collections import Counter
+from os.path import basename
+
+
+class ProfilerBusy(Exception):
+    """A profile is already being recorded."""
+
+
+class SamplingProfiler:
+    """Samples the stacks of every thread for a number of seconds and returns them in
+    the collapsed format read by flamegraph.pl and speedscope. Sampling runs on its own
+    thread, so the event loop keeps serving while it is being profiled."""
+
+    def __init__(self, config) -> None:
+        settings = config.PROFILER
+        self.token = settings["TOKEN"]
+        self.enabled = self.token is not None
+        self.interval = settings["INTERVAL_MS"] / 1000
+        self.max_seconds = settings["MAX_SECONDS"]
+        self.running = False
+        self.profiles = 0
+
+    def authorized(self, header):
+        """Checks an `Authorization: Bearer <token>` header."""
+        if not self.enabled or not header.startswith("Bearer "):
+            return False
+        return hmac.compare_digest(header[7:].encode(), self.token.encode())
+
+    def sample(self, seconds):
+        """Returns (collapsed stack counts, samples taken)."""
+        me = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {i.ident: i.name for i in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    name = f"{code.co_name} ({basename(code.co_filename)}:{code.co_firstlineno})"
+                    stack.append(name)
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(self.interval)
+        return stacks, samples
+
+    async def profile(self, seconds):
+        """Profiles for up to MAX_SECONDS and returns the collapsed stacks, one
+        "frame;frame;... count" line each, most sampled first."""
+        if self.running:
+            raise ProfilerBusy()
+        self.running = True
+        try:
+            stacks, _ = await asyncio.to_thread(
+                self.sample, min(seconds, self.max_seconds)
+            )
+        finally:
+            self.running = False
+        self.profiles += 1
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "running": self.running,
+            "profiles": self.profiles,
+        }
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import OrderedDict
+import jsonrpc
+
+
+# Request units charged per call, matched on method name prefix. Anything else costs 1.
+REQUEST_UNITS = {
+    "eth_getLogs": 10,
+    "eth_getBlockReceipts": 10,
+    "debug_": 20,
+    "trace_": 20,
+    "eth_estimateGas": 2,
+    "eth_call": 2,
+    "block_results": 5,
+}
+
+# Scheduling classes, lower runs first
+HIGH = 0
+NORMAL = 1
+BULK = 2
+PRIORITY_NAMES = {HIGH: "high", NORMAL: "normal", BULK: "bulk"}
+
+
+class RateLimited(Exception):
+    """Raised when a call can't be given upstream budget in time."""
+
+    def __init__(self, message, retry_after) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Refills at `rate` tokens per second, holding at most `burst`."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost, reserve=0.0):
+        """Takes `cost` tokens if at least `reserve` would be left afterwards."""
+        self.refill()
+        if self.tokens - cost < reserve:
+            return False
+        self.tokens -= cost
+        return True
+
+    def wait_time(self, cost, reserve=0.0):
+        """Returns the seconds until `take(cost, reserve)` can succeed."""
+        self.refill()
+        return max(cost + reserve - self.tokens, 0.0) / self.rate
+
+
+def get_units(weights, call):
+    """Returns (request_units, priority) for a call, a batch or a bare method name."""
+    if isinstance(call, list):
+        costs = [get_units(weights, i) for i in call]
+        if not costs:
+            return 1, NORMAL
+        return sum(i[0] for i in costs), min(i[1] for i in costs)
+    method = call.get("method") if isinstance(call, dict) else call
+    method = str(method or "")
+    cost = 1
+    for prefix, units in weights.items():
+        if method.startswith(prefix):
+            cost = units
+            break
+    if jsonrpc.is_write(method):
+        return cost, HIGH
+    if jsonrpc.is_heavy(method):
+        return cost, BULK
+    return cost, NORMAL
+
+
+class ClientLimiter:
+    """Token bucket limits per client, keyed by address, header or query parameter.
+    Buckets are charged in request units, so heavy calls use up a client's allowance
+    faster than cheap ones."""
+
+    def __init__(self, config) -> None:
+        settings = config.RATELIMIT
+        self.enabled = settings["ENABLED"]
+        self.rate = settings["RATE"]
+        self.burst = settings["BURST"]
+        self.max_clients = settings["MAX_CLIENTS"]
+        self.weights = {**REQUEST_UNITS, **config.BUDGET["UNITS"]}
+        # "ip", "header:<name>" or "query:<name>"
+        self.source, _, self.name = settings["KEY"].partition(":")
+        self.buckets = OrderedDict()
+        self.limited = 0
+
+    def get_key(self, request):
+        if self.source == "header":
+            key = request.headers.get(self.name)
+        elif self.source == "query":
+            key = request.query_params.get(self.name)
+        else:
+            key = None
+        if key is None:
+            # Clients without the key share the limit of their address
+            key = request.client.host if request.client else "unknown"
+        return key
+
+    def check(self, request, call):
+        """Charges a request to its client. Returns None if it may proceed,
+        or the seconds to wait before retrying."""
+        if not self.enabled:
+            return None
+        key = self.get_key(request)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        cost = min(get_units(self.weights, call)[0], self.burst)
+        if bucket.take(cost):
+            return None
+        self.limited += 1
+        return bucket.wait_time(cost)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "clients": len(self.buckets),
+            "limited": self.limited,
+        }
+
+
+class BudgetScheduler:
+    """Keeps upstream traffic within a request unit budget per network. While there is
+    budget to spare calls go straight through; otherwise they wait in priority order,
+    and bulk calls must leave a reserve for the latency-sensitive ones."""
+
+    def __init__(self, config, endpoints) -> None:
+        settings = config.BUDGET
+        self.enabled = settings["RU_PER_SEC"] > 0
+        self.weights = {**REQUEST_UNITS, **settings["UNITS"]}
+        self.max_wait = settings["MAX_WAIT"]
+        self.buckets = {}
+        for network, protos in endpoints.items():
+            # Every upstream endpoint brings its own quota
+            count = len(protos["rpc"])
+            if count:
+                self.buckets[network] = TokenBucket(
+                    settings["RU_PER_SEC"] * count, settings["BURST"] * count
+                )
+        self.reserve = {
+            HIGH: 0.0,
+            NORMAL: settings["RESERVE"] / 2,
+            BULK: settings["RESERVE"],
+        }
+        self.waiters = {}
+        self.timers = {}
+        self.order = itertools.count()
+        self.queued = {name: 0 for name in PRIORITY_NAMES.values()}
+        self.rejected = 0
+
+    async def acquire(self, network, call):
+        """Waits until the network has budget for `call`, or raises RateLimited."""
+        bucket = self.buckets.get(network)
+        if not self.enabled or bucket is None:
+            return
+        cost, priority = get_units(self.weights, call)
+        cost = min(cost, bucket.burst)
+        reserve = min(self.reserve[priority] * bucket.burst, bucket.burst - cost)
+        waiters = self.waiters.setdefault(network, [])
+        if not waiters and bucket.take(cost, reserve):
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(waiters, (priority, next(self.order), cost, reserve, future))
+        self.queued[PRIORITY_NAMES[priority]] += 1
+        self.drain(network)
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise RateLimited(
+                f"upstream request budget for {network} exhausted",
+                bucket.wait_time(cost, reserve),
+            )
+
+    def drain(self, network):
+        """Releases queued calls in priority order while the budget allows."""
+        timer = self.timers.pop(network, None)
+        if timer is not None:
+            timer.cancel()
+        bucket = self.buckets[network]
+        waiters = self.waiters[network]
+        while waiters:
+            _, _, cost, reserve, future = waiters[0]
+            if future.done():
+                heapq.heappop(waiters)
+            elif bucket.take(cost, reserve):
+                heapq.heappop(waiters)
+                future.set_result(None)
+            else:
+                self.timers[network] = asyncio.get_running_loop().call_later(
+                    bucket.wait_time(cost, reserve), self.drain, network
+                )
+                break
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "waiting": {network: len(i) for network, i in self.waiters.items()},
+            "available": {
+                network: math.floor(bucket.tokens)
+                for network, bucket in self.buckets.items()
+            },
+        }
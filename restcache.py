@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+import time
+import struct
+import asyncio
+import hashlib
+from urllib.parse import urlencode
+from starlette.responses import Response
+import jsonrpc
+from logger import logger
+
+
+# Per-path policy for the Tendermint RPC GET endpoints.
+#   ttl: seconds a reply stays fresh, None for immutable replies.
+#   pinned: query parameters that pin a reply to a block; with any of them set
+#     to a positive height the reply is immutable.
+# Paths not listed here are never cached.
+REST_POLICIES = {
+    "block": {"ttl": 1, "pinned": ("height",)},
+    "block_results": {"ttl": 1, "pinned": ("height",)},
+    "blockchain": {"ttl": 1, "pinned": ("maxHeight",)},
+    "commit": {"ttl": 1, "pinned": ("height",)},
+    "header": {"ttl": 1, "pinned": ("height",)},
+    "validators": {"ttl": 5, "pinned": ("height",)},
+    "consensus_params": {"ttl": 30, "pinned": ("height",)},
+    "block_by_hash": {"ttl": None},
+    "header_by_hash": {"ttl": None},
+    "tx": {"ttl": None},
+    "genesis": {"ttl": None},
+    "status": {"ttl": 1},
+    "health": {"ttl": 1},
+    "abci_info": {"ttl": 1},
+    "num_unconfirmed_txs": {"ttl": 1},
+    "net_info": {"ttl": 10},
+}
+# Cache-Control max-age for immutable replies, one year
+IMMUTABLE_MAX_AGE = 31536000
+# Stored before each cached body: the time it was fetched and its ETag digest
+ENTRY_HEADER = struct.Struct("!d16s")
+
+
+def is_height(value):
+    return value.isdigit() and int(value) > 0
+
+
+def matches_etag(header, etag):
+    """Returns True if an If-None-Match header matches an ETag, compared weakly."""
+    if header.strip() == "*":
+        return True
+    etag = etag.removeprefix("W/")
+    return any(i.strip().removeprefix("W/") == etag for i in header.split(","))
+
+
+class RestCache:
+    """HTTP caching for the GET /rpc/{network}/{path} route. Replies pinned to a height
+    or hash are kept as immutable, the others for a short TTL and then served stale while
+    a background request refreshes them. Replies carry ETag, Cache-Control and Age, so
+    downstream caches can keep them too, and matching If-None-Match requests get a 304.
+    """
+
+    def __init__(self, config, upstream, cache, flights) -> None:
+        self.enabled = config.REST_CACHE["ENABLED"] and cache.enabled
+        self.stale = config.REST_CACHE["STALE_SECONDS"]
+        self.upstream = upstream
+        self.cache = cache
+        self.flights = flights
+        self.refreshing = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def get_policy(self, path, params):
+        """Returns (cacheable, ttl) for a path and its query parameters."""
+        policy = REST_POLICIES.get(path.strip("/"))
+        if not self.enabled or policy is None:
+            return False, None
+        if any(is_height(params.get(i, "")) for i in policy.get("pinned", ())):
+            return True, None
+        return True, policy["ttl"]
+
+    def get_key(self, network, path, params):
+        query = urlencode(sorted(params.multi_items()))
+        return f"{network}:GET:{path.strip('/')}?{query}"
+
+    async def respond(self, request, network, path):
+        """Answers a GET request from the cache, or returns None if the path isn't cached."""
+        params = request.query_params
+        cacheable, ttl = self.get_policy(path, params)
+        if not cacheable:
+            return None
+        key = self.get_key(network, path, params)
+        value = await self.cache.lookup(key)
+        if value is not None:
+            age = time.time() - ENTRY_HEADER.unpack_from(value)[0]
+            if ttl is not None and age > ttl:
+                self.stale_hits += 1
+                self.refresh(network, path, params, key, ttl)
+                return self.get_resp(request, value, age, ttl, "STALE")
+            self.hits += 1
+            return self.get_resp(request, value, age, ttl, "HIT")
+        self.misses += 1
+        status, content = await self.fetch(network, path, params, key)
+        value = self.store(key, status, content, ttl)
+        if value is None:
+            return Response(content, status_code=status, media_type="application/json")
+        return self.get_resp(request, value, 0, ttl, "MISS")
+
+    async def fetch(self, network, path, params, key):
+        async def fetch_upstream():
+            r = await self.upstream.fetch(
+                network, "GET", path, params=params, rpc_method=path
+            )
+            return r.status_code, r.content
+
+        (status, content), _ = await self.flights.do(key, fetch_upstream)
+        return status, content
+
+    def store(self, key, status, content, ttl):
+        """Caches a successful reply. Returns the stored entry, or None if it errored."""
+        if status != 200 or jsonrpc.extract_result(content) is None:
+            return None
+        digest = hashlib.blake2b(content, digest_size=16).digest()
+        value = ENTRY_HEADER.pack(time.time(), digest) + content
+        if ttl is None:
+            # Tendermint blocks are final once committed
+            self.cache.set(key, value, persist=True)
+        else:
+            # Kept past its TTL for the stale window
+            self.cache.set(key, value, ttl + self.stale)
+        return value
+
+    def refresh(self, network, path, params, key, ttl):
+        """Refetches a stale entry in the background, once at a time per key."""
+        if key in self.refreshing:
+            return
+        self.refreshing.add(key)
+        asyncio.create_task(self.run_refresh(network, path, params, key, ttl))
+
+    async def run_refresh(self, network, path, params, key, ttl):
+        try:
+            status, content = await self.fetch(network, path, params, key)
+            if self.store(key, status, content, ttl) is None:
+                self.refresh_errors += 1
+            else:
+                self.refreshes += 1
+        except Exception as e:
+            self.refresh_errors += 1
+            logger.warning(f"Refreshing {network}/{path} failed: {e}")
+        finally:
+            self.refreshing.discard(key)
+
+    def get_resp(self, request, value, age, ttl, status):
+        digest = ENTRY_HEADER.unpack_from(value)[1]
+        # Weak, as the same tag goes with every content-coding the body is sent in
+        etag = f'W/"{digest.hex()}"'
+        if ttl is None:
+            cache_control = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+        else:
+            cache_control = (
+                f"public, max-age={ttl}, stale-while-revalidate={self.stale}"
+            )
+        headers = {
+            "ETag": etag,
+            "Cache-Control": cache_control,
+            "Age": str(int(age)),
+            "Vary": "Accept-Encoding",
+            "X-Cache": status,
+        }
+        if matches_etag(request.headers.get("if-none-match", ""), etag):
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        return Response(
+            value[ENTRY_HEADER.size :], media_type="application/json", headers=headers
+        )
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "refreshes": self.refreshes,
+            "refresh_errors": self.refresh_errors,
+            "refreshing": len(self.refreshing),
+        }
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+import os
+import struct
+import asyncio
+import itertools
+from cache import ResponseCache
+from config import ConfigFastAPI
+from logger import logger
+
+
+OP_GET = 1
+OP_SET = 2
+OP_CLAIM = 3
+OP_RESOLVE = 4
+OP_FAIL = 5
+
+FOUND = 0
+MISSING = 1
+LEADER = 2
+
+# request id, op, key length, ttl (negative for none), value length
+REQUEST = struct.Struct("!IBIdI")
+# request id, status, remaining ttl (negative for none), value length
+REPLY = struct.Struct("!IBdI")
+
+# Seconds to wait before reconnecting to the hub after a failure
+RECONNECT_DELAY = 1.0
+
+
+class SharedCacheServer:
+    """Runs in its own process next to the uvicorn workers and holds the cache and
+    in-flight claims they share, over a Unix socket. A worker that claims a key first
+    becomes its leader, the others wait for the result it resolves the claim with."""
+
+    def __init__(self, config) -> None:
+        self.path = config.SHARED["SOCKET"]
+        self.cache = ResponseCache(config)
+        # key -> (leader writer, [(writer, request id)])
+        self.claims = {}
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        # Created private so only the workers' user can connect, the hub has the process
+        # to itself so changing the umask around the bind is safe
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.handle, path=self.path)
+        finally:
+            os.umask(umask)
+        logger.info(f"Shared cache listening on {self.path}")
+        async with server:
+            await server.serve_forever()
+
+    def reply(self, writer, id, status, value=b"", ttl=None):
+        ttl = -1.0 if ttl is None else ttl
+        writer.write(REPLY.pack(id, status, ttl, len(value)) + value)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(REQUEST.size)
+                id, op, key_length, ttl, value_length = REQUEST.unpack(header)
+                key = (await reader.readexactly(key_length)).decode()
+                value = await reader.readexactly(value_length)
+                ttl = None if ttl < 0 else ttl
+                if op == OP_GET:
+                    value, ttl = self.cache.get_entry(key)
+                    if value is None:
+                        self.reply(writer, id, MISSING)
+                    else:
+                        self.reply(writer, id, FOUND, value, ttl)
+                elif op == OP_SET:
+                    self.cache.set(key, value, ttl)
+                elif op == OP_CLAIM:
+                    if key in self.claims:
+                        self.claims[key][1].append((writer, id))
+                    else:
+                        self.claims[key] = (writer, [])
+                        self.reply(writer, id, LEADER)
+                elif op in (OP_RESOLVE, OP_FAIL):
+                    _, waiters = self.claims.pop(key, (None, []))
+                    status = FOUND if op == OP_RESOLVE else MISSING
+                    for waiter, waiter_id in waiters:
+                        self.reply(
+                            waiter, waiter_id, status, value if status == FOUND else b""
+                        )
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            # Release the claims of a worker that went away, so its followers move on
+            for key, (leader, waiters) in list(self.claims.items()):
+                if leader is writer:
+                    del self.claims[key]
+                    for waiter, waiter_id in waiters:
+                        self.reply(waiter, waiter_id, MISSING)
+            writer.close()
+
+
+def run_server():
+    """Entry point of the shared cache process."""
+    asyncio.run(SharedCacheServer(ConfigFastAPI()).serve())
+
+
+class SharedCacheClient:
+    """A worker's connection to the shared cache process. Requests are multiplexed
+    over one socket; if the hub can't be reached every call degrades to a miss."""
+
+    def __init__(self, config) -> None:
+        self.path = config.SHARED["SOCKET"]
+        self.timeout = config.SHARED["TIMEOUT"]
+        self.ids = itertools.count(1)
+        self.pending = {}
+        self.writer = None
+        self.reader_task = None
+        self.lock = None
+        self.retry_at = 0.0
+        self.errors = 0
+        self.send_errors = 0
+
+    async def connect(self):
+        """Returns True once connected to the hub, retrying at most every RECONNECT_DELAY."""
+        if self.writer is not None:
+            return True
+        loop = asyncio.get_running_loop()
+        if loop.time() < self.retry_at:
+            return False
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.writer is not None:
+                return True
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path)
+            except OSError as e:
+                self.retry_at = loop.time() + RECONNECT_DELAY
+                self.errors += 1
+                logger.warning(f"Shared cache unavailable at {self.path}: {e}")
+                return False
+        self.reader_task = asyncio.create_task(self.read_loop(reader))
+        return True
+
+    async def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            await asyncio.gather(self.reader_task, return_exceptions=True)
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = None
+
+    async def read_loop(self, reader):
+        try:
+            while True:
+                id, status, ttl, length = REPLY.unpack(
+                    await reader.readexactly(REPLY.size)
+                )
+                value = await reader.readexactly(length)
+                future = self.pending.pop(id, None)
+                if future is not None and not future.done():
+                    future.set_result((status, value, None if ttl < 0 else ttl))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            logger.warning(f"Lost the shared cache connection: {e}")
+        finally:
+            self.writer = None
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_result((MISSING, b"", None))
+            self.pending = {}
+
+    def send(self, op, key, value=b"", ttl=None, id=0):
+        """Writes a request to the hub. Returns False if it couldn't be sent, the shared
+        tier is an optimization and its errors never reach a request."""
+        if self.writer is None:
+            return False
+        try:
+            key = key.encode()
+            ttl = -1.0 if ttl is None else ttl
+            self.writer.write(
+                REQUEST.pack(id, op, len(key), ttl, len(value)) + key + value
+            )
+        except Exception as e:
+            self.send_errors += 1
+            logger.warning(f"Shared cache request failed: {e}")
+            return False
+        return True
+
+    async def request(self, op, key, value=b"", timeout=None):
+        """Sends a request and returns (status, value, ttl), a miss on any failure."""
+        if not await self.connect():
+            return MISSING, b"", None
+        id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[id] = future
+        if not self.send(op, key, value, id=id):
+            self.pending.pop(id, None)
+            return MISSING, b"", None
+        try:
+            return await asyncio.wait_for(future, timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self.pending.pop(id, None)
+            return MISSING, b"", None
+
+    async def get(self, key):
+        """Returns (value, remaining ttl) from the shared cache, or (None, None)."""
+        status, value, ttl = await self.request(OP_GET, key)
+        if status != FOUND:
+            return None, None
+        return value, ttl
+
+    def set(self, key, value, ttl=None):
+        self.send(OP_SET, key, value, ttl)
+
+    async def claim(self, key):
+        """Returns (LEADER, None) if this worker should run the flight for `key`,
+        (FOUND, value) once another worker resolved it, or (MISSING, None) if that failed.
+        """
+        status, value, _ = await self.request(OP_CLAIM, key)
+        return status, value if status == FOUND else None
+
+    def resolve(self, key, value):
+        self.send(OP_RESOLVE, key, value)
+
+    def fail(self, key):
+        self.send(OP_FAIL, key)
+
+    def stats(self):
+        return {
+            "enabled": True,
+            "connected": self.writer is not None,
+            "pending": len(self.pending),
+            "connect_errors": self.errors,
+            "send_errors": self.send_errors,
+        }
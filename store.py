@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+import os
+import time
+import zlib
+import queue
+import sqlite3
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logger import logger
+
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS entries (
+        key TEXT PRIMARY KEY,
+        value BLOB NOT NULL,
+        size INTEGER NOT NULL,
+        used INTEGER NOT NULL
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS entries_used ON entries (used)",
+    "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+)
+
+# Writes applied per transaction by the writer thread
+WRITE_BATCH = 500
+# Reads only refresh an entry's last use if it is older than this many seconds
+TOUCH_INTERVAL = 3600
+
+
+class PersistentStore:
+    """SQLite tier behind the response cache for immutable results, so they survive
+    restarts. Values are zlib compressed, the file is bounded by MAX_BYTES with least
+    recently used entries evicted first, and nothing is loaded up front: lookups go to
+    the indexed table on demand. All disk I/O happens off the event loop, reads on a
+    small executor and writes batched on a single writer thread."""
+
+    def __init__(self, config) -> None:
+        self.settings = config.STORE
+        self.enabled = self.settings["ENABLED"]
+        self.path = self.settings["PATH"]
+        self.max_bytes = self.settings["MAX_BYTES"]
+        self.level = self.settings["COMPRESSION_LEVEL"]
+        self.writes = queue.Queue(maxsize=self.settings["MAX_PENDING"])
+        self.local = threading.local()
+        self.readers = None
+        self.writer = None
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.written = 0
+        self.evicted = 0
+        self.dropped = 0
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def start(self):
+        if not self.enabled:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        connection = self.connect()
+        with connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+            row = connection.execute(
+                "SELECT value FROM meta WHERE name = 'size'"
+            ).fetchone()
+        connection.close()
+        self.size = row[0] if row else 0
+        self.readers = ThreadPoolExecutor(
+            max_workers=self.settings["READERS"], thread_name_prefix="store-read"
+        )
+        self.writer = threading.Thread(
+            target=self.write_loop, name="store-write", daemon=True
+        )
+        self.writer.start()
+        logger.info(
+            f"Persistent cache at {self.path} ({round(self.size / 1024**2, 1)} MB)"
+        )
+
+    def close(self):
+        """Flushes pending writes and stops the store's threads."""
+        if self.writer is None:
+            return
+        self.writes.put(None)
+        self.writer.join()
+        self.readers.shutdown(wait=True)
+        self.writer = None
+        self.readers = None
+
+    async def get(self, key):
+        """Returns a stored value, or None."""
+        if self.readers is None:
+            return None
+        value = await asyncio.get_running_loop().run_in_executor(
+            self.readers, self.read, key
+        )
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def read(self, key):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self.connect()
+        row = connection.execute(
+            "SELECT value, used FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if time.time() - row[1] > TOUCH_INTERVAL:
+            self.enqueue(("touch", key))
+        return zlib.decompress(row[0])
+
+    def put(self, key, value):
+        """Queues a value to be stored. Never blocks, values are dropped under backlog."""
+        if self.writer is not None:
+            self.enqueue(("put", key, value))
+
+    def enqueue(self, item):
+        try:
+            self.writes.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def write_loop(self):
+        connection = self.connect()
+        running = True
+        while running:
+            batch = [self.writes.get()]
+            while len(batch) < WRITE_BATCH:
+                try:
+                    batch.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [i for i in batch if i is not None]
+            try:
+                self.apply(connection, batch)
+            except sqlite3.Error as e:
+                logger.warning(f"Persistent cache write failed: {e}")
+        connection.close()
+
+    def apply(self, connection, batch):
+        now = int(time.time())
+        with connection:
+            # Other worker processes may write to the same file, take the write lock before
+            # reading the size so their updates can't interleave with this batch
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT value FROM meta WHERE name = 'size'"
+            ).fetchone()
+            self.size = row[0] if row else self.size
+            for item in batch:
+                if item[0] == "touch":
+                    connection.execute(
+                        "UPDATE entries SET used = ? WHERE key = ?", (now, item[1])
+                    )
+                    continue
+                _, key, value = item
+                value = zlib.compress(value, self.level)
+                size = len(key) + len(value)
+                row = connection.execute(
+                    "SELECT size FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                connection.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, size, used) VALUES (?, ?, ?, ?)",
+                    (key, value, size, now),
+                )
+                self.size += size - (row[0] if row else 0)
+                self.written += 1
+            if self.size > self.max_bytes:
+                self.evict(connection)
+            connection.execute(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES ('size', ?)",
+                (self.size,),
+            )
+
+    def evict(self, connection):
+        """Deletes least recently used entries until the store is 10% under its bound."""
+        target = self.max_bytes * 0.9
+        while self.size > target:
+            rows = connection.execute(
+                "SELECT key, size FROM entries ORDER BY used LIMIT 200"
+            ).fetchall()
+            if not rows:
+                self.size = 0
+                break
+            connection.executemany(
+                "DELETE FROM entries WHERE key = ?", [(i[0],) for i in rows]
+            )
+            self.size -= sum(i[1] for i in rows)
+            self.evicted += len(rows)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "written": self.written,
+            "evicted": self.evicted,
+            "dropped": self.dropped,
+            "pending": self.writes.qsize(),
+        }
@@ -0,0 +1,8 @@
+import pytest
+from config import ConfigFastAPI
+
+
+@pytest.fixture
+def config():
+    """Settings from the environment, sections may be changed per test."""
+    return ConfigFastAPI()
@@ -0,0 +1,102 @@
+import asyncio
+import json
+from batch import BatchHandler
+from cache import ResponseCache
+from coalesce import SingleFlight
+from ratelimit import RateLimited
+
+
+class Reply:
+    def __init__(self, content, status_code=200) -> None:
+        self.content = content
+        self.status_code = status_code
+
+
+class Upstream:
+    """Answers each call with its method name, in reverse order."""
+
+    def __init__(self, error=None) -> None:
+        self.batches = []
+        self.error = error
+
+    async def fetch(self, network, method, path, content=None, **kwargs):
+        calls = json.loads(content)
+        self.batches.append(calls)
+        if self.error is not None:
+            raise self.error
+        replies = [
+            {"jsonrpc": "2.0", "id": i["id"], "result": i["method"]} for i in calls
+        ]
+        return Reply(json.dumps(replies[::-1]).encode())
+
+
+class Heads:
+    def get_result(self, network, call):
+        return None
+
+
+def handle(config, upstream, calls, cache=None):
+    config.BATCH["UPSTREAM_SIZE"] = 2
+    cache = cache or ResponseCache(config)
+    handler = BatchHandler(config, upstream, cache, SingleFlight(config), Heads())
+    resp = asyncio.run(handler.handle("eth", None, calls))
+    return json.loads(resp.body), resp.headers["X-Cache"]
+
+
+def call(id, method, *params):
+    return {"jsonrpc": "2.0", "id": id, "method": method, "params": list(params)}
+
+
+def test_batch_is_split_and_reassembled(config):
+    upstream = Upstream()
+    calls = [call(f"c{i}", f"eth_method{i}") for i in range(5)]
+    replies, status = handle(config, upstream, calls)
+    assert [len(i) for i in upstream.batches] == [2, 2, 1]
+    expected = [(f"c{i}", f"eth_method{i}") for i in range(5)]
+    assert [(i["id"], i["result"]) for i in replies] == expected
+    assert status == "MISS"
+
+
+def test_cached_repeated_and_invalid_entries(config):
+    upstream = Upstream()
+    cache = ResponseCache(config)
+    cache.set("eth:eth_chainId:[]", b'"0x1"')
+    calls = [
+        call(1, "eth_chainId"),
+        call(2, "eth_gasPrice"),
+        call(3, "eth_gasPrice"),
+        {"jsonrpc": "2.0", "method": "eth_blockNumber"},
+        "garbage",
+        {"jsonrpc": "2.0", "id": 6, "method": {"name": "eth_chainId"}},
+    ]
+    replies, status = handle(config, upstream, calls, cache)
+    # The repeat and the cached call are answered locally
+    assert [[i["method"] for i in batch] for batch in upstream.batches] == [
+        ["eth_gasPrice", "eth_blockNumber"]
+    ]
+    assert replies[:3] == [
+        {"jsonrpc": "2.0", "id": 1, "result": "0x1"},
+        {"jsonrpc": "2.0", "id": 2, "result": "eth_gasPrice"},
+        {"jsonrpc": "2.0", "id": 3, "result": "eth_gasPrice"},
+    ]
+    # The notification gets no reply
+    assert len(replies) == 5
+    assert [i["error"]["code"] for i in replies[3:]] == [-32600, -32600]
+    assert status == "PARTIAL"
+    assert cache.get("eth:eth_gasPrice:[]") == b'"eth_gasPrice"'
+
+
+def test_upstream_errors_are_reported_per_call(config):
+    replies, _ = handle(
+        config, Upstream(ConnectionError("down")), [call(1, "a"), call(2, "b")]
+    )
+    assert [(i["id"], i["error"]["code"]) for i in replies] == [
+        (1, -32603),
+        (2, -32603),
+    ]
+    limited = Upstream(RateLimited("budget exhausted", 1.0))
+    replies, _ = handle(config, limited, [call(1, "a"), call(2, "b")])
+    assert [(i["id"], i["error"]["code"]) for i in replies] == [
+        (1, -32005),
+        (2, -32005),
+    ]
@@ -0,0 +1,169 @@
+import json
+import pytest
+import jsonrpc
+from cache import CACHE_POLICIES, RECENT_TTL, ResponseCache, is_volatile
+
+
+class Store:
+    enabled = True
+
+    def __init__(self) -> None:
+        self.entries = {}
+
+    def put(self, key, value):
+        self.entries[key] = value
+
+
+def call(method, *params):
+    return {"jsonrpc": "2.0", "id": 1, "method": method, "params": list(params)}
+
+
+def receipt(block_number):
+    return json.dumps({"transactionHash": "0x1", "blockNumber": block_number}).encode()
+
+
+@pytest.mark.parametrize(
+    "method, params, volatile",
+    [
+        ("eth_getBlockByNumber", ["latest", False], True),
+        ("eth_getBlockByNumber", ["0x10", False], False),
+        ("eth_getBalance", ["0xabc"], True),
+        ("eth_getBalance", ["0xabc", "pending"], True),
+        ("eth_getBalance", ["0xabc", {"blockHash": "0x1"}], False),
+        ("eth_chainId", [], False),
+        ("eth_chainId", None, False),
+    ],
+)
+def test_is_volatile(method, params, volatile):
+    assert is_volatile(CACHE_POLICIES[method], params) is volatile
+
+
+def test_get_key(config):
+    cache = ResponseCache(config)
+    cache.set_head("eth", 1000)
+    key, ttl = cache.get_key("eth", call("eth_getBlockByNumber", "0x10", False))
+    assert key == 'eth:eth_getBlockByNumber:["0x10",false]' and ttl is None
+    assert cache.get_key("eth", call("eth_getBlockByNumber", "latest", False))[1] == 1
+    # Ids and key order don't matter
+    a = cache.get_key(
+        "eth", dict(call("eth_call", {"to": "0x1", "data": "0x"}, "0x5"), id=9)
+    )
+    b = cache.get_key("eth", call("eth_call", {"data": "0x", "to": "0x1"}, "0x5"))
+    assert a == b
+    assert cache.get_key("eth", call("eth_getBalance", "0xabc", "latest")) == (
+        None,
+        None,
+    )
+    assert cache.get_key("eth", call("eth_sendRawTransaction", "0x00")) == (None, None)
+    assert cache.get_key("eth", {"id": 1, "method": ["eth_chainId"]}) == (None, None)
+
+
+@pytest.mark.parametrize(
+    "method, params",
+    [
+        ("eth_getBlockByNumber", ["0x3e8", False]),
+        ("eth_getBlockTransactionCountByNumber", ["0x3e8"]),
+        ("eth_getTransactionByBlockNumberAndIndex", ["0x3e8", "0x0"]),
+        ("eth_getBalance", ["0xabc", "0x3e8"]),
+    ],
+)
+def test_recent_blocks_expire_until_final(config, method, params):
+    cache = ResponseCache(config)
+    # Unknown head
+    assert cache.get_key("eth", call(method, *params))[1] == RECENT_TTL
+    cache.set_head("eth", 1000)
+    key, ttl = cache.get_key("eth", call(method, *params))
+    assert ttl == RECENT_TTL
+    cache.set(key, b"{}", ttl)
+    assert key in cache.head_keys["eth"]
+    # A reorg replacing the head block drops it
+    cache.set_head("eth", 1000)
+    assert cache.get(key) is None
+    cache.set_head("eth", 1000 + cache.finality)
+    assert cache.get_key("eth", call(method, *params))[1] is None
+
+
+def test_block_hash_references_are_immutable(config):
+    cache = ResponseCache(config)
+    by_hash = call("eth_getBalance", "0xabc", {"blockHash": "0x1"})
+    assert cache.get_key("eth", by_hash)[1] is None
+    assert (
+        cache.get_key("eth", call("eth_getBlockByNumber", "earliest", False))[1] is None
+    )
+
+
+def test_lru_eviction(config):
+    config.CACHE["MAX_BYTES"] = 120
+    cache = ResponseCache(config)
+    for i in range(3):
+        cache.set(f"eth:eth_chainId:{i}", b"x" * 20)
+    cache.get("eth:eth_chainId:0")
+    cache.set("eth:eth_chainId:3", b"x" * 20)
+    assert "eth:eth_chainId:1" not in cache.entries
+    assert "eth:eth_chainId:0" in cache.entries
+    assert cache.size == sum(len(k) + len(v) for k, (v, _) in cache.entries.items())
+    assert cache.size <= 120
+
+
+def test_is_final(config):
+    cache = ResponseCache(config)
+    policy = CACHE_POLICIES["eth_getBlockByNumber"]
+    key = 'eth:eth_getBlockByNumber:["0x64",false]'
+    # Unknown head
+    assert not cache.is_final("eth", key, policy)
+    cache.set_head("eth", 100 + cache.finality)
+    assert cache.is_final("eth", key, policy)
+    cache.set_head("eth", 100 + cache.finality - 1)
+    assert not cache.is_final("eth", key, policy)
+    by_hash = 'eth:eth_getBalance:["0xabc",{"blockHash":"0x1"}]'
+    assert cache.is_final("eth", by_hash, CACHE_POLICIES["eth_getBalance"])
+    assert cache.is_final("eth", "eth:eth_chainId:[]", CACHE_POLICIES["eth_chainId"])
+    assert not cache.is_final("eth", "eth:custom:[]", {})
+
+
+def test_pending_transactions_are_not_cached(config):
+    store = Store()
+    cache = ResponseCache(config, store)
+    key = 'eth:eth_getTransactionReceipt:["0x1"]'
+    cache.set(key, receipt(None))
+    assert cache.get(key) is None
+    cache.set(key, b"null")
+    assert cache.get(key) is None
+    assert store.entries == {}
+
+
+def test_recently_mined_transactions_expire(config):
+    store = Store()
+    cache = ResponseCache(config, store)
+    cache.set_head("eth", 1000)
+    key = 'eth:eth_getTransactionByHash:["0x1"]'
+    cache.set(key, receipt(hex(1000)))
+    _, ttl = cache.get_entry(key)
+    assert 0 < ttl <= CACHE_POLICIES["eth_getTransactionByHash"]["mined_ttl"]
+    assert key in cache.head_keys["eth"]
+    assert store.entries == {}
+    # A reorg could drop it, so it goes with the next head
+    cache.set_head("eth", 1001)
+    assert cache.get(key) is None
+    cache.set(key, receipt(hex(1000 - cache.finality)))
+    assert cache.get_entry(key)[1] is None
+    assert key in store.entries
+
+
+def test_head_keys_are_bounded(config):
+    config.CACHE["MAX_BYTES"] = 2000
+    cache = ResponseCache(config)
+    for i in range(500):
+        cache.set(f"eth:eth_blockNumber:[{i}]", b'"0x1"', 1)
+    # No head tracker, entries only expire by ttl
+    assert cache.head_keys == {}
+    cache.set_head("eth", 1)
+    for i in range(500):
+        cache.set(f"eth:eth_blockNumber:[{i}]", b'"0x1"', 1)
+    assert len(cache.head_keys["eth"]) == len(cache.entries) < 500
+
+
+def test_result_body():
+    body = jsonrpc.result_body(5, b'{"a":[1,2]}')
+    assert json.loads(body) == {"jsonrpc": "2.0", "id": 5, "result": {"a": [1, 2]}}
+    assert body.endswith(jsonrpc.result_suffix(5))
@@ -0,0 +1,22 @@
+import glob
+import json
+from capture import TrafficCapture
+
+
+def test_rotates_to_a_new_file_each_time(config, tmp_path):
+    config.CAPTURE.update(
+        ENABLED=True, PATH=str(tmp_path), SAMPLE_RATE=1.0, ROTATE_BYTES=1, MAX_FILES=10
+    )
+    capture = TrafficCapture(config)
+    capture.start()
+    for i in range(5):
+        body = b'{"jsonrpc":"2.0","id":1,"method":"eth_chainId"}'
+        capture.record("eth", "rpc", "POST", "eth_chainId", body, None, 0.01, 10, 200)
+    capture.close()
+    names = glob.glob(f"{tmp_path}/capture-*.jsonl")
+    # All within the same second, each rotation still gets a file of its own
+    assert len(names) == capture.files == 5
+    for name in names:
+        with open(name, "rb") as f:
+            lines = f.read().splitlines()
+        assert len(lines) == 1 and json.loads(lines[0])["method"] == "eth_chainId"
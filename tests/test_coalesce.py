@@ -0,0 +1,88 @@
+import asyncio
+import pytest
+from coalesce import SingleFlight
+
+
+def test_identical_calls_share_one_flight(config):
+    flights = SingleFlight(config)
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 200, b"result"
+
+    async def run():
+        return await asyncio.gather(*[flights.do("key", fetch) for _ in range(5)])
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert [i[0] for i in results] == [(200, b"result")] * 5
+    assert sorted(i[1] for i in results) == [False] + [True] * 4
+    assert flights.flights == {}
+
+
+def test_flights_end_with_their_request(config):
+    flights = SingleFlight(config)
+
+    async def fetch():
+        return 200, b"result"
+
+    async def run():
+        await flights.do("key", fetch)
+        await flights.do("key", fetch)
+
+    asyncio.run(run())
+    assert (flights.leaders, flights.shared) == (2, 0)
+
+
+def test_errors_reach_every_caller(config):
+    flights = SingleFlight(config)
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise ConnectionError("down")
+
+    async def run():
+        return await asyncio.gather(
+            *[flights.do("key", fetch) for _ in range(3)], return_exceptions=True
+        )
+
+    assert all(isinstance(i, ConnectionError) for i in asyncio.run(run()))
+
+
+def test_a_cancelled_caller_does_not_cancel_the_flight(config):
+    flights = SingleFlight(config)
+
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return 200, b"result"
+
+    async def run():
+        leader = asyncio.ensure_future(flights.do("key", fetch))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.do("key", fetch))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(run()) == ((200, b"result"), True)
+
+
+def test_disabled(config):
+    config.COALESCE["ENABLED"] = False
+    flights = SingleFlight(config)
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 200, b"result"
+
+    async def run():
+        await asyncio.gather(*[flights.do("key", fetch) for _ in range(3)])
+
+    asyncio.run(run())
+    assert len(calls) == 3
@@ -0,0 +1,105 @@
+import asyncio
+import gzip
+import pytest
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from compression import Compressor, ResultResponse, parse_accept_encoding
+
+
+def request(accept_encoding=None):
+    headers = (
+        []
+        if accept_encoding is None
+        else [(b"accept-encoding", accept_encoding.encode())]
+    )
+    return Request({"type": "http", "method": "POST", "headers": headers})
+
+
+def get_compressor(config, min_bytes=100):
+    config.COMPRESSION["MIN_BYTES"] = min_bytes
+    compressor = Compressor(config)
+    # Only gzip is always available
+    compressor.encodings = ["gzip"]
+    return compressor
+
+
+def test_parse_accept_encoding():
+    assert parse_accept_encoding("gzip, br;q=0.5, zstd;q=0, *;q=bad") == {
+        "gzip": 1.0,
+        "br": 0.5,
+        "zstd": 0.0,
+        "*": 0.0,
+    }
+
+
+@pytest.mark.parametrize(
+    "header, encoding",
+    [("gzip", "gzip"), ("*", "gzip"), ("gzip;q=0", None), ("br", None), ("", None)],
+)
+def test_negotiate(config, header, encoding):
+    assert get_compressor(config).negotiate(header) == encoding
+
+
+def test_large_bodies_are_compressed(config):
+    compressor = get_compressor(config)
+    body = b'{"result":"' + b"ab" * 1000 + b'"}'
+    resp = asyncio.run(
+        compressor.compress(
+            request("gzip"), Response(body, media_type="application/json")
+        )
+    )
+    assert resp.headers["content-encoding"] == "gzip"
+    assert resp.headers["vary"] == "Accept-Encoding"
+    assert int(resp.headers["content-length"]) == len(resp.body)
+    assert gzip.decompress(resp.body) == body
+
+
+def test_small_bodies_and_unwilling_clients_are_left_alone(config):
+    compressor = get_compressor(config)
+    small = Response(b"{}", media_type="application/json")
+    assert (
+        "content-encoding"
+        not in asyncio.run(compressor.compress(request("gzip"), small)).headers
+    )
+    large = Response(b"{}" * 1000, media_type="application/json")
+    assert (
+        "content-encoding"
+        not in asyncio.run(compressor.compress(request(), large)).headers
+    )
+
+
+def test_cached_results_reuse_the_compressed_prefix(config):
+    compressor = get_compressor(config)
+    result = b'"' + b"0" * 2000 + b'"'
+
+    async def run(id):
+        resp = ResultResponse("eth:key", id, result)
+        return await compressor.compress(request("gzip"), resp)
+
+    first, second = asyncio.run(run(1)), asyncio.run(run("b"))
+    assert (
+        gzip.decompress(first.body) == b'{"jsonrpc":"2.0","result":%s,"id":1}' % result
+    )
+    assert (
+        gzip.decompress(second.body)
+        == b'{"jsonrpc":"2.0","result":%s,"id":"b"}' % result
+    )
+    assert compressor.prefix_hits == 1
+
+
+def test_streamed_responses_are_compressed_by_chunk(config):
+    compressor = get_compressor(config)
+    chunks = [b"[" + b"1," * 500, b"2]"]
+
+    async def body():
+        for i in chunks:
+            yield i
+
+    async def run():
+        resp = StreamingResponse(body(), media_type="application/json")
+        resp = await compressor.compress(request("gzip"), resp)
+        return resp, b"".join([i async for i in resp.body_iterator])
+
+    resp, content = asyncio.run(run())
+    assert resp.headers["content-encoding"] == "gzip"
+    assert gzip.decompress(content) == b"".join(chunks)
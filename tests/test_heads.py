@@ -0,0 +1,45 @@
+import asyncio
+import jsonrpc
+from cache import ResponseCache
+from heads import HeadTracker
+
+
+class Upstream:
+    endpoints = {}
+
+    async def fetch(self, *args, **kwargs):
+        raise ConnectionError("offline")
+
+
+def new_head(number, block_hash):
+    result = {"number": hex(number), "hash": block_hash}
+    return jsonrpc.dumps({"method": "eth_subscription", "params": {"result": result}})
+
+
+def test_same_height_with_new_hash_invalidates(config):
+    cache = ResponseCache(config)
+    heads = HeadTracker(config, Upstream(), cache)
+    call = {"id": 1, "method": "eth_getBlockByNumber", "params": ["latest", False]}
+    key, ttl = cache.get_key("eth", call)
+
+    async def run():
+        heads.on_head("eth", *heads.parse_head("eth", new_head(100, "0xa")))
+        cache.set(key, b"{}", ttl)
+        # Repeated notification of the same block
+        heads.on_head("eth", *heads.parse_head("eth", new_head(100, "0xa")))
+        assert cache.get(key) == b"{}"
+        # Older block, ignored
+        heads.on_head("eth", *heads.parse_head("eth", new_head(99, "0xc")))
+        assert cache.get(key) == b"{}"
+        heads.on_head("eth", *heads.parse_head("eth", new_head(100, "0xb")))
+        assert cache.get(key) is None
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert heads.get_head("eth")["hash"] == "0xb"
+    assert cache.heights["eth"] == 100
+
+
+def test_parse_head_ignores_confirmations(config):
+    heads = HeadTracker(config, Upstream(), ResponseCache(config))
+    assert heads.parse_head("eth", b'{"jsonrpc":"2.0","id":1,"result":"0x1"}') is None
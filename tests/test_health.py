@@ -0,0 +1,106 @@
+import asyncio
+from health import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, HealthChecker
+
+
+def get_breaker(config, **settings):
+    config.BREAKER.update(settings)
+    return CircuitBreaker(config.BREAKER)
+
+
+def test_consecutive_failures_open_the_circuit(config):
+    breaker = get_breaker(config, MAX_FAILURES=3)
+    breaker.failure()
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    breaker.failure()
+    assert breaker.state == CLOSED
+    breaker.failure()
+    assert breaker.state == OPEN and not breaker.available()
+
+
+def test_error_rate_opens_the_circuit(config):
+    breaker = get_breaker(config, MAX_FAILURES=100, MIN_REQUESTS=10, ERROR_RATE=0.5)
+    for _ in range(4):
+        breaker.success()
+        breaker.failure()
+    assert breaker.state == CLOSED
+    breaker.success()
+    breaker.failure()
+    assert breaker.state == OPEN and breaker.trips == 1
+
+
+def test_half_open_lets_one_trial_through(config):
+    breaker = get_breaker(config, MAX_FAILURES=1, HALF_OPEN_PROBES=2)
+    breaker.failure()
+    breaker.opened_at -= breaker.cooldown
+    assert breaker.state == HALF_OPEN and breaker.available()
+    trial = breaker.begin()
+    assert trial and not breaker.available()
+    # Requests started before the circuit opened don't end the trial
+    other = breaker.begin()
+    breaker.end(other)
+    assert not breaker.available()
+    breaker.success()
+    breaker.end(trial)
+    assert breaker.available()
+    breaker.success()
+    assert breaker.state == CLOSED
+
+
+def test_a_failed_trial_opens_the_circuit_again(config):
+    breaker = get_breaker(config, MAX_FAILURES=1)
+    breaker.failure()
+    breaker.opened_at -= breaker.cooldown
+    breaker.end(breaker.begin())
+    breaker.failure()
+    assert breaker.state == OPEN and breaker.trips == 2
+
+
+def test_disabled_breaker_is_always_available(config):
+    breaker = get_breaker(config, ENABLED=False, MAX_FAILURES=1)
+    breaker.failure()
+    assert breaker.available()
+
+
+class Endpoint:
+    def __init__(self, name, height) -> None:
+        self.name = name
+        self.reply = height
+        self.height = None
+        self.lagging = False
+
+
+class Reply:
+    def __init__(self, height) -> None:
+        self.content = b'{"jsonrpc":"2.0","id":1,"result":"%s"}' % hex(height).encode()
+
+
+class Upstream:
+    def __init__(self, endpoints) -> None:
+        self.endpoints = {"eth": {"rpc": endpoints, "wss": []}}
+
+    async def request(self, network, method, path, endpoint=None, **kwargs):
+        if endpoint.reply is None:
+            raise ConnectionError("down")
+        return Reply(endpoint.reply)
+
+
+class Heads:
+    def get_head(self, network):
+        return None
+
+
+def test_lagging_endpoints_leave_rotation(config):
+    config.HEALTH["MAX_LAG"] = 5
+    endpoints = [Endpoint("a", 100), Endpoint("b", 90), Endpoint("c", None)]
+    checker = HealthChecker(config, Upstream(endpoints), Heads())
+    asyncio.run(checker.check("eth"))
+    assert [(i.height, i.lagging) for i in endpoints] == [
+        (100, False),
+        (90, True),
+        (None, False),
+    ]
+    endpoints[1].reply = 98
+    asyncio.run(checker.check("eth"))
+    assert not endpoints[1].lagging
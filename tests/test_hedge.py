@@ -0,0 +1,104 @@
+import asyncio
+import pytest
+import jsonrpc
+from hedge import Hedger
+
+
+def get_hedger(config, delay_ms=10):
+    config.HEDGE.update(ENABLED=True, DEFAULT_MS=delay_ms, MIN_MS=1, MIN_SAMPLES=10)
+    return Hedger(config)
+
+
+def attempt(result, delay, log=None):
+    async def run():
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            if log is not None:
+                log.append(result)
+            raise
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return run
+
+
+def test_fast_calls_are_not_hedged(config):
+    hedger = get_hedger(config)
+    secondary = attempt("second", 0)
+    assert (
+        asyncio.run(hedger.run("eth", "eth_call", attempt("first", 0), secondary))
+        == "first"
+    )
+    assert hedger.hedged == 0
+
+
+def test_slow_calls_are_hedged_and_the_loser_cancelled(config):
+    hedger = get_hedger(config)
+    cancelled = []
+    primary = attempt("first", 1, cancelled)
+    result = asyncio.run(hedger.run("eth", "eth_call", primary, attempt("second", 0)))
+    assert result == "second"
+    assert (hedger.hedged, hedger.wins) == (1, 1)
+    assert cancelled == ["first"]
+
+
+def test_a_failed_hedge_waits_for_the_primary(config):
+    hedger = get_hedger(config)
+    primary = attempt("first", 0.05)
+    secondary = attempt(ConnectionError("down"), 0)
+    assert asyncio.run(hedger.run("eth", "eth_call", primary, secondary)) == "first"
+    assert hedger.wins == 0
+
+
+def test_both_failing_raises_the_primary_error(config):
+    hedger = get_hedger(config)
+    primary = attempt(ValueError("first"), 0.05)
+    secondary = attempt(ConnectionError("second"), 0)
+    with pytest.raises(ValueError):
+        asyncio.run(hedger.run("eth", "eth_call", primary, secondary))
+
+
+def test_threshold_follows_the_observed_percentile(config):
+    hedger = get_hedger(config)
+    key = hedger.get_series("eth", "eth_call")
+    for i in range(1, 21):
+        hedger.observe(key, i / 1000)
+    assert hedger.threshold(key) == pytest.approx(0.019)
+    assert hedger.threshold(hedger.get_series("eth", "eth_getBalance")) == 0.01
+
+
+def test_only_reads_are_eligible(config):
+    hedger = get_hedger(config)
+    assert hedger.eligible("eth_getBalance")
+    assert not hedger.eligible("eth_sendRawTransaction")
+    assert not hedger.eligible(None)
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        "eth_sendRawTransaction",
+        "eth_signTypedData_v4",
+        "personal_unlockAccount",
+        "eth_newFilter",
+    ],
+)
+def test_writes_are_never_reads(method):
+    assert jsonrpc.is_write(method)
+    assert not jsonrpc.is_read(method)
+    assert not jsonrpc.is_shareable(method)
+
+
+@pytest.mark.parametrize(
+    "method", ["eth_getBalance", "eth_call", "/status", "block_results"]
+)
+def test_reads(method):
+    assert jsonrpc.is_read(method)
+    assert not jsonrpc.is_write(method)
+
+
+def test_unknown_methods_are_not_hedged():
+    assert not jsonrpc.is_read("custom_doSomething")
+    assert not jsonrpc.is_read("eth_getFilterLogs")
@@ -0,0 +1,53 @@
+import json
+import pytest
+import jsonrpc
+
+
+def test_with_id_swaps_the_id_in_place():
+    body = b'{"jsonrpc":"2.0","id":1,"result":"0x1"}'
+    assert (
+        jsonrpc.with_id(body, "abc") == b'{"jsonrpc":"2.0","id":"abc","result":"0x1"}'
+    )
+    assert jsonrpc.with_id(body, None) == b'{"jsonrpc":"2.0","id":null,"result":"0x1"}'
+
+
+def test_with_id_decodes_when_ambiguous():
+    # "id" also appears inside the result
+    body = b'{"jsonrpc":"2.0","id":1,"result":{"id":7}}'
+    assert json.loads(jsonrpc.with_id(body, 2)) == {
+        "jsonrpc": "2.0",
+        "id": 2,
+        "result": {"id": 7},
+    }
+    assert jsonrpc.with_id(b"[1,2]", 2) == b"[1,2]"
+    assert jsonrpc.with_id(b"not json", 2) == b"not json"
+
+
+def test_sniff_call():
+    body = b'{"jsonrpc":"2.0","id":"a-1","method":"eth_sendRawTransaction","params":["0x00"]}'
+    assert jsonrpc.sniff_call(body) == {
+        "jsonrpc": "2.0",
+        "id": "a-1",
+        "method": "eth_sendRawTransaction",
+    }
+    assert jsonrpc.sniff_call(b'{"id":null,"method":"eth_chainId"}')["id"] is None
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b'[{"id":1,"method":"eth_chainId"}]',
+        b'{"id":1,"method":"eth_call","params":[{"method":"x"}]}',
+        b'{"method":"eth_chainId"}',
+    ],
+)
+def test_sniff_call_gives_up_when_unsure(body):
+    assert jsonrpc.sniff_call(body) is None
+
+
+def test_big_ints_stay_exact():
+    big = 2**64 + 1
+    body = b'{"jsonrpc":"2.0","id":1,"result":{"value":%d}}' % big
+    assert jsonrpc.loads(body)["result"]["value"] == big
+    assert jsonrpc.loads(body.decode())["result"]["value"] == big
+    assert jsonrpc.extract_result(body) == b'{"value":%d}' % big
@@ -0,0 +1,144 @@
+import asyncio
+import json
+import pytest
+import jsonrpc
+from cache import ResponseCache
+from logs import LogSplitter, RANGE_ERROR_HINTS, UpstreamError, is_range_error
+
+
+class Reply:
+    def __init__(self, data, status_code=200) -> None:
+        self.content = json.dumps(data).encode()
+        self.status_code = status_code
+
+
+class Upstream:
+    """Rejects ranges wider than `max_range` with `message`, otherwise returns one log
+    per block."""
+
+    def __init__(self, max_range, message, status_code=200) -> None:
+        self.max_range = max_range
+        self.message = message
+        self.status_code = status_code
+        self.ranges = []
+
+    async def fetch(self, network, method, path, content=None, **kwargs):
+        log_filter = jsonrpc.loads(content)["params"][0]
+        start, end = int(log_filter["fromBlock"], 16), int(log_filter["toBlock"], 16)
+        self.ranges.append((start, end))
+        if end - start + 1 > self.max_range:
+            error = {"code": -32005, "message": self.message}
+            return Reply({"jsonrpc": "2.0", "id": 1, "error": error}, self.status_code)
+        return Reply(
+            {
+                "jsonrpc": "2.0",
+                "id": 1,
+                "result": [hex(i) for i in range(start, end + 1)],
+            }
+        )
+
+
+class Heads:
+    def get_head(self, network):
+        return {"height": 100000}
+
+
+def get_splitter(config, upstream):
+    config.LOGS.update(CHUNK_SIZE=100, MIN_CHUNK=10)
+    return LogSplitter(config, upstream, ResponseCache(config), Heads())
+
+
+@pytest.mark.parametrize("hint", RANGE_ERROR_HINTS)
+def test_each_hint_is_a_range_error(hint):
+    assert is_range_error(f"upstream said: {hint.upper()}")
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        "query returned more than 10000 results",
+        "block range is too wide",
+        "Log response size exceeded. You can make eth_getLogs requests with up to a 2K block range",
+        "eth_getLogs is limited to a 10,000 range",
+        "exceed maximum block range: 5000",
+        "requested too many blocks from 0 to 20000, maximum is set to 2048",
+        "ranges over 10000 blocks are not supported",
+    ],
+)
+def test_provider_messages_are_range_errors(message):
+    assert is_range_error(message)
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        "invalid params",
+        "execution reverted",
+        "unknown block",
+        "limit exceeded",
+        "rate limit exceeded",
+        "daily request limit reached",
+        str({"code": -32005, "message": "429 Too Many Requests"}),
+        "Your app has exceeded its compute units per second capacity",
+        "rate limited, block range queries are throttled",
+        "connection timeout",
+        "request timed out",
+        "502",
+    ],
+)
+def test_other_errors_are_not_range_errors(message):
+    assert not is_range_error(message)
+
+
+def test_get_chunks_aligns_on_chunk_size(config):
+    splitter = get_splitter(config, None)
+    assert splitter.get_chunks(150, 420) == [
+        (150, 199),
+        (200, 299),
+        (300, 399),
+        (400, 420),
+    ]
+    assert splitter.get_chunks(200, 299) == [(200, 299)]
+
+
+def test_fetch_chunk_splits_on_range_errors(config):
+    upstream = Upstream(25, "query returned more than 10000 results")
+    splitter = get_splitter(config, upstream)
+    chunk = {"fromBlock": hex(0), "toBlock": hex(99)}
+    result = asyncio.run(
+        splitter.fetch_chunk("eth", None, asyncio.Semaphore(4), chunk, 0, 99, None)
+    )
+    assert jsonrpc.loads(result) == [hex(i) for i in range(100)]
+    assert splitter.splits == 3
+    assert max(end - start + 1 for start, end in upstream.ranges[1:]) <= 50
+
+
+def test_fetch_chunk_gives_up_below_min_chunk(config):
+    splitter = get_splitter(config, Upstream(5, "block range is too wide"))
+    chunk = {"fromBlock": hex(0), "toBlock": hex(99)}
+    with pytest.raises(UpstreamError):
+        asyncio.run(
+            splitter.fetch_chunk("eth", None, asyncio.Semaphore(4), chunk, 0, 99, None)
+        )
+
+
+def test_fetch_chunk_does_not_split_other_errors(config):
+    upstream = Upstream(25, "invalid params")
+    splitter = get_splitter(config, upstream)
+    chunk = {"fromBlock": hex(0), "toBlock": hex(99)}
+    with pytest.raises(UpstreamError):
+        asyncio.run(
+            splitter.fetch_chunk("eth", None, asyncio.Semaphore(4), chunk, 0, 99, None)
+        )
+    assert upstream.ranges == [(0, 99)]
+
+
+def test_fetch_chunk_does_not_split_when_throttled(config):
+    upstream = Upstream(25, "block range too wide, slow down", status_code=429)
+    splitter = get_splitter(config, upstream)
+    chunk = {"fromBlock": hex(0), "toBlock": hex(99)}
+    with pytest.raises(UpstreamError):
+        asyncio.run(
+            splitter.fetch_chunk("eth", None, asyncio.Semaphore(4), chunk, 0, 99, None)
+        )
+    assert upstream.ranges == [(0, 99)]
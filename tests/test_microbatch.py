@@ -0,0 +1,56 @@
+import asyncio
+from microbatch import MicroBatcher
+
+
+class Batches:
+    def __init__(self, error=None) -> None:
+        self.sent = []
+        self.error = error
+
+    async def fetch_chunk(self, network, path, calls):
+        self.sent.append([i["method"] for i in calls])
+        if self.error is not None:
+            raise self.error
+        return [(200, i["method"].encode()) for i in calls]
+
+
+def get_batcher(config, batches, window_ms=5, max_size=3):
+    config.MICROBATCH.update(NETWORKS={"eth"}, WINDOW_MS=window_ms, MAX_SIZE=max_size)
+    return MicroBatcher(config, batches)
+
+
+def test_calls_within_the_window_share_a_batch(config):
+    batches = Batches()
+    batcher = get_batcher(config, batches, max_size=10)
+
+    async def run():
+        calls = [batcher.fetch("eth", None, {"method": f"m{i}"}) for i in range(4)]
+        return await asyncio.gather(*calls)
+
+    assert asyncio.run(run()) == [(200, f"m{i}".encode()) for i in range(4)]
+    assert batches.sent == [["m0", "m1", "m2", "m3"]]
+    assert batcher.enabled_for("eth") and not batcher.enabled_for("bsc")
+
+
+def test_full_batches_are_sent_without_waiting(config):
+    batches = Batches()
+    batcher = get_batcher(config, batches, window_ms=10000)
+
+    async def run():
+        calls = [batcher.fetch("eth", None, {"method": f"m{i}"}) for i in range(3)]
+        return await asyncio.wait_for(asyncio.gather(*calls), 1)
+
+    assert len(asyncio.run(run())) == 3
+    assert batches.sent == [["m0", "m1", "m2"]]
+
+
+def test_a_failed_batch_fails_its_callers(config):
+    batcher = get_batcher(config, Batches(ConnectionError("down")))
+
+    async def run():
+        calls = [batcher.fetch("eth", None, {"method": f"m{i}"}) for i in range(2)]
+        return await asyncio.wait_for(asyncio.gather(*calls, return_exceptions=True), 1)
+
+    results = asyncio.run(run())
+    assert all(isinstance(i, ConnectionError) for i in results)
+    assert batcher.errors == 1
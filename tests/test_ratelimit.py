@@ -0,0 +1,81 @@
+import asyncio
+import pytest
+from ratelimit import BULK, HIGH, NORMAL, REQUEST_UNITS, BudgetScheduler, RateLimited
+from ratelimit import TokenBucket, get_units
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, burst=5)
+    assert bucket.take(3)
+    assert not bucket.take(3)
+    assert bucket.take(1, reserve=0.5)
+    assert not bucket.take(1, reserve=0.5)
+    assert bucket.wait_time(3) == pytest.approx(0.2, abs=0.01)
+
+
+def test_token_bucket_refills_up_to_burst():
+    bucket = TokenBucket(rate=1000, burst=5)
+    bucket.take(5)
+    bucket.updated -= 1
+    bucket.refill()
+    assert bucket.tokens == 5
+
+
+def test_get_units():
+    assert get_units(REQUEST_UNITS, {"method": "eth_getLogs"}) == (10, BULK)
+    assert get_units(REQUEST_UNITS, {"method": "eth_sendRawTransaction"}) == (1, HIGH)
+    assert get_units(REQUEST_UNITS, {"method": "eth_chainId"}) == (1, NORMAL)
+    assert get_units(REQUEST_UNITS, "debug_traceTransaction") == (20, BULK)
+    batch = [{"method": "eth_call"}, {"method": "eth_sendRawTransaction"}]
+    assert get_units(REQUEST_UNITS, batch) == (3, HIGH)
+    assert get_units(REQUEST_UNITS, []) == (1, NORMAL)
+
+
+def get_scheduler(config, rate, burst, max_wait=5.0):
+    config.BUDGET.update(RU_PER_SEC=rate, BURST=burst, RESERVE=0.2, MAX_WAIT=max_wait)
+    return BudgetScheduler(config, {"eth": {"rpc": ["http://node"], "wss": []}})
+
+
+def test_budget_passes_calls_while_there_is_budget(config):
+    budget = get_scheduler(config, rate=1, burst=100)
+
+    async def run():
+        for _ in range(10):
+            await budget.acquire("eth", {"method": "eth_chainId"})
+        # Networks without a budget are not limited
+        await budget.acquire("other", {"method": "eth_chainId"})
+
+    asyncio.run(run())
+    assert budget.stats()["available"]["eth"] == 90
+
+
+def test_budget_keeps_a_reserve_from_bulk_calls(config):
+    budget = get_scheduler(config, rate=1, burst=100, max_wait=0.05)
+
+    async def run():
+        for _ in range(8):
+            await budget.acquire("eth", {"method": "eth_getLogs"})
+        with pytest.raises(RateLimited) as e:
+            await budget.acquire("eth", {"method": "eth_getLogs"})
+        assert e.value.retry_after > 0
+        # The reserve is left for the other classes
+        await budget.acquire("eth", {"method": "eth_sendRawTransaction"})
+
+    asyncio.run(run())
+    assert budget.rejected == 1
+
+
+def test_budget_releases_waiters_in_priority_order(config):
+    budget = get_scheduler(config, rate=200, burst=10)
+    order = []
+
+    async def call(method):
+        await budget.acquire("eth", {"method": method})
+        order.append(method)
+
+    async def run():
+        budget.buckets["eth"].tokens = 0
+        await asyncio.gather(call("eth_chainId"), call("eth_sendRawTransaction"))
+
+    asyncio.run(run())
+    assert order == ["eth_sendRawTransaction", "eth_chainId"]
@@ -0,0 +1,99 @@
+import asyncio
+import json
+import time
+from starlette.requests import Request
+from cache import ResponseCache
+from coalesce import SingleFlight
+from restcache import ENTRY_HEADER, RestCache, matches_etag
+
+
+class Reply:
+    def __init__(self, content, status_code=200) -> None:
+        self.content = content
+        self.status_code = status_code
+
+
+class Upstream:
+    def __init__(self) -> None:
+        self.fetches = 0
+
+    async def fetch(self, network, method, path, params=None, **kwargs):
+        self.fetches += 1
+        result = {"path": path, "params": dict(params), "n": self.fetches}
+        return Reply(
+            json.dumps({"jsonrpc": "2.0", "id": -1, "result": result}).encode()
+        )
+
+
+def request(query=b"", etag=None):
+    headers = [] if etag is None else [(b"if-none-match", etag.encode())]
+    return Request(
+        {"type": "http", "method": "GET", "query_string": query, "headers": headers}
+    )
+
+
+def get_cache(config):
+    upstream = Upstream()
+    cache = RestCache(config, upstream, ResponseCache(config), SingleFlight(config))
+    return cache, upstream
+
+
+def test_pinned_replies_are_immutable(config):
+    cache, upstream = get_cache(config)
+
+    async def run():
+        first = await cache.respond(request(b"height=5"), "atom", "block")
+        second = await cache.respond(request(b"height=5"), "atom", "block")
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert (first.headers["x-cache"], second.headers["x-cache"]) == ("MISS", "HIT")
+    assert second.headers["cache-control"] == "public, max-age=31536000, immutable"
+    assert second.headers["vary"] == "Accept-Encoding"
+    assert second.headers["etag"].startswith('W/"')
+    assert first.body == second.body and upstream.fetches == 1
+
+
+def test_if_none_match_gets_a_304(config):
+    cache, _ = get_cache(config)
+
+    async def run():
+        first = await cache.respond(request(b"height=5"), "atom", "block")
+        etag = first.headers["etag"]
+        return await cache.respond(
+            request(b"height=5", etag.removeprefix("W/")), "atom", "block"
+        )
+
+    resp = asyncio.run(run())
+    assert resp.status_code == 304 and resp.body == b""
+    assert matches_etag('"a", W/"b"', 'W/"b"') and matches_etag("*", 'W/"b"')
+    assert not matches_etag('"a"', 'W/"b"')
+
+
+def test_stale_replies_are_served_while_refreshed(config):
+    cache, upstream = get_cache(config)
+
+    async def run():
+        await cache.respond(request(), "atom", "status")
+        key = cache.get_key("atom", "status", request().query_params)
+        value = cache.cache.get(key)
+        # Fetched longer ago than the 1s ttl
+        cache.cache.set(
+            key, ENTRY_HEADER.pack(time.time() - 5, value[8:24]) + value[24:], 30
+        )
+        stale = await cache.respond(request(), "atom", "status")
+        await asyncio.sleep(0.01)
+        fresh = await cache.respond(request(), "atom", "status")
+        return stale, fresh
+
+    stale, fresh = asyncio.run(run())
+    assert stale.headers["x-cache"] == "STALE" and int(stale.headers["age"]) >= 5
+    assert (
+        fresh.headers["x-cache"] == "HIT" and json.loads(fresh.body)["result"]["n"] == 2
+    )
+    assert (cache.refreshes, upstream.fetches) == (1, 2)
+
+
+def test_uncached_paths_fall_through(config):
+    cache, _ = get_cache(config)
+    assert asyncio.run(cache.respond(request(), "atom", "broadcast_tx_sync")) is None
@@ -0,0 +1,56 @@
+import os
+import stat
+import asyncio
+from shared import SharedCacheClient, SharedCacheServer
+
+
+def test_large_keys_round_trip(config, tmp_path):
+    config.SHARED["SOCKET"] = str(tmp_path / "shared.sock")
+    server = SharedCacheServer(config)
+    key = "eth:eth_call:" + "a" * 100000
+
+    async def run():
+        listener = await asyncio.start_unix_server(
+            server.handle, path=config.SHARED["SOCKET"]
+        )
+        client = SharedCacheClient(config)
+        try:
+            assert await client.connect()
+            client.set(key, b'"0x1"', 30)
+            value, ttl = await client.get(key)
+            assert value == b'"0x1"' and 0 < ttl <= 30
+            assert await client.get("eth:eth_call:missing") == (None, None)
+        finally:
+            await client.close()
+            listener.close()
+        assert client.send_errors == 0
+
+    asyncio.run(run())
+
+
+def test_unreachable_hub_is_a_miss(config, tmp_path):
+    config.SHARED["SOCKET"] = str(tmp_path / "missing.sock")
+    client = SharedCacheClient(config)
+
+    async def run():
+        assert await client.get("key") == (None, None)
+        client.set("key", b"value")
+
+    asyncio.run(run())
+    assert client.errors == 1
+
+
+def test_socket_is_private(config, tmp_path):
+    config.SHARED["SOCKET"] = str(tmp_path / "shared.sock")
+    server = SharedCacheServer(config)
+
+    async def run():
+        task = asyncio.create_task(server.serve())
+        while not os.path.exists(config.SHARED["SOCKET"]):
+            await asyncio.sleep(0.01)
+        mode = stat.S_IMODE(os.stat(config.SHARED["SOCKET"]).st_mode)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return mode
+
+    assert asyncio.run(run()) == 0o600
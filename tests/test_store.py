@@ -0,0 +1,59 @@
+import os
+import sqlite3
+import asyncio
+from store import PersistentStore
+
+
+def get_store(config, tmp_path, max_bytes=1024**2):
+    config.STORE.update(
+        ENABLED=True, PATH=str(tmp_path / "rpc.sqlite"), MAX_BYTES=max_bytes
+    )
+    store = PersistentStore(config)
+    store.start()
+    return store
+
+
+def test_values_survive_a_restart(config, tmp_path):
+    store = get_store(config, tmp_path)
+    store.put("eth:eth_getBlockByHash:[1]", b'{"number":"0x1"}' * 100)
+    store.close()
+    store = get_store(config, tmp_path)
+    try:
+        value = asyncio.run(store.get("eth:eth_getBlockByHash:[1]"))
+        assert value == b'{"number":"0x1"}' * 100
+        assert asyncio.run(store.get("eth:eth_getBlockByHash:[2]")) is None
+        assert (store.hits, store.misses) == (1, 1)
+        assert store.size > 0
+    finally:
+        store.close()
+
+
+def test_least_recently_used_entries_are_evicted(config, tmp_path):
+    store = get_store(config, tmp_path, max_bytes=40000)
+    for i in range(300):
+        store.put(f"old{i}", os.urandom(100))
+    store.close()
+    connection = sqlite3.connect(config.STORE["PATH"])
+    with connection:
+        connection.execute("UPDATE entries SET used = 0")
+    connection.close()
+    store = get_store(config, tmp_path, max_bytes=40000)
+    try:
+        for i in range(100):
+            store.put(f"new{i}", os.urandom(100))
+        store.close()
+        store = get_store(config, tmp_path, max_bytes=40000)
+        assert store.size <= 40000
+        assert asyncio.run(store.get("new0")) is not None
+        assert asyncio.run(store.get("old0")) is None
+    finally:
+        store.close()
+
+
+def test_disabled_store_is_a_miss(config, tmp_path):
+    config.STORE["PATH"] = str(tmp_path / "rpc.sqlite")
+    store = PersistentStore(config)
+    store.start()
+    store.put("key", b"value")
+    assert asyncio.run(store.get("key")) is None
+    assert not (tmp_path / "rpc.sqlite").exists()
@@ -0,0 +1,55 @@
+import pytest
+from health import UpstreamUnavailable
+from upstream import Endpoint, UpstreamPool
+
+
+def get_pool(config, weights=(1.0, 1.0)):
+    config.UPSTREAM_URLS = {
+        "eth": {
+            "rpc": [
+                {"url": f"http://node{i}", "weight": weight, "index": i}
+                for i, weight in enumerate(weights, 1)
+            ],
+            "wss": [],
+        }
+    }
+    return UpstreamPool(config)
+
+
+def test_endpoint_score_follows_latency_load_and_weight():
+    endpoint = Endpoint("eth", "rpc", "http://node", alpha=0.5)
+    endpoint.observe(0.1)
+    endpoint.observe(0.3)
+    assert endpoint.ewma == pytest.approx(0.2)
+    idle = endpoint.score()
+    endpoint.acquire()
+    assert endpoint.score() == pytest.approx(idle * 2)
+    endpoint.release()
+    endpoint.weight = 2
+    assert endpoint.score() == pytest.approx(idle / 2)
+
+
+def test_choose_prefers_the_fastest_endpoint(config):
+    pool = get_pool(config)
+    fast, slow = pool.endpoints["eth"]["rpc"]
+    fast.observe(0.01)
+    slow.observe(0.2)
+    assert pool.choose("eth") is fast
+    assert pool.choose("eth", exclude=fast) is slow
+    # Queued work moves traffic to the other endpoint
+    for _ in range(30):
+        fast.acquire()
+    assert pool.choose("eth") is slow
+
+
+def test_choose_skips_open_and_lagging_endpoints(config):
+    pool = get_pool(config)
+    first, second = pool.endpoints["eth"]["rpc"]
+    first.lagging = True
+    assert pool.choose("eth") is second
+    second.breaker.trip()
+    # A lagging endpoint is still better than none
+    assert pool.choose("eth") is first
+    first.breaker.trip()
+    with pytest.raises(UpstreamUnavailable):
+        pool.choose("eth")
@@ -0,0 +1,89 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from wsproxy import SharedUpstream, Subscription
+
+
+class Socket:
+    """Answers eth_subscribe and sends `after_reply` right behind the reply."""
+
+    def __init__(self, after_reply=()) -> None:
+        self.incoming = asyncio.Queue()
+        self.after_reply = list(after_reply)
+
+    async def send(self, message):
+        call = json.loads(message)
+        reply = {"jsonrpc": "2.0", "id": call["id"], "result": "0xabc"}
+        self.incoming.put_nowait(json.dumps(reply))
+        for i in self.after_reply:
+            self.incoming.put_nowait(i)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.incoming.get()
+
+
+class Upstream:
+    def __init__(self, socket) -> None:
+        self.socket = socket
+
+    @asynccontextmanager
+    async def websocket(self, network):
+        yield self.socket
+
+
+class Client:
+    def __init__(self) -> None:
+        self.messages = []
+
+    def deliver(self, message, event=False, supersedes=None):
+        self.messages.append(json.loads(message))
+
+
+def event(subscription, params=None):
+    params = (
+        params if params is not None else {"subscription": subscription, "result": 1}
+    )
+    return json.dumps(
+        {"jsonrpc": "2.0", "method": "eth_subscription", "params": params}
+    )
+
+
+def test_events_right_after_the_subscribe_reply_are_delivered():
+    async def run():
+        hub = SharedUpstream("eth", Upstream(Socket([event("0xabc")])))
+        subscription = Subscription('["newHeads"]', {"method": "eth_subscribe"})
+        client = Client()
+        # Already attached, as when resubscribing after the socket dropped
+        subscription.clients[client] = "0x1"
+        hub.subscriptions[subscription.key] = subscription
+        await hub.open(subscription)
+        await asyncio.sleep(0)
+        hub.task.cancel()
+        return hub, client
+
+    hub, client = asyncio.run(run())
+    assert [i["params"]["subscription"] for i in client.messages] == ["0x1"]
+    assert hub.events == 1
+
+
+def test_malformed_events_keep_the_socket_running():
+    malformed = [event(None, params=[1]), event(None, params="x"), event(["0xabc"])]
+
+    async def run():
+        hub = SharedUpstream("eth", Upstream(Socket(malformed + [event("0xabc")])))
+        subscription = Subscription('["newHeads"]', {"method": "eth_subscribe"})
+        client = Client()
+        subscription.clients[client] = "0x1"
+        hub.subscriptions[subscription.key] = subscription
+        await hub.open(subscription)
+        await asyncio.sleep(0)
+        running = not hub.task.done()
+        hub.task.cancel()
+        return running, client
+
+    running, client = asyncio.run(run())
+    assert running
+    assert len(client.messages) == 1
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+import time
+import contextvars
+from contextlib import contextmanager
+from starlette.background import BackgroundTask
+from logger import logger
+
+
+# Phases in Server-Timing order. "send" ends after the headers are out, so it is only logged.
+PHASES = ("read", "cache", "queue", "connect", "upstream", "serialize", "send")
+
+# The timer of the /rpc request being handled. Tasks started by the request copy it,
+# so hedged or coalesced upstream attempts add to the same timer.
+current = contextvars.ContextVar("request_timer", default=None)
+
+
+class RequestTimer:
+    """Nanosecond phase durations of a single request, summed per phase."""
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter_ns()
+        self.handled = None
+        self.phases = {}
+
+    def add(self, name, ns):
+        self.phases[name] = self.phases.get(name, 0) + ns
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter_ns() - start)
+
+    def connect_tracer(self):
+        """Returns an httpx `trace` extension adding new connection and TLS setup time
+        to the connect phase. Returns the tracer and a function giving the total so far.
+        """
+        started = {}
+        total = 0
+
+        async def trace(name, info):
+            nonlocal total
+            event, _, stage = name.rpartition(".")
+            if event not in ("connection.connect_tcp", "connection.start_tls"):
+                return
+            if stage == "started":
+                started[event] = time.perf_counter_ns()
+            elif event in started:
+                elapsed = time.perf_counter_ns() - started.pop(event)
+                total += elapsed
+                self.add("connect", elapsed)
+
+        return trace, lambda: total
+
+    def elapsed(self):
+        return time.perf_counter_ns() - self.start
+
+    def header(self):
+        """Returns a Server-Timing header value, durations in milliseconds."""
+        handled = self.handled or self.elapsed()
+        parts = [
+            f"{i};dur={self.phases[i] / 1e6:.3f}" for i in PHASES if i in self.phases
+        ]
+        parts.append(f"total;dur={handled / 1e6:.3f}")
+        return ", ".join(parts)
+
+    def describe(self):
+        parts = [f"{i}={self.phases[i] / 1e6:.1f}" for i in PHASES if i in self.phases]
+        return " ".join(parts)
+
+
+@contextmanager
+def phase(name):
+    """Times a block into the current request's phase, if there is a request."""
+    timer = current.get()
+    if timer is None:
+        yield
+        return
+    with timer.phase(name):
+        yield
+
+
+class RequestTiming:
+    """Times the phases of /rpc requests: body read, cache lookup, upstream queueing,
+    connect and wait, serialization and sending. Durations are reported in a
+    Server-Timing header, and requests slower than SLOW_REQUEST_MS are logged."""
+
+    def __init__(self, config) -> None:
+        self.server_timing = config.TIMING["SERVER_TIMING"]
+        self.slow_ns = int(config.TIMING["SLOW_REQUEST_MS"] * 1e6)
+        self.requests = 0
+        self.slow = 0
+
+    def start(self):
+        """Starts timing the request handled by the current task."""
+        timer = RequestTimer()
+        current.set(timer)
+        return timer
+
+    def finish(self, timer, resp, label):
+        """Adds the Server-Timing header and times sending the body, which only ends once
+        the response's background tasks run."""
+        timer.handled = timer.elapsed()
+        self.requests += 1
+        if self.server_timing:
+            resp.headers["Server-Timing"] = timer.header()
+        background = resp.background
+
+        async def sent():
+            timer.add("send", timer.elapsed() - timer.handled)
+            if background is not None:
+                await background()
+            self.check(timer, label)
+
+        resp.background = BackgroundTask(sent)
+        return resp
+
+    def check(self, timer, label):
+        total = timer.elapsed()
+        if total < self.slow_ns:
+            return
+        self.slow += 1
+        logger.warning(
+            f"Slow request {label}: {total / 1e6:.1f} ms ({timer.describe()})"
+        )
+
+    def stats(self):
+        return {
+            "server_timing": self.server_timing,
+            "slow_request_ms": self.slow_ns / 1e6,
+            "requests": self.requests,
+            "slow": self.slow,
+        }
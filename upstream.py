@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+import time
+import functools
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+import httpx
+import websockets
+from hedge import Hedger
+from health import CircuitBreaker, UpstreamUnavailable
+from metrics import Histogram
+from ratelimit import BudgetScheduler
+from logger import logger
+import timing
+
+
+# Upstream response headers relayed unchanged to the client in passthrough mode
+PASSTHROUGH_HEADERS = ("content-type", "content-encoding", "content-length")
+
+
+class Endpoint:
+    """A single upstream URL with its load-balancing stats."""
+
+    def __init__(
+        self, network, proto, url, weight=1.0, index=1, alpha=0.3, breaker=None
+    ) -> None:
+        self.network = network
+        self.proto = proto
+        self.url = url
+        self.weight = weight
+        self.name = f"{network}-{proto}-{index}"
+        self.alpha = alpha
+        self.ewma = None
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.breaker = breaker
+        self.latency = Histogram()
+        self.statuses = {}
+        # Last height reported to the health checker, and whether it is behind the head
+        self.height = None
+        self.lagging = False
+
+    def get_url(self, path=None):
+        if path is None:
+            return self.url
+        return f"{self.url}/{path}"
+
+    def score(self):
+        """Lower is better: expected latency, scaled by queued work and weight."""
+        ewma = self.ewma or 0
+        return (ewma + 0.001) * (self.outstanding + 1) / self.weight
+
+    def available(self):
+        return self.breaker is None or self.breaker.available()
+
+    def acquire(self):
+        """Counts a request as outstanding. Returns whether it is the breaker's trial,
+        to be passed back to `release`."""
+        self.outstanding += 1
+        self.requests += 1
+        return self.breaker is not None and self.breaker.begin()
+
+    def release(self, trial=False):
+        self.outstanding -= 1
+        if self.breaker is not None:
+            self.breaker.end(trial)
+
+    def observe(self, elapsed):
+        if self.ewma is None:
+            self.ewma = elapsed
+        else:
+            self.ewma += self.alpha * (elapsed - self.ewma)
+        if self.breaker is not None:
+            self.breaker.success()
+
+    def failed(self):
+        self.errors += 1
+        if self.breaker is not None:
+            self.breaker.failure()
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "host": urlsplit(self.url).hostname,
+            "weight": self.weight,
+            "ewma_ms": round(self.ewma * 1000, 2) if self.ewma is not None else None,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "height": self.height,
+            "lagging": self.lagging,
+            **(self.breaker.stats() if self.breaker is not None else {}),
+        }
+
+
+class UpstreamPool:
+    """Shared async HTTP clients for upstream RPC endpoints, one keep-alive pool per network.
+    Requests are spread across each network's endpoints by latency and load."""
+
+    def __init__(self, config) -> None:
+        self.config = config
+        self.settings = config.UPSTREAM
+        self.clients = {}
+        self.http2 = self.settings["HTTP2"] and self.h2_available()
+        self.hedger = Hedger(config)
+        self.endpoints = {}
+        for network, protos in config.UPSTREAM_URLS.items():
+            self.endpoints[network] = {
+                proto: [
+                    Endpoint(
+                        network,
+                        proto,
+                        i["url"],
+                        weight=i["weight"],
+                        index=i["index"],
+                        alpha=config.BALANCER["EWMA_ALPHA"],
+                        breaker=CircuitBreaker(config.BREAKER),
+                    )
+                    for i in urls
+                ]
+                for proto, urls in protos.items()
+            }
+        self.budget = BudgetScheduler(config, self.endpoints)
+
+    def h2_available(self):
+        """Returns True if the optional `h2` package needed for HTTP/2 is installed."""
+        try:
+            import h2  # noqa: F401
+
+            return True
+        except ImportError:
+            logger.warning(
+                "UPSTREAM_HTTP2 is set but `h2` is not installed, using HTTP/1.1"
+            )
+            return False
+
+    def get_limits(self):
+        return httpx.Limits(
+            max_connections=self.settings["MAX_CONNECTIONS"],
+            max_keepalive_connections=self.settings["MAX_KEEPALIVE"],
+            keepalive_expiry=self.settings["KEEPALIVE_EXPIRY"],
+        )
+
+    def get_timeout(self):
+        return httpx.Timeout(
+            connect=self.settings["CONNECT_TIMEOUT"],
+            read=self.settings["READ_TIMEOUT"],
+            write=self.settings["READ_TIMEOUT"],
+            pool=self.settings["CONNECT_TIMEOUT"],
+        )
+
+    def start(self):
+        """Opens a client for every configured network."""
+        for network, protos in self.endpoints.items():
+            if protos["rpc"]:
+                self.client(network)
+        logger.info(f"Upstream pools ready for {list(self.clients.keys())}")
+
+    def client(self, network):
+        """Returns the pooled client for a network, creating it if needed."""
+        if network not in self.clients:
+            self.clients[network] = httpx.AsyncClient(
+                http2=self.http2,
+                limits=self.get_limits(),
+                timeout=self.get_timeout(),
+            )
+        return self.clients[network]
+
+    def choose(self, network, proto="rpc", exclude=None):
+        """Returns the endpoint with the lowest expected latency for a network,
+        preferring one other than `exclude` if there is a choice. Endpoints with an
+        open circuit are skipped, and lagging ones are only used if nothing else is left.
+        """
+        endpoints = [i for i in self.endpoints[network][proto] if i.available()]
+        if not endpoints:
+            raise UpstreamUnavailable(f"no healthy {proto} upstream for {network}")
+        endpoints = [i for i in endpoints if not i.lagging] or endpoints
+        if exclude is not None and len(endpoints) > 1:
+            endpoints = [i for i in endpoints if i is not exclude]
+        return min(endpoints, key=lambda i: i.score())
+
+    async def fetch(
+        self,
+        network,
+        method,
+        path=None,
+        content=None,
+        params=None,
+        headers=None,
+        rpc_method=None,
+        call=None,
+    ):
+        """Sends a request upstream and reads the full (decoded) response body.
+        Read-only calls identified by `rpc_method` may be hedged. `call` is the
+        JSON-RPC call or batch being sent, for request unit budgeting."""
+        request = functools.partial(
+            self.request,
+            network,
+            method,
+            path,
+            content,
+            params,
+            headers,
+            call=call if call is not None else rpc_method,
+        )
+        if not self.hedger.eligible(rpc_method):
+            return await request()
+        first = self.choose(network)
+        return await self.hedger.run(
+            network,
+            rpc_method,
+            functools.partial(request, endpoint=first),
+            functools.partial(request, endpoint=self.choose(network, exclude=first)),
+        )
+
+    async def send(
+        self,
+        network,
+        method,
+        path=None,
+        content=None,
+        params=None,
+        headers=None,
+        call=None,
+    ):
+        """Sends a request upstream without reading the body, for streaming passthrough.
+        The caller is responsible for closing the returned response."""
+        return await self.request(
+            network, method, path, content, params, headers, stream=True, call=call
+        )
+
+    async def request(
+        self,
+        network,
+        method,
+        path,
+        content=None,
+        params=None,
+        headers=None,
+        stream=False,
+        endpoint=None,
+        call=None,
+    ):
+        with timing.phase("queue"):
+            await self.budget.acquire(network, call)
+        client = self.client(network)
+        if endpoint is None:
+            endpoint = self.choose(network)
+        timer = timing.current.get()
+        extensions = None
+        if timer is not None:
+            trace, connected = timer.connect_tracer()
+            extensions = {"trace": trace}
+        request = client.build_request(
+            method,
+            endpoint.get_url(path),
+            content=content,
+            params=params,
+            headers=headers,
+            extensions=extensions,
+        )
+        start = time.perf_counter_ns()
+        trial = endpoint.acquire()
+        try:
+            r = await client.send(request, stream=stream)
+        except Exception:
+            endpoint.failed()
+            raise
+        finally:
+            endpoint.release(trial)
+            if timer is not None:
+                # Until the response headers, or the whole body when not streaming
+                timer.add("upstream", time.perf_counter_ns() - start - connected())
+        elapsed = (time.perf_counter_ns() - start) / 1e9
+        endpoint.latency.observe(elapsed)
+        endpoint.statuses[r.status_code] = endpoint.statuses.get(r.status_code, 0) + 1
+        if r.status_code >= 500 or r.status_code == 429:
+            endpoint.failed()
+        else:
+            endpoint.observe(elapsed)
+        return r
+
+    def passthrough_headers(self, response):
+        return {
+            k: response.headers[k] for k in PASSTHROUGH_HEADERS if k in response.headers
+        }
+
+    def websocket_options(self):
+        """Returns the keepalive and compression settings for upstream sockets."""
+        settings = self.config.WEBSOCKET
+        return {
+            "compression": "deflate" if settings["COMPRESSION"] else None,
+            "ping_interval": settings["PING_INTERVAL"],
+            "ping_timeout": settings["PING_TIMEOUT"],
+            "max_size": settings["MAX_MESSAGE_BYTES"],
+        }
+
+    @asynccontextmanager
+    async def websocket(self, network):
+        """Opens a WebSocket to the best upstream for a network, held as outstanding
+        load on that endpoint until closed."""
+        endpoint = self.choose(network, "wss")
+        start = time.perf_counter()
+        trial = endpoint.acquire()
+        try:
+            try:
+                ws = await websockets.connect(endpoint.url, **self.websocket_options())
+            except Exception:
+                endpoint.failed()
+                raise
+            endpoint.observe(time.perf_counter() - start)
+            if trial:
+                # A trial ends with the handshake, not with the socket
+                endpoint.breaker.end(trial)
+                trial = False
+            try:
+                yield ws
+            finally:
+                await ws.close()
+        finally:
+            endpoint.release(trial)
+
+    def stats(self):
+        return {
+            network: [i.stats() for proto in protos.values() for i in proto]
+            for network, protos in self.endpoints.items()
+            if any(protos.values())
+        }
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients = {}
@@ -0,0 +1,586 @@
+#!/usr/bin/env python3
+import asyncio
+import secrets
+from collections import deque
+from contextlib import AsyncExitStack
+import websockets
+from fastapi import WebSocket, WebSocketDisconnect
+import jsonrpc
+from logger import logger
+from ratelimit import RateLimited
+
+
+EVM_METHODS = {"subscribe": "eth_subscribe", "unsubscribe": "eth_unsubscribe"}
+TENDERMINT_METHODS = {
+    "subscribe": "subscribe",
+    "unsubscribe": "unsubscribe",
+    "unsubscribe_all": "unsubscribe_all",
+}
+
+# Only meaningful on a socket, never answered through the HTTP path
+SOCKET_METHODS = {*EVM_METHODS.values(), *TENDERMINT_METHODS.values()}
+
+# Seconds to wait for the upstream to confirm a (un)subscribe request
+REQUEST_TIMEOUT = 10
+
+
+class Subscription:
+    """One upstream subscription, shared by every client that asked for it."""
+
+    def __init__(self, key, request, heads=False) -> None:
+        self.key = key
+        self.request = request
+        # Head events, where only the newest one matters to a lagging client
+        self.heads = heads
+        self.upstream_id = None
+        self.opened = asyncio.get_running_loop().create_future()
+        # ClientSession -> the id that client knows this subscription by
+        self.clients = {}
+
+
+class SharedUpstream:
+    """A single upstream WebSocket per network, carrying the subscriptions of all clients.
+    Events are fanned out to each subscribed client with its own id written in, and
+    upstream subscriptions are dropped when their last client leaves."""
+
+    def __init__(self, network, upstream, tendermint=False) -> None:
+        self.network = network
+        self.upstream = upstream
+        self.tendermint = tendermint
+        self.methods = TENDERMINT_METHODS if tendermint else EVM_METHODS
+        self.ws = None
+        self.task = None
+        self.reconnect = None
+        self.connected = None
+        self.next_id = 0
+        self.pending = {}
+        # Request id -> the subscription its reply opens
+        self.opening = {}
+        self.subscriptions = {}
+        self.by_upstream_id = {}
+        self.events = 0
+
+    async def connect(self):
+        if self.task is None or self.task.done():
+            self.connected = asyncio.get_running_loop().create_future()
+            self.task = asyncio.create_task(self.run())
+        await asyncio.shield(self.connected)
+
+    async def run(self):
+        try:
+            async with self.upstream.websocket(self.network) as ws:
+                self.ws = ws
+                self.connected.set_result(True)
+                async for message in ws:
+                    try:
+                        self.dispatch(message)
+                    except Exception as e:
+                        # One bad message must not end every client's subscriptions
+                        logger.warning(f"Dropped a message on {self.network}: {e}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Shared upstream socket for {self.network} failed: {e}")
+            if not self.connected.done():
+                self.connected.set_exception(e)
+        finally:
+            self.ws = None
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("upstream socket closed"))
+            self.pending = {}
+            self.opening = {}
+            self.by_upstream_id = {}
+            for subscription in self.subscriptions.values():
+                subscription.upstream_id = None
+        # A failed run of the reconnect task itself lands here too, it keeps retrying
+        if self.subscriptions and (self.reconnect is None or self.reconnect.done()):
+            self.reconnect = asyncio.create_task(self.resubscribe())
+
+    async def resubscribe(self):
+        """Restores every shared subscription after the upstream socket dropped.
+        Clients keep their ids, they only miss the events sent while disconnected."""
+        delay = 1
+        while self.subscriptions:
+            await asyncio.sleep(delay)
+            try:
+                await self.connect()
+                for subscription in list(self.subscriptions.values()):
+                    if subscription.upstream_id is None:
+                        await self.open(subscription)
+                return
+            except Exception as e:
+                logger.warning(f"Resubscribing on {self.network} failed: {e}")
+                delay = min(delay * 2, 60)
+
+    async def request(self, payload, subscription=None):
+        """Sends a request on the shared socket, returning the reply and the id used.
+        The `subscription` a subscribe request opens is registered as its reply is read,
+        so no event sent right after the reply is missed."""
+        await self.connect()
+        self.next_id += 1
+        id = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[id] = future
+        if subscription is not None:
+            self.opening[id] = subscription
+        try:
+            await self.ws.send(jsonrpc.dumps(dict(payload, id=id)).decode())
+            return await asyncio.wait_for(future, REQUEST_TIMEOUT), id
+        finally:
+            self.pending.pop(id, None)
+            self.opening.pop(id, None)
+
+    def dispatch(self, message):
+        try:
+            data = jsonrpc.loads(message)
+        except ValueError:
+            return
+        if not isinstance(data, dict):
+            return
+        id = data.get("id")
+        future = self.pending.get(id) if isinstance(id, int) else None
+        if future is not None and not future.done():
+            subscription = self.opening.pop(id, None)
+            if subscription is not None and "error" not in data:
+                self.register(
+                    subscription, id if self.tendermint else data.get("result")
+                )
+            future.set_result(data)
+            return
+        if self.tendermint:
+            # Tendermint events carry the id of the subscribe request
+            subscription = self.by_upstream_id.get(id)
+            if subscription is None:
+                return
+            rest = jsonrpc.dumps({k: v for k, v in data.items() if k != "id"}).decode()
+            for client, client_id in list(subscription.clients.items()):
+                client.deliver(
+                    '{"id":' + jsonrpc.dumps(client_id).decode() + "," + rest[1:],
+                    event=True,
+                    supersedes=client_id if subscription.heads else None,
+                )
+        elif data.get("method") == "eth_subscription":
+            params = data.get("params")
+            upstream_id = (
+                params.get("subscription") if isinstance(params, dict) else None
+            )
+            if not isinstance(upstream_id, str):
+                return
+            subscription = self.by_upstream_id.get(upstream_id)
+            if subscription is None:
+                return
+            for client, client_id in list(subscription.clients.items()):
+                client.deliver(
+                    message.replace(f'"{upstream_id}"', f'"{client_id}"', 1),
+                    event=True,
+                    supersedes=client_id if subscription.heads else None,
+                )
+        else:
+            return
+        self.events += 1
+
+    def get_key(self, call):
+        params = call.get("params")
+        if self.tendermint:
+            return params.get("query") if isinstance(params, dict) else None
+        return jsonrpc.canonical_params(params)
+
+    async def open(self, subscription):
+        reply, _ = await self.request(subscription.request, subscription)
+        if "error" in reply:
+            raise ValueError(reply["error"].get("message", "subscribe failed"))
+        if subscription.upstream_id is None:
+            raise ValueError(f"unexpected subscribe reply: {reply.get('result')}")
+
+    def register(self, subscription, upstream_id):
+        if not self.tendermint and not isinstance(upstream_id, str):
+            return
+        subscription.upstream_id = upstream_id
+        self.by_upstream_id[upstream_id] = subscription
+
+    async def subscribe(self, client, call):
+        """Attaches a client to the shared subscription for `call`, opening it if needed."""
+        key = self.get_key(call)
+        if key is None:
+            return jsonrpc.error_body(call.get("id"), -32602, "Invalid params")
+        subscription = self.subscriptions.get(key)
+        if subscription is None:
+            subscription = Subscription(
+                key,
+                {
+                    "jsonrpc": "2.0",
+                    "method": call["method"],
+                    "params": call.get("params"),
+                },
+                heads="NewBlock" in key if self.tendermint else key == '["newHeads"]',
+            )
+            self.subscriptions[key] = subscription
+            try:
+                await self.open(subscription)
+                subscription.opened.set_result(True)
+            except Exception as e:
+                del self.subscriptions[key]
+                subscription.opened.set_exception(e)
+                subscription.opened.exception()
+                return jsonrpc.error_body(
+                    call.get("id"), -32603, f"Subscribe failed: {e}"
+                )
+        else:
+            try:
+                await asyncio.shield(subscription.opened)
+            except Exception as e:
+                return jsonrpc.error_body(
+                    call.get("id"), -32603, f"Subscribe failed: {e}"
+                )
+        if self.tendermint:
+            client_id, handle, result = call.get("id"), key, {}
+        else:
+            client_id = handle = result = "0x" + secrets.token_hex(16)
+        subscription.clients[client] = client_id
+        client.subscriptions[handle] = (self, subscription)
+        return jsonrpc.dumps({"jsonrpc": "2.0", "id": call.get("id"), "result": result})
+
+    def unsubscribe(self, client, call):
+        params = call.get("params")
+        if call["method"] == "unsubscribe_all":
+            handles = [h for h, (hub, _) in client.subscriptions.items() if hub is self]
+        elif self.tendermint:
+            handles = [self.get_key(call)]
+        else:
+            handles = params[:1] if isinstance(params, list) else []
+        removed = [self.detach(client, handle) for handle in handles]
+        result = {} if self.tendermint else any(removed)
+        return jsonrpc.dumps({"jsonrpc": "2.0", "id": call.get("id"), "result": result})
+
+    def detach(self, client, handle):
+        entry = client.subscriptions.pop(handle, None)
+        if entry is None:
+            return False
+        subscription = entry[1]
+        subscription.clients.pop(client, None)
+        if not subscription.clients:
+            self.close(subscription)
+        return True
+
+    def close(self, subscription):
+        """Drops a subscription nobody is listening to anymore. The upstream side is
+        released in the background, so this is safe to call while a client is torn down.
+        """
+        self.subscriptions.pop(subscription.key, None)
+        if subscription.upstream_id is not None:
+            self.by_upstream_id.pop(subscription.upstream_id, None)
+        asyncio.create_task(self.release(subscription))
+
+    async def release(self, subscription):
+        if subscription.upstream_id is not None:
+            if self.tendermint:
+                params = {"query": subscription.key}
+                request = {"jsonrpc": "2.0", "method": "unsubscribe", "params": params}
+            else:
+                params = [subscription.upstream_id]
+                request = {
+                    "jsonrpc": "2.0",
+                    "method": "eth_unsubscribe",
+                    "params": params,
+                }
+            try:
+                await self.request(request)
+            except Exception as e:
+                logger.warning(f"Unsubscribing on {self.network} failed: {e}")
+        # Close the socket once the last subscription is gone
+        if not self.subscriptions:
+            if self.reconnect is not None:
+                self.reconnect.cancel()
+                self.reconnect = None
+            if self.task is not None:
+                self.task.cancel()
+                self.task = None
+
+    def stats(self):
+        return {
+            "connected": self.ws is not None,
+            "subscriptions": len(self.subscriptions),
+            "clients": sum(len(i.clients) for i in self.subscriptions.values()),
+            "events": self.events,
+        }
+
+
+class ClientSession:
+    """A downstream WebSocket client, its subscriptions and bounded outbound queue.
+    A writer task drains the queue, so a slow client never stalls the upstream reader;
+    once the queue is full the slow-consumer policy decides what gives."""
+
+    def __init__(self, websocket: WebSocket, network, settings) -> None:
+        self.websocket = websocket
+        self.network = network
+        self.queue_size = settings["QUEUE_SIZE"]
+        self.policy = settings["SLOW_POLICY"]
+        self.queue = deque()
+        self.ready = asyncio.Event()
+        # supersedes key -> its still queued entry
+        self.superseded = {}
+        self.dropped = 0
+        self.coalesced = 0
+        self.closing = False
+        # handle -> (SharedUpstream, Subscription)
+        self.subscriptions = {}
+
+    def deliver(self, message, event=False, supersedes=None):
+        """Queues a text or binary frame. Events may be dropped under backpressure,
+        and a queued event is replaced by a newer one with the same `supersedes` key."""
+        if self.closing:
+            return
+        if self.policy == "coalesce" and supersedes is not None:
+            entry = self.superseded.get(supersedes)
+            if entry is not None:
+                entry[0] = message
+                self.coalesced += 1
+                return
+        if len(self.queue) >= self.queue_size:
+            # Replies to the client's own requests are never dropped, a client too slow
+            # to take them, or with only replies queued, is disconnected instead
+            if not event or self.policy == "disconnect" or not self.drop_oldest_event():
+                self.close(1013)
+                return
+        entry = [message, event, supersedes]
+        self.queue.append(entry)
+        if supersedes is not None and self.policy == "coalesce":
+            self.superseded[supersedes] = entry
+        self.ready.set()
+
+    def drop_oldest_event(self):
+        """Drops the oldest queued event, returns False if only replies are queued."""
+        for entry in self.queue:
+            if entry[1]:
+                self.queue.remove(entry)
+                self.forget(entry)
+                self.dropped += 1
+                return True
+        return False
+
+    def close(self, code):
+        """Closes the client socket, the reader side then tears the session down."""
+        if self.closing:
+            return
+        self.closing = True
+        asyncio.create_task(self.close_socket(code))
+
+    async def close_socket(self, code):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            # Already closed by the client
+            pass
+
+    def forget(self, entry):
+        if entry[2] is not None and self.superseded.get(entry[2]) is entry:
+            del self.superseded[entry[2]]
+
+    async def write(self):
+        try:
+            while True:
+                while not self.queue:
+                    self.ready.clear()
+                    await self.ready.wait()
+                entry = self.queue.popleft()
+                self.forget(entry)
+                if isinstance(entry[0], bytes):
+                    await self.websocket.send_bytes(entry[0])
+                else:
+                    await self.websocket.send_text(entry[0])
+        except (WebSocketDisconnect, RuntimeError):
+            # The client went away, the reader side cleans up
+            pass
+        except Exception as e:
+            logger.warning(
+                f"Writing to a WebSocket client on {self.network} failed: {e}"
+            )
+            self.close(1011)
+
+
+class WebSocketProxy:
+    """Serves downstream WebSocket clients. Subscriptions are shared across clients
+    through one upstream socket per network, other traffic is relayed on a private
+    upstream socket opened on first use."""
+
+    def __init__(self, config, upstream, limiter=None) -> None:
+        self.upstream = upstream
+        # Per-client rate limits, charged for every JSON-RPC message
+        self.limiter = limiter
+        self.settings = config.WEBSOCKET
+        self.tendermint = config.HEADS["TENDERMINT_NETWORKS"]
+        self.hubs = {}
+        # async (network, body, call) -> reply body, serving calls via the HTTP path
+        self.call_handler = None
+        self.clients = 0
+        self.calls = 0
+        self.limited = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.disconnected = 0
+
+    def get_hub(self, network):
+        if network not in self.hubs:
+            if not self.upstream.endpoints.get(network, {}).get("wss"):
+                return None
+            self.hubs[network] = SharedUpstream(
+                network, self.upstream, tendermint=network in self.tendermint
+            )
+        return self.hubs[network]
+
+    async def serve(self, client_ws: WebSocket, network):
+        client = ClientSession(client_ws, network, self.settings)
+        hub = self.get_hub(network)
+        writer = asyncio.create_task(client.write())
+        calls = set()
+        inflight = asyncio.Semaphore(self.settings["MAX_INFLIGHT"])
+        self.clients += 1
+        async with AsyncExitStack() as stack:
+            private = None
+            try:
+                while True:
+                    frame = await client_ws.receive()
+                    if frame["type"] == "websocket.disconnect":
+                        break
+                    # Binary frames are passed through untouched
+                    message = frame.get("text")
+                    if message is None:
+                        message = frame.get("bytes")
+                    else:
+                        call = jsonrpc.parse_call(message)
+                        reply = self.check_limit(client_ws, call)
+                        if reply is None:
+                            reply = await self.handle_subscription(client, hub, call)
+                        if reply is not None:
+                            client.deliver(reply.decode())
+                            continue
+                        if self.is_routable(network, call):
+                            # Answered concurrently, replies may come back out of order
+                            await inflight.acquire()
+                            task = asyncio.create_task(
+                                self.handle_call(client, network, message, call)
+                            )
+                            calls.add(task)
+                            task.add_done_callback(calls.discard)
+                            task.add_done_callback(lambda _: inflight.release())
+                            continue
+                    if private is None:
+                        private = await stack.enter_async_context(
+                            self.open_private(client, network)
+                        )
+                    await private.send(message)
+            except (WebSocketDisconnect, websockets.exceptions.ConnectionClosed):
+                pass
+            finally:
+                self.clients -= 1
+                self.dropped += client.dropped
+                self.coalesced += client.coalesced
+                self.disconnected += client.closing
+                writer.cancel()
+                for task in calls:
+                    task.cancel()
+                for handle, (subscription_hub, _) in list(client.subscriptions.items()):
+                    subscription_hub.detach(client, handle)
+
+    def check_limit(self, client_ws, call):
+        """Returns a rate limit error reply if the client is over its limit, or None."""
+        if self.limiter is None:
+            return None
+        retry_after = self.limiter.check(client_ws, call)
+        if retry_after is None:
+            return None
+        self.limited += 1
+        id = call.get("id") if isinstance(call, dict) else None
+        message = f"Rate limit exceeded, retry after {retry_after:.1f}s"
+        return jsonrpc.error_body(id, -32005, message)
+
+    async def handle_subscription(self, client, hub, call):
+        """Returns the reply to a (un)subscribe request, or None for any other message."""
+        if hub is None or not isinstance(call, dict):
+            return None
+        method = call.get("method")
+        if method == hub.methods["subscribe"]:
+            return await hub.subscribe(client, call)
+        if method in (hub.methods["unsubscribe"], hub.methods.get("unsubscribe_all")):
+            return hub.unsubscribe(client, call)
+        return None
+
+    def is_routable(self, network, call):
+        """Returns True for request/response calls that can be served like HTTP ones."""
+        if self.call_handler is None:
+            return False
+        if not self.upstream.endpoints.get(network, {}).get("rpc"):
+            return False
+        calls = call if isinstance(call, list) else [call]
+        return len(calls) > 0 and all(
+            isinstance(i, dict)
+            and isinstance(i.get("method"), str)
+            and i["method"] not in SOCKET_METHODS
+            and not jsonrpc.is_stateful(i["method"])
+            for i in calls
+        )
+
+    async def handle_call(self, client, network, message, call):
+        self.calls += 1
+        try:
+            reply = await self.call_handler(network, message.encode(), call)
+        except RateLimited as e:
+            id = call.get("id") if isinstance(call, dict) else None
+            reply = jsonrpc.error_body(id, -32005, f"Rate limit exceeded: {e}")
+        except Exception as e:
+            logger.warning(f"WebSocket call on {network} failed: {e}")
+            id = call.get("id") if isinstance(call, dict) else None
+            reply = jsonrpc.error_body(id, -32603, "Upstream request failed")
+        client.deliver(reply.decode())
+
+    def open_private(self, client, network):
+        """Opens a client's own upstream socket, relaying everything it sends back."""
+        if network in self.upstream.endpoints:
+            connection = self.upstream.websocket(network)
+        else:
+            connection = websockets.connect(
+                "wss://echo.websocket.org", **self.upstream.websocket_options()
+            )
+        return PrivateUpstream(connection, client)
+
+    def stats(self):
+        return {
+            "clients": self.clients,
+            "calls": self.calls,
+            "limited": self.limited,
+            "slow_policy": self.settings["SLOW_POLICY"],
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "disconnected": self.disconnected,
+            "networks": {network: hub.stats() for network, hub in self.hubs.items()},
+        }
+
+
+class PrivateUpstream:
+    """Async context manager for a client's private upstream socket and its relay task."""
+
+    def __init__(self, connection, client) -> None:
+        self.connection = connection
+        self.client = client
+        self.task = None
+
+    async def __aenter__(self):
+        self.ws = await self.connection.__aenter__()
+        # Keepalive pings are handled by the websockets protocol itself
+        self.task = asyncio.create_task(self.relay())
+        return self.ws
+
+    async def __aexit__(self, *exc):
+        self.task.cancel()
+        return await self.connection.__aexit__(*exc)
+
+    async def relay(self):
+        try:
+            async for message in self.ws:
+                self.client.deliver(message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except Exception as e:
+            logger.warning(f"Relaying from a private upstream socket failed: {e}")
+            self.client.close(1011)